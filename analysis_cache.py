@@ -0,0 +1,121 @@
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+
+from filelock import FileLock
+
+
+class AnalysisCache:
+    """
+    Persistent cache of motion analysis timelines, shared by every process
+    using the same `cache_dir`.
+
+    Entries are keyed by a fingerprint of the video's content plus the
+    analysis parameters, so a retried or re-rendered video skips analysis
+    whatever it is called. The fingerprint hashes the file size and a few
+    sampled blocks rather than the whole multi-GB file. Once the cache holds
+    more than `max_bytes`, the least recently used entries are evicted.
+    """
+
+    SAMPLE_SIZE = 1024 * 1024
+    SAMPLE_COUNT = 3
+
+    def __init__(self, cache_dir, max_bytes=256 * 1024 * 1024):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.lock = FileLock(self.cache_dir / ".lock")
+        self.stats_path = self.cache_dir / "stats.json"
+
+    @staticmethod
+    def fingerprint(video_path) -> str:
+        size = os.path.getsize(video_path)
+        digest = hashlib.blake2b(str(size).encode(), digest_size=16)
+
+        with open(video_path, "rb") as f:
+            count = AnalysisCache.SAMPLE_COUNT
+            for i in range(count):
+                f.seek(max(0, size - AnalysisCache.SAMPLE_SIZE) * i // (count - 1))
+                digest.update(f.read(AnalysisCache.SAMPLE_SIZE))
+
+        return digest.hexdigest()
+
+    def key(self, video_path, params: dict) -> str:
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(self.fingerprint(video_path).encode())
+        digest.update(json.dumps(params, sort_keys=True).encode())
+        return digest.hexdigest()
+
+    def get(self, key: str, outpath) -> bool:
+        """
+        Copies the cached timeline for `key` to `outpath`. Returns whether
+        there was one.
+        """
+        entry_path = self._entry_path(key)
+        with self.lock:
+            hit = entry_path.exists()
+            if hit:
+                shutil.copyfile(entry_path, outpath)
+                # The modification time doubles as the LRU timestamp.
+                os.utime(entry_path)
+            self._count("hits" if hit else "misses")
+        return hit
+
+    def put(self, key: str, timeline_path):
+        entry_path = self._entry_path(key)
+        tmp_path = entry_path.with_suffix(f".{os.getpid()}.tmp")
+        shutil.copyfile(timeline_path, tmp_path)
+
+        with self.lock:
+            os.replace(tmp_path, entry_path)
+            self._evict_unlocked()
+
+    def stats(self) -> dict:
+        with self.lock:
+            stats = self._load_stats_unlocked()
+            entries = self._entries_unlocked()
+            stats["entries"] = len(entries)
+            stats["bytes"] = sum(entry.stat().st_size for entry in entries)
+        return stats
+
+    def clear(self):
+        with self.lock:
+            for entry in self._entries_unlocked():
+                entry.unlink()
+            self.stats_path.unlink(missing_ok=True)
+
+    def _entry_path(self, key):
+        return self.cache_dir / f"{key}.json"
+
+    def _entries_unlocked(self):
+        return [
+            entry for entry in self.cache_dir.glob("*.json") if entry != self.stats_path
+        ]
+
+    def _evict_unlocked(self):
+        entries = sorted(
+            ((entry.stat(), entry) for entry in self._entries_unlocked()),
+            key=lambda item: item[0].st_mtime,
+        )
+        total = sum(stat.st_size for stat, _ in entries)
+        for stat, entry in entries:
+            if total <= self.max_bytes:
+                break
+            entry.unlink()
+            total -= stat.st_size
+            self._count("evictions")
+
+    def _load_stats_unlocked(self):
+        stats = {"hits": 0, "misses": 0, "evictions": 0}
+        if self.stats_path.exists():
+            with open(self.stats_path, "r") as f:
+                stats.update(json.load(f))
+        return stats
+
+    def _count(self, name):
+        stats = self._load_stats_unlocked()
+        stats[name] += 1
+        with open(self.stats_path, "w") as f:
+            json.dump(stats, f)
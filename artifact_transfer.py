@@ -0,0 +1,323 @@
+"""
+Serves the stages' video directories to other machines, so a stage can
+fetch files another machine produced without a shared filesystem.
+
+    python artifact_transfer.py --host 0.0.0.0 --port 8766
+
+It listens on loopback only unless `--host` says otherwise, since anyone
+who can reach it can read every video it serves.
+
+Producing stages run with `--publish http://<this host>:8766`, which
+records each file's URL, size and checksum on its progress item as it
+moves on; consuming stages fetch and verify it before working on the item.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import quote, unquote
+
+import requests
+
+from pipeline_metrics import metrics
+
+ROOT = Path(__file__).parent
+ARTIFACT_DIRS = ("downloaded_videos", "processed_videos")
+HOST = "127.0.0.1"
+PORT = 8766
+BLOCK_SIZE = 1024 * 1024
+
+
+class ArtifactChecksumError(RuntimeError):
+    pass
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while block := f.read(BLOCK_SIZE):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def publish(path, base_url):
+    """
+    Describes `path`, one of the files under `ARTIFACT_DIRS`, for a
+    consumer to fetch from the `ArtifactServer` at `base_url`.
+    """
+    path = Path(path)
+    with metrics.span("artifact_publish"):
+        sha256 = file_sha256(path)
+    return {
+        "url": f"{base_url.rstrip('/')}/{path.parent.name}/{quote(path.name)}",
+        "size": path.stat().st_size,
+        "sha256": sha256,
+    }
+
+
+class ArtifactServer(ThreadingHTTPServer):
+    """
+    Serves the files in `ARTIFACT_DIRS` under `root` as
+    `/<directory>/<file name>`, with `Range` support for chunked fetches.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, root, address):
+        super().__init__(address, ArtifactRequestHandler)
+        self.directories = {name: Path(root) / name for name in ARTIFACT_DIRS}
+
+
+class ArtifactRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    RANGE = re.compile(r"bytes=(\d+)-(\d*)$")
+
+    def do_HEAD(self):
+        self._serve(send_body=False)
+
+    def do_GET(self):
+        self._serve(send_body=True)
+
+    def _serve(self, send_body):
+        path = self._resolve()
+        if path is None:
+            self._reply_empty(404)
+            return
+
+        size = path.stat().st_size
+        start, end = 0, size - 1
+        status = 200
+        if "Range" in self.headers:
+            match = self.RANGE.match(self.headers["Range"])
+            if match is None or int(match.group(1)) >= size:
+                self._reply_empty(416, {"Content-Range": f"bytes */{size}"})
+                return
+            start = int(match.group(1))
+            if match.group(2):
+                end = min(int(match.group(2)), size - 1)
+            status = 206
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.end_headers()
+        if not send_body:
+            return
+
+        with open(path, "rb") as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining:
+                block = f.read(min(BLOCK_SIZE, remaining))
+                if not block:
+                    break
+                self.wfile.write(block)
+                remaining -= len(block)
+
+    def _resolve(self):
+        parts = self.path.lstrip("/").split("/")
+        if len(parts) != 2 or parts[0] not in self.server.directories:
+            return None
+        name = unquote(parts[1])
+        if name in ("", ".", "..") or "/" in name:
+            return None
+        path = self.server.directories[parts[0]] / name
+        return path if path.is_file() else None
+
+    def _reply_empty(self, status, headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ArtifactFetcher:
+    """
+    Downloads a published artifact in `chunk_size` ranges, `workers` at a
+    time, into `<destination>.part`. Finished chunks are recorded in
+    `<destination>.part.json`, so a fetch that is interrupted resumes with
+    the chunks it is missing. The whole file is checked against the
+    published SHA-256 before it is moved into place; on a mismatch the
+    partial file is discarded and `ArtifactChecksumError` raised.
+
+    A fetch that fails for good raises one of `ERRORS`; callers give the
+    item back and `discard` what was left of it.
+    """
+
+    ERRORS = (ArtifactChecksumError, requests.RequestException)
+    CHUNK_SIZE = 64 * 1024 * 1024
+    WORKERS = 4
+    MAX_RETRIES = 5
+    MAX_BACKOFF_SECONDS = 32
+    TIMEOUT = 60
+
+    def __init__(
+        self,
+        chunk_size=CHUNK_SIZE,
+        workers=WORKERS,
+        max_retries=MAX_RETRIES,
+        timeout=TIMEOUT,
+    ):
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def fetch(self, artifact, destination):
+        destination = Path(destination)
+        if (
+            destination.exists()
+            and destination.stat().st_size == artifact["size"]
+            and file_sha256(destination) == artifact["sha256"]
+        ):
+            return
+
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        part_path = destination.with_name(destination.name + ".part")
+        state_path = destination.with_name(destination.name + ".part.json")
+        done = self._load_state(state_path, part_path, artifact)
+
+        with open(part_path, "r+b" if part_path.exists() else "w+b") as f:
+            f.truncate(artifact["size"])
+        chunks = [
+            (start, min(start + self.chunk_size, artifact["size"]) - 1)
+            for start in range(0, artifact["size"], self.chunk_size)
+            if start not in done
+        ]
+        if done:
+            print(f"Resuming {destination.name}: {len(chunks)} chunk(s) left.")
+
+        lock = threading.Lock()
+
+        def fetch_chunk(chunk):
+            self._with_retries(self._fetch_range, artifact["url"], part_path, *chunk)
+            with lock:
+                done.add(chunk[0])
+                self._save_state(state_path, artifact, done)
+
+        with metrics.span("artifact_fetch"):
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                # list() re-raises the first chunk that failed for good.
+                list(pool.map(fetch_chunk, chunks))
+
+            if file_sha256(part_path) != artifact["sha256"]:
+                part_path.unlink()
+                state_path.unlink(missing_ok=True)
+                raise ArtifactChecksumError(
+                    f"{destination.name} does not match its published checksum"
+                )
+        os.replace(part_path, destination)
+        state_path.unlink(missing_ok=True)
+
+    @staticmethod
+    def discard(destination):
+        destination = Path(destination)
+        for path in (
+            destination,
+            destination.with_name(destination.name + ".part"),
+            destination.with_name(destination.name + ".part.json"),
+            destination.with_name(destination.name + ".part.tmp"),
+        ):
+            path.unlink(missing_ok=True)
+
+    def _fetch_range(self, url, part_path, start, end):
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = requests.Session()
+
+        with session.get(
+            url,
+            headers={"Range": f"bytes={start}-{end}"},
+            stream=True,
+            timeout=self.timeout,
+        ) as response:
+            response.raise_for_status()
+            if response.status_code != 206:
+                raise requests.HTTPError(
+                    f"{url} ignored the range request", response=response
+                )
+            with open(part_path, "r+b") as f:
+                f.seek(start)
+                received = 0
+                for block in response.iter_content(BLOCK_SIZE):
+                    f.write(block)
+                    received += len(block)
+        if received != end - start + 1:
+            raise requests.ConnectionError(
+                f"Got {received} of {end - start + 1} bytes from {url}"
+            )
+        metrics.count("artifact_bytes", received)
+
+    def _with_retries(self, function, *args):
+        for attempt in range(self.max_retries + 1):
+            try:
+                return function(*args)
+            except requests.RequestException as e:
+                if attempt == self.max_retries:
+                    raise
+                status = getattr(e.response, "status_code", None)
+                if status is not None and status < 500:
+                    raise
+                delay = min(2**attempt, self.MAX_BACKOFF_SECONDS)
+                print(f"Artifact fetch failed ({e}), retrying in {delay}s.")
+                time.sleep(delay + random.random())
+
+    def _load_state(self, state_path, part_path, artifact):
+        # Only resume chunks of this very artifact.
+        if not part_path.exists() or not state_path.exists():
+            return set()
+        with open(state_path, "r") as f:
+            state = json.load(f)
+        if state.get("sha256") != artifact["sha256"] or (
+            state.get("chunk_size") != self.chunk_size
+        ):
+            return set()
+        return set(state["done"])
+
+    def _save_state(self, state_path, artifact, done):
+        tmp_path = state_path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(
+                {
+                    "sha256": artifact["sha256"],
+                    "chunk_size": self.chunk_size,
+                    "done": sorted(done),
+                },
+                f,
+            )
+        os.replace(tmp_path, state_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    args = parser.parse_args()
+
+    server = ArtifactServer(ROOT, (args.host, args.port))
+    print(f"Serving {', '.join(ARTIFACT_DIRS)} on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
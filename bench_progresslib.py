@@ -0,0 +1,316 @@
+"""
+Load harness for ProgressController.
+
+Pre-populates a progress file with `--items` DOWNLOADED items, then starts
+`--workers` processes that hammer it for `--seconds` with a random mix of
+`read_and_move_next_item` (claim), `move_item` (finish one of its claims)
+and `add_item` calls, as many download/process/upload machines would.
+Reports per-call p50/p99 latency, throughput and the time spent waiting for
+the file lock, then checks the final state:
+
+    - no item was claimed by two workers
+    - every item is in exactly one state
+    - the number of items per state matches the calls that succeeded
+    - a fresh controller replaying the files sees the same state
+
+Every combination of `--workers` and `--items` is run; `--output` saves the
+results as JSON so backends or journal settings can be compared. With
+`--backend http` the workers go through a `progress_server.py` coordinator
+started on localhost; lock waits are then the coordinator's and are not
+sampled.
+
+    python bench_progresslib.py --workers 1 4 16 --items 1000 100000
+    python bench_progresslib.py --backend http --workers 16
+"""
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import random
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from progress_client import open_progress
+from progress_server import ProgressServer
+from progresslib import ProgressController, ProgressState
+
+
+class SampledLock:
+    """
+    Wraps the controller's lock to keep every outermost wait.
+    """
+
+    def __init__(self, lock):
+        self.lock = lock
+        self.waits = []
+        self._depth = 0
+
+    def acquire(self):
+        start = time.perf_counter()
+        self.lock.acquire()
+        if self._depth == 0:
+            self.waits.append(time.perf_counter() - start)
+        self._depth += 1
+
+    def release(self):
+        self._depth -= 1
+        self.lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+def make_item(key):
+    return ProgressController.ProgressItem(
+        original_video_name=f"{key}.mp4",
+        new_video_name=f"PROCESSED {key}.mp4",
+        original_playlist_name="Playlist",
+        new_playlist_name="PROCESSED Playlist",
+        original_video_id=key,
+        original_playlist_id="playlist",
+        new_playlist_id="PROCESSED playlist",
+    )
+
+
+def populate(progress_file, items):
+    controller = ProgressController(progress_file)
+    progress_data = {state: {} for state in controller.default_progress}
+    progress_data[ProgressState.DOWNLOADED] = {
+        f"item-{i}": make_item(f"item-{i}") for i in range(items)
+    }
+    with controller.lock:
+        controller._write_snapshot_unlocked(progress_data)
+        controller._start_journal_unlocked()
+
+
+def worker(slot, progress_store, compaction, seconds, add_ratio, seed, barrier):
+    controller = open_progress(progress_store, worker_id=f"bench:{slot}", **compaction)
+    waits = []
+    if isinstance(controller, ProgressController):
+        controller.lock = SampledLock(controller.lock)
+        waits = controller.lock.waits
+    rng = random.Random(seed)
+    latencies = {"claim": [], "finish": [], "add": []}
+    claimed, finished, added = [], [], []
+    outstanding = []
+
+    # Load the state before the clock starts, so the first call of each
+    # worker doesn't count a full snapshot read as one transition.
+    controller.contains("warm-up")
+    barrier.wait()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        roll = rng.random()
+        start = time.perf_counter()
+        if roll < add_ratio:
+            operation = "add"
+            key = f"added-{slot}-{len(added)}"
+            controller.add_item(ProgressState.DOWNLOADED, key, make_item(key))
+            added.append(key)
+        elif outstanding and roll < add_ratio + (1 - add_ratio) / 2:
+            operation = "finish"
+            key = outstanding.pop(rng.randrange(len(outstanding)))
+            controller.move_item(ProgressState.PROCESSING, ProgressState.PROCESSED, key)
+            finished.append(key)
+        else:
+            operation = "claim"
+            next_item = controller.read_and_move_next_item(
+                ProgressState.DOWNLOADED, ProgressState.PROCESSING
+            )
+            if next_item is not None:
+                claimed.append(next_item[0])
+                outstanding.append(next_item[0])
+        latencies[operation].append(time.perf_counter() - start)
+
+    return {
+        "latencies": latencies,
+        "lock_waits": waits,
+        "claimed": claimed,
+        "finished": finished,
+        "added": added,
+    }
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return float("nan")
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+
+def summarize(samples):
+    return {
+        "count": len(samples),
+        "p50_ms": percentile(samples, 0.50) * 1000,
+        "p99_ms": percentile(samples, 0.99) * 1000,
+        "max_ms": max(samples, default=float("nan")) * 1000,
+    }
+
+
+def check_invariants(progress_file, items, results):
+    """
+    Returns a list of violated invariants; empty if the run was consistent.
+    """
+    errors = []
+    claims = [key for result in results for key in result["claimed"]]
+    if len(claims) != len(set(claims)):
+        duplicates = len(claims) - len(set(claims))
+        errors.append(f"{duplicates} item(s) were claimed more than once")
+
+    progress_data = ProgressController(progress_file).load_progress()
+    seen = list(itertools.chain.from_iterable(progress_data.values()))
+    if len(seen) != len(set(seen)):
+        errors.append("some items are in more than one state")
+
+    added = sum(len(result["added"]) for result in results)
+    finished = sum(len(result["finished"]) for result in results)
+    expected = {
+        ProgressState.DOWNLOADED: items + added - len(claims),
+        ProgressState.PROCESSING: len(claims) - finished,
+        ProgressState.PROCESSED: finished,
+    }
+    for state, count in expected.items():
+        if len(progress_data[state]) != count:
+            errors.append(
+                f"{len(progress_data[state])} items in {state.value}, "
+                f"expected {count}"
+            )
+
+    # Folding the journal into the snapshot must not change anything.
+    compacted = ProgressController(progress_file)
+    compacted.compact()
+    if ProgressController(progress_file).load_progress() != progress_data:
+        errors.append("the compacted state differs from the replayed one")
+
+    return errors
+
+
+def run(workers, items, seconds, add_ratio, compaction, seed, backend):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        progress_file = Path(tmp_dir) / "progress.json"
+        populate(progress_file, items)
+
+        progress_store = progress_file
+        if backend == "http":
+            server = ProgressServer(progress_file, ("127.0.0.1", 0))
+            server.controller.compact_every = compaction["compact_every"]
+            server.controller.compact_ratio = compaction["compact_ratio"]
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            progress_store = f"http://127.0.0.1:{server.server_address[1]}"
+            # Compaction is the coordinator's business then.
+            compaction = {}
+
+        context = multiprocessing.get_context("spawn")
+        barrier = context.Manager().Barrier(workers)
+        with context.Pool(workers) as pool:
+            results = pool.starmap(
+                worker,
+                [
+                    (
+                        slot,
+                        progress_store,
+                        compaction,
+                        seconds,
+                        add_ratio,
+                        seed + slot,
+                        barrier,
+                    )
+                    for slot in range(workers)
+                ],
+            )
+
+        if backend == "http":
+            server.shutdown()
+            server.server_close()
+        errors = check_invariants(progress_file, items, results)
+
+    operations = {
+        operation: summarize(
+            [sample for result in results for sample in result["latencies"][operation]]
+        )
+        for operation in ("claim", "finish", "add")
+    }
+    total = sum(summary["count"] for summary in operations.values())
+    return {
+        "backend": backend,
+        "workers": workers,
+        "items": items,
+        "seconds": seconds,
+        "operations_per_second": total / seconds,
+        "operations": operations,
+        "lock_wait": summarize(
+            [wait for result in results for wait in result["lock_waits"]]
+        ),
+        "errors": errors,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--items", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument(
+        "--add-ratio", type=float, default=0.2, help="share of calls that add items"
+    )
+    parser.add_argument(
+        "--compact-every", type=int, default=ProgressController.COMPACT_EVERY
+    )
+    parser.add_argument(
+        "--compact-ratio", type=float, default=ProgressController.COMPACT_RATIO
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--backend", choices=["file", "http"], default="file")
+    parser.add_argument("--output", type=Path)
+    args = parser.parse_args()
+
+    runs = []
+    for items, workers in itertools.product(args.items, args.workers):
+        result = run(
+            workers,
+            items,
+            args.seconds,
+            args.add_ratio,
+            {
+                "compact_every": args.compact_every,
+                "compact_ratio": args.compact_ratio,
+            },
+            args.seed,
+            args.backend,
+        )
+        runs.append(result)
+
+        line = f"{workers} worker(s), {items} items: "
+        line += f"{result['operations_per_second']:.0f} calls/s"
+        # Nothing is sampled when the lock is the coordinator's.
+        if result["lock_wait"]["count"]:
+            line += (
+                f", lock wait p50 {result['lock_wait']['p50_ms']:.2f} ms, "
+                f"p99 {result['lock_wait']['p99_ms']:.2f} ms"
+            )
+        print(line)
+        for operation, summary in result["operations"].items():
+            print(
+                f"  {operation}: {summary['count']} calls, "
+                f"p50 {summary['p50_ms']:.2f} ms, p99 {summary['p99_ms']:.2f} ms, "
+                f"max {summary['max_ms']:.2f} ms"
+            )
+        for error in result["errors"]:
+            print(f"  INVARIANT VIOLATED: {error}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(runs, f, indent=4)
+
+    if any(result["errors"] for result in runs):
+        sys.exit(1)
@@ -0,0 +1,371 @@
+"""
+Benchmarks the VideoProcessor stages on a synthetic video.
+
+The video alternates moving (testsrc2) and static (solid colour) sections,
+with an AAC sine tone as its audio track, so it is the same on every run and
+needs nothing but a local ffmpeg. Each stage
+runs in a fresh process and is measured for wall time, CPU time (including
+ffmpeg and other child processes), peak RSS, output size and speed relative
+to the video's duration:
+
+    analysis     motion analysis (_generate_v1, uncached)
+    overlay      the overlay pass (_edit_add_overlay)
+    speedup      the auto-editor speed-up pass (_edit_apply_speedup)
+    two_pass, single_pass, segmented, smart
+                 the render modes, from the timeline auto-editor would produce
+    process      the whole VideoProcessor.process path in --render-mode
+
+"speedup" and "two_pass" need auto-editor and are skipped without it.
+"segmented" runs once per `--workers` value to show how it scales.
+
+Save a run with --save-baseline and compare later runs against it with
+--baseline; the exit status is 1 if any stage got slower than --tolerance.
+
+    python bench_video_processor.py --sections 8 --section-seconds 30
+    python bench_video_processor.py --stages analysis process --save-baseline base.json
+    python bench_video_processor.py --stages analysis process --baseline base.json
+"""
+
+import argparse
+import json
+import multiprocessing
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from video_processor import VideoProcessor
+
+# CPU time and peak RSS are taken over the stage's process and everything it
+# started and waited for (ffmpeg, auto-editor, segment workers).
+USAGE_WHO = (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)
+
+
+def bench_analysis(video_path, timeline_path, output_path, encoder_settings, options):
+    VideoProcessor._generate_v1(
+        video_path, output_path, threads=encoder_settings.threads
+    )
+
+
+def bench_overlay(video_path, timeline_path, output_path, encoder_settings, options):
+    VideoProcessor._edit_add_overlay(
+        video_path, timeline_path, output_path, encoder_settings
+    )
+
+
+def bench_speedup(video_path, timeline_path, output_path, encoder_settings, options):
+    VideoProcessor._edit_apply_speedup(
+        video_path, timeline_path, output_path, encoder_settings
+    )
+
+
+def bench_two_pass(video_path, timeline_path, output_path, encoder_settings, options):
+    VideoProcessor._render_two_pass(
+        video_path, timeline_path, output_path, encoder_settings
+    )
+
+
+def bench_single_pass(
+    video_path, timeline_path, output_path, encoder_settings, options
+):
+    VideoProcessor._render_single_pass(
+        video_path, timeline_path, output_path, encoder_settings
+    )
+
+
+def bench_segmented(video_path, timeline_path, output_path, encoder_settings, options):
+    VideoProcessor._render_segmented(
+        video_path, timeline_path, output_path, encoder_settings, options["workers"]
+    )
+
+
+def bench_smart(video_path, timeline_path, output_path, encoder_settings, options):
+    VideoProcessor._render_smart(
+        video_path, timeline_path, output_path, encoder_settings, options["workers"]
+    )
+
+
+def bench_process(video_path, timeline_path, output_path, encoder_settings, options):
+    # process() writes its timeline next to the input, so give it a copy.
+    input_path = output_path.with_name(f"{output_path.stem}_input.mp4")
+    shutil.copyfile(video_path, input_path)
+    VideoProcessor.process(
+        input_path,
+        output_path,
+        render_mode=options["render_mode"],
+        encoder_settings=encoder_settings,
+        workers=options["workers"],
+    )
+    input_path.unlink()
+
+
+# name: (function, output suffix, needs auto-editor)
+STAGES = {
+    "analysis": (bench_analysis, ".json", False),
+    "overlay": (bench_overlay, ".mp4", False),
+    "speedup": (bench_speedup, ".mp4", True),
+    "two_pass": (bench_two_pass, ".mp4", True),
+    "single_pass": (bench_single_pass, ".mp4", False),
+    "segmented": (bench_segmented, ".mp4", False),
+    "smart": (bench_smart, ".mp4", False),
+    "process": (bench_process, ".mp4", False),
+}
+
+
+def generate_video(output_path, sections, section_seconds, size):
+    fps = VideoProcessor.VIDEO_FPS
+    command = ["ffmpeg", "-y", "-v", "error"]
+    for i in range(sections):
+        source = "testsrc2=" if i % 2 == 0 else "color=c=gray:"
+        command.extend(
+            [
+                "-f",
+                "lavfi",
+                "-i",
+                f"{source}size={size}:rate={fps}:duration={section_seconds}",
+            ]
+        )
+
+    # A tone per section, so the audio paths (atempo, copying and aligning
+    # audio at the joins) are measured as well.
+    for i in range(sections):
+        command.extend(
+            [
+                "-f",
+                "lavfi",
+                "-i",
+                f"sine=frequency={440 + 110 * (i % 4)}:sample_rate=48000"
+                f":duration={section_seconds}",
+            ]
+        )
+
+    inputs = "".join(f"[{i}:v][{sections + i}:a]" for i in range(sections))
+    command.extend(
+        [
+            "-filter_complex",
+            f"{inputs}concat=n={sections}:v=1:a=1[v][a]",
+            "-map",
+            "[v]",
+            "-map",
+            "[a]",
+            "-c:v",
+            "libx264",
+            "-preset",
+            "ultrafast",
+            "-pix_fmt",
+            "yuv420p",
+            "-c:a",
+            "aac",
+            "-b:a",
+            "128k",
+            output_path,
+        ]
+    )
+    subprocess.run(command, check=True)
+
+
+def generate_timeline(output_path, video_path, sections, section_seconds):
+    # Moving sections play at normal speed, static ones are sped up.
+    frames = section_seconds * VideoProcessor.VIDEO_FPS
+    chunks = [
+        [
+            i * frames,
+            (i + 1) * frames,
+            1 if i % 2 == 0 else VideoProcessor.SPEEDUP_FACTOR,
+        ]
+        for i in range(sections)
+    ]
+    with open(output_path, "w") as f:
+        json.dump({"version": "1", "source": str(video_path), "chunks": chunks}, f)
+
+
+def run_stage(stage, video_path, timeline_path, output_path, encoder_settings, options):
+    """
+    Runs one stage and measures it. Meant to run in a fresh process, so the
+    peak RSS belongs to this stage alone.
+    """
+    VideoProcessor.ANALYSIS_CACHE_DIR = None
+    VideoProcessor.MOTION_ANALYZER = options["analyzer"]
+    function = STAGES[stage][0]
+
+    usage_before = [resource.getrusage(who) for who in USAGE_WHO]
+    start = time.perf_counter()
+    function(video_path, timeline_path, output_path, encoder_settings, options)
+    wall = time.perf_counter() - start
+    usage_after = [resource.getrusage(who) for who in USAGE_WHO]
+
+    cpu = sum(
+        (after.ru_utime + after.ru_stime) - (before.ru_utime + before.ru_stime)
+        for before, after in zip(usage_before, usage_after)
+    )
+    # ru_maxrss is in KiB on Linux.
+    peak_rss = max(usage.ru_maxrss for usage in usage_after) * 1024
+    return {
+        "wall_seconds": wall,
+        "cpu_seconds": cpu,
+        "peak_rss_mb": peak_rss / 1e6,
+        "output_mb": output_path.stat().st_size / 1e6,
+    }
+
+
+def measure(stage, video_path, timeline_path, output_path, encoder_settings, options):
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+        return pool.submit(
+            run_stage,
+            stage,
+            video_path,
+            timeline_path,
+            output_path,
+            encoder_settings,
+            options,
+        ).result()
+
+
+def compare(results, baseline, tolerance):
+    """
+    Prints each stage against the baseline and returns the stages that got
+    more than `tolerance` slower.
+    """
+    regressions = []
+    for name, result in results.items():
+        base = baseline["results"].get(name)
+        if base is None:
+            print(f"{name}: not in baseline")
+            continue
+        ratios = {
+            metric: result[metric] / base[metric] if base[metric] else float("nan")
+            for metric in ("wall_seconds", "cpu_seconds", "peak_rss_mb")
+        }
+        slower = ratios["wall_seconds"] > 1 + tolerance
+        if slower:
+            regressions.append(name)
+        print(
+            f"{name}: {ratios['wall_seconds']:.2f}x wall, "
+            f"{ratios['cpu_seconds']:.2f}x CPU, "
+            f"{ratios['peak_rss_mb']:.2f}x RSS vs baseline"
+            + (" (REGRESSION)" if slower else "")
+        )
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--sections", type=int, default=8)
+    parser.add_argument("--section-seconds", type=int, default=30)
+    parser.add_argument("--size", default="1280x720")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=list(STAGES))
+    parser.add_argument("--codec", default="h264", choices=["h264", "hevc"])
+    parser.add_argument("--encoder")
+    parser.add_argument("--preset")
+    parser.add_argument("--threads", type=int)
+    parser.add_argument("--quality", type=int)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument(
+        "--analyzer",
+        default=VideoProcessor.MOTION_ANALYZER,
+        choices=["native", "auto-editor"],
+    )
+    parser.add_argument("--render-mode", default=VideoProcessor.RENDER_MODE)
+    parser.add_argument(
+        "--repeat", type=int, default=1, help="runs per stage; the fastest is kept"
+    )
+    parser.add_argument("--save-baseline", type=Path)
+    parser.add_argument("--baseline", type=Path)
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.1,
+        help="slowdown vs the baseline counted as a regression",
+    )
+    args = parser.parse_args()
+
+    encoder_settings = VideoProcessor.EncoderSettings(
+        codec=args.codec,
+        encoder=args.encoder,
+        preset=args.preset,
+        threads=args.threads,
+        quality=args.quality,
+    )
+    params = {
+        "sections": args.sections,
+        "section_seconds": args.section_seconds,
+        "size": args.size,
+        "codec": args.codec,
+        "encoder": args.encoder,
+        "preset": args.preset,
+        "threads": args.threads,
+        "quality": args.quality,
+        "analyzer": args.analyzer,
+        "render_mode": args.render_mode,
+    }
+
+    runs = []
+    for stage in args.stages:
+        if STAGES[stage][2] and shutil.which("auto-editor") is None:
+            print(f"Skipping {stage}: auto-editor is not installed.")
+        elif stage == "segmented":
+            runs.extend((f"segmented[{w}]", stage, w) for w in args.workers)
+        else:
+            runs.append((stage, stage, args.workers[-1]))
+
+    duration = args.sections * args.section_seconds
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_dir = Path(tmp_dir)
+        video_path = tmp_dir / "synthetic.mp4"
+        timeline_path = tmp_dir / "synthetic_v1_timeline.json"
+        generate_video(video_path, args.sections, args.section_seconds, args.size)
+        generate_timeline(
+            timeline_path, video_path, args.sections, args.section_seconds
+        )
+
+        for name, stage, workers in runs:
+            output_path = tmp_dir / f"{name}{STAGES[stage][1]}"
+            options = {
+                "workers": workers,
+                "analyzer": args.analyzer,
+                "render_mode": args.render_mode,
+            }
+            result = min(
+                (
+                    measure(
+                        stage,
+                        video_path,
+                        timeline_path,
+                        output_path,
+                        encoder_settings,
+                        options,
+                    )
+                    for _ in range(args.repeat)
+                ),
+                key=lambda result: result["wall_seconds"],
+            )
+            result["realtime_factor"] = duration / result["wall_seconds"]
+            results[name] = result
+            print(
+                f"{name}: {result['wall_seconds']:.1f}s wall, "
+                f"{result['cpu_seconds']:.1f}s CPU, "
+                f"{result['peak_rss_mb']:.0f} MB peak RSS, "
+                f"{result['realtime_factor']:.1f}x real time, "
+                f"{result['output_mb']:.1f} MB"
+            )
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump({"params": params, "results": results}, f, indent=4)
+        print(f"Saved baseline to {args.save_baseline}")
+
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+        if baseline["params"] != params:
+            print("Warning: the baseline was run with different parameters.")
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
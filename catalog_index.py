@@ -0,0 +1,169 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from yt_utils import YoutubeUtils
+
+
+class CatalogIndex:
+    """
+    Local index of the channel's playlists and the videos in them, kept in
+    `index_path` between runs.
+
+    `sync` brings the index up to date with conditional requests: every page
+    of `playlists.list` and `playlistItems.list` is stored with its page token
+    and ETag, and re-requested with `If-None-Match`, so unchanged pages come
+    back as an empty 304 and only changed pages are downloaded again. The
+    playlist resources include their item count, so a playlist whose ETag is
+    unchanged has no new items and its pages aren't requested at all.
+    Playlists that did change are synced concurrently on `workers` threads.
+    """
+
+    VERSION = 1
+    SYNC_WORKERS = 8
+
+    def __init__(self, ytlib: YoutubeUtils, index_path, workers=SYNC_WORKERS):
+        self.ytlib = ytlib
+        self.index_path = Path(index_path)
+        self.workers = workers
+
+        self._index = {"version": self.VERSION, "playlist_pages": [], "items": {}}
+        if self.index_path.exists():
+            with open(self.index_path, "r") as f:
+                index = json.load(f)
+            if index.get("version") == self.VERSION:
+                self._index = index
+        self._video_ids = self._collect_video_ids()
+
+    def __contains__(self, video_id: str) -> bool:
+        return video_id in self._video_ids
+
+    def __len__(self) -> int:
+        return len(self._video_ids)
+
+    def playlists(self) -> list[YoutubeUtils.Playlist]:
+        return [
+            YoutubeUtils.Playlist(item["id"], item["title"])
+            for page in self._index["playlist_pages"]
+            for item in page["items"]
+        ]
+
+    def videos(self) -> list[YoutubeUtils.Video]:
+        """
+        Every video in the index, in playlist order.
+        """
+        videos = []
+        for playlist in self.playlists():
+            entry = self._index["items"].get(playlist.id, {"pages": []})
+            for page in entry["pages"]:
+                for video_id, title in page["items"]:
+                    videos.append(YoutubeUtils.Video(video_id, title, playlist))
+        return videos
+
+    def sync(self) -> list[YoutubeUtils.Video]:
+        """
+        Updates the index and saves it. Returns the videos that weren't in
+        the index before.
+        """
+        playlist_pages = self._sync_pages(
+            lambda token: self.ytlib.youtube.playlists().list(
+                part="snippet,contentDetails",
+                mine=True,
+                maxResults=50,
+                pageToken=token,
+            ),
+            self._index["playlist_pages"],
+            lambda item: {
+                "id": item["id"],
+                "title": item["snippet"]["title"],
+                "etag": item["etag"],
+            },
+        )
+
+        old_items = self._index["items"]
+        playlists = [item for page in playlist_pages for item in page["items"]]
+        changed = [
+            playlist
+            for playlist in playlists
+            if old_items.get(playlist["id"], {}).get("etag") != playlist["etag"]
+        ]
+        print(f"Catalog: {len(changed)} of {len(playlists)} playlists changed.")
+
+        def sync_playlist(playlist):
+            pages = self._sync_pages(
+                lambda token: self.ytlib.youtube.playlistItems().list(
+                    part="snippet",
+                    playlistId=playlist["id"],
+                    maxResults=50,
+                    pageToken=token,
+                ),
+                old_items.get(playlist["id"], {}).get("pages", []),
+                lambda item: [
+                    item["snippet"]["resourceId"]["videoId"],
+                    item["snippet"]["title"],
+                ],
+            )
+            return playlist["id"], {"etag": playlist["etag"], "pages": pages}
+
+        items = {
+            playlist["id"]: old_items[playlist["id"]]
+            for playlist in playlists
+            if playlist["id"] in old_items
+        }
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            items.update(executor.map(sync_playlist, changed))
+
+        known_ids = self._video_ids
+        self._index = {
+            "version": self.VERSION,
+            "playlist_pages": playlist_pages,
+            "items": items,
+        }
+        self._video_ids = self._collect_video_ids()
+        self._save()
+
+        new_videos = [video for video in self.videos() if video.id not in known_ids]
+        print(f"Catalog: {len(self)} videos, {len(new_videos)} new.")
+        return new_videos
+
+    def _sync_pages(self, make_request, cached_pages, parse_item):
+        """
+        Walks a paginated list, reusing each cached page the API reports as
+        unchanged. Cached pages are matched by page token, so a page whose
+        position shifted is simply downloaded again.
+        """
+        cached = {page["token"]: page for page in cached_pages}
+        pages = []
+        token = None
+        while True:
+            page = cached.get(token)
+            response = self.ytlib.execute(
+                make_request(token), etag=page["etag"] if page else None
+            )
+            if response is not None:
+                page = {
+                    "token": token,
+                    "etag": response["etag"],
+                    "next": response.get("nextPageToken"),
+                    "items": [parse_item(item) for item in response.get("items", [])],
+                }
+            pages.append(page)
+
+            token = page["next"]
+            if token is None:
+                return pages
+
+    def _collect_video_ids(self):
+        return set(
+            video_id
+            for entry in self._index["items"].values()
+            for page in entry["pages"]
+            for video_id, _ in page["items"]
+        )
+
+    def _save(self):
+        tmp_path = self.index_path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self._index, f)
+        os.replace(tmp_path, self.index_path)
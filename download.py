@@ -1,9 +1,16 @@
+import argparse
+import asyncio
+import time
 from pathlib import Path
 
 import pyotp
-from playwright.sync_api import TimeoutError as PlaywrightTimeoutError
-from playwright.sync_api import sync_playwright
+from playwright.async_api import TimeoutError as PlaywrightTimeoutError
+from playwright.async_api import async_playwright
 
+from artifact_transfer import publish
+from catalog_index import CatalogIndex
+from pipeline_metrics import metrics
+from progress_client import open_progress
 from progresslib import ProgressController, ProgressState
 from yt_utils import YoutubeUtils
 from my_secrets import (
@@ -22,118 +29,333 @@ totp = pyotp.TOTP(TOTP_SECRET)
 
 OUTPUT_DIR = Path(__file__).parent / "downloaded_videos"
 PROGRESS_FILE = Path(__file__).parent / "progress.json"
+CATALOG_FILE = Path(__file__).parent / "catalog.json"
+# YouTube API units used today, shared with upload.py.
+QUOTA_USAGE_FILE = Path(__file__).parent / "quota_usage.json"
+METRICS_DIR = Path(__file__).parent / "metrics"
+# Browser cookies from the last login, reused until Google expires them.
+STORAGE_STATE_FILE = Path(__file__).parent / ".playwright_state.json"
+HEADLESS = True
+CONCURRENCY = 4
+DOWNLOAD_TIMEOUT = 60 * 60
+DOWNLOAD_RETRIES = 2
+# How often --daemon checks the channel for new videos.
+CATALOG_INTERVAL = 10 * 60
 progress_controller = ProgressController(PROGRESS_FILE)
 
+# Only one page logs in at a time, and the Google API client is not
+# thread-safe, so claims are made one at a time as well.
+login_lock = asyncio.Lock()
+claim_lock = asyncio.Lock()
 
-def login_google(page):
-    page.goto("https://accounts.google.com/")
-    page.get_by_role("textbox", name="Email or phone").fill(EMAIL)
-    page.get_by_role("button", name="Next").click()
-    page.wait_for_selector('input[name="Passwd"]')
-    page.get_by_role("textbox", name="Enter your password").fill(PASSWORD)
-    page.get_by_role("button", name="Next").click()
+
+async def login_google(page):
+    await page.goto("https://accounts.google.com/")
+    await page.get_by_role("textbox", name="Email or phone").fill(EMAIL)
+    await page.get_by_role("button", name="Next").click()
+    await page.wait_for_selector('input[name="Passwd"]')
+    await page.get_by_role("textbox", name="Enter your password").fill(PASSWORD)
+    await page.get_by_role("button", name="Next").click()
 
     # TOTP if needed
     try:
-        page.get_by_role(
+        await page.get_by_role(
             "link", name="Get a verification code from the Google Authenticator app"
         ).wait_for(timeout=5000)
     except PlaywrightTimeoutError:
         print("No TOTP prompt")
         return
 
-    page.get_by_role(
+    await page.get_by_role(
         "link", name="Get a verification code from the Google Authenticator app"
     ).click()
-    page.wait_for_selector('input[name="totpPin"]', timeout=5000)
-    page.fill('input[name="totpPin"]', totp.now())
-    page.get_by_role("button", name="Next").click()
-    page.wait_for_url("https://myaccount.google.com/?pli=1", timeout=10000)
+    await page.wait_for_selector('input[name="totpPin"]', timeout=5000)
+    await page.fill('input[name="totpPin"]', totp.now())
+    await page.get_by_role("button", name="Next").click()
+    await page.wait_for_url("https://myaccount.google.com/?pli=1", timeout=10000)
 
 
-def download_video(page, video: YoutubeUtils.Video):
-    try:
-        print(f"Navigating to video {video.id}...")
-        page.goto(f"https://studio.youtube.com/video/{video.id}/edit/", timeout=15000)
-        page.get_by_role("button", name="Options").wait_for(timeout=5000)
-        page.get_by_role("button", name="Options").click()
-        print(f"Opened video {video.id} options.")
-
-        page.get_by_role("menuitem", name="Download").wait_for(timeout=5000)
-        with page.expect_download(timeout=10000) as download_info:
-            page.get_by_role("menuitem", name="Download").click()
-            print(f"Began downloading video {video.id}...")
-
-        download = download_info.value
-        OUTPUT_DIR.mkdir(exist_ok=True)
-        file_path = OUTPUT_DIR / f"{video.title}.mp4"
-        download.save_as(file_path)
-
-        progress_controller.move_item(
-            ProgressState.DOWNLOADING, ProgressState.DOWNLOADED, video.id
-        )
-        print(f"Downloaded: {file_path}")
+def needs_login(page):
+    return page.url.startswith("https://accounts.google.com/")
 
-    except Exception as e:
-        print(f"Failed to download video {video.id}: {e}")
 
+async def save_session(context):
+    await context.storage_state(path=STORAGE_STATE_FILE)
+    STORAGE_STATE_FILE.chmod(0o600)
 
-if __name__ == "__main__":
-    ytlib = YoutubeUtils(
-        youtube_token=YOUTUBE_TOKEN,
-        youtube_refresh_token=YOUTUBE_REFRESH_TOKEN,
-        youtube_token_uri=YOUTUBE_TOKEN_URI,
-        youtube_client_id=YOUTUBE_CLIENT_ID,
-        youtube_client_secret=YOUTUBE_CLIENT_SECRET,
-    )
 
-    playlists = ytlib.get_playlists()
-    all_yt_videos = []
-    for playlist in playlists:
-        videos = ytlib.list_videos_in_playlist(playlist)
-        all_yt_videos.extend(videos)
+async def ensure_logged_in(page):
+    """
+    Logs in on `page` if Studio redirects it to the Google login. Pages
+    share one context, so a login on any page renews the session for all.
+    """
+    async with login_lock:
+        await page.goto("https://studio.youtube.com/", timeout=15000)
+        if needs_login(page):
+            print("Session expired, logging in...")
+            await login_google(page)
+            await save_session(page.context)
 
-    while True:
-        progress_controller.lock_file()
-        progress_log = progress_controller._load_progress_unlocked()
-        existing_video_ids = [
-            video_id
-            for status in progress_log.keys()
-            for video_id in progress_log[status].keys()
-        ]
-        video_ids_to_download = set(video.id for video in all_yt_videos) - set(
-            existing_video_ids
+
+async def open_session(browser):
+    """
+    Opens a browser context with the saved session, logging in (and saving
+    the new session) only if Google no longer accepts the saved one.
+    """
+    if STORAGE_STATE_FILE.exists():
+        context = await browser.new_context(
+            accept_downloads=True, storage_state=STORAGE_STATE_FILE
         )
-        videos_to_download = [
-            video for video in all_yt_videos if video.id in video_ids_to_download
-        ]
-        if len(videos_to_download) == 0:
-            print("No more videos to download.")
-            progress_controller.unlock_file()
-            exit(0)
-        next_video = videos_to_download[0]
-        progress_controller._add_item_unlocked(
+    else:
+        context = await browser.new_context(accept_downloads=True)
+
+    page = await context.new_page()
+    await ensure_logged_in(page)
+    await page.close()
+    return context
+
+
+async def download_video(page, video: YoutubeUtils.Video):
+    print(f"Navigating to video {video.id}...")
+    edit_url = f"https://studio.youtube.com/video/{video.id}/edit/"
+    await page.goto(edit_url, timeout=15000)
+    if needs_login(page):
+        # The session expired while we were running.
+        await ensure_logged_in(page)
+        await page.goto(edit_url, timeout=15000)
+
+    await page.get_by_role("button", name="Options").wait_for(timeout=5000)
+    await page.get_by_role("button", name="Options").click()
+    print(f"Opened video {video.id} options.")
+
+    await page.get_by_role("menuitem", name="Download").wait_for(timeout=5000)
+    async with page.expect_download(timeout=10000) as download_info:
+        await page.get_by_role("menuitem", name="Download").click()
+        print(f"Began downloading video {video.id}...")
+
+    download = await download_info.value
+    OUTPUT_DIR.mkdir(exist_ok=True)
+    file_path = OUTPUT_DIR / f"{video.id}.mp4"
+    await download.save_as(file_path)
+    return file_path
+
+
+async def download_with_retries(page, video: YoutubeUtils.Video, timeout, retries):
+    """
+    Returns whether `video` was downloaded, trying `retries` more times
+    after a failure or after `timeout` seconds without finishing.
+    """
+    for attempt in range(retries + 1):
+        started = time.monotonic()
+        try:
+            file_path = await asyncio.wait_for(download_video(page, video), timeout)
+        except Exception as e:
+            print(f"Failed to download video {video.id} (try {attempt + 1}): {e!r}")
+            metrics.count("download_failures")
+            await asyncio.sleep(2**attempt)
+            continue
+
+        print(f"Downloaded: {file_path}")
+        metrics.observe("download_seconds", time.monotonic() - started)
+        metrics.count("download_bytes", file_path.stat().st_size)
+        return True
+    return False
+
+
+def claim_next_video(ytlib, all_yt_videos, skipped_ids):
+    """
+    Adds the first video that is not in the progress log yet as
+    DOWNLOADING, leased to this worker, and returns it.
+    """
+    candidates = [video for video in all_yt_videos if video.id not in skipped_ids]
+    missing_ids = set(
+        progress_controller.missing_keys([video.id for video in candidates])
+    )
+    for next_video in candidates:
+        if next_video.id not in missing_ids:
+            continue
+        title = ytlib.video_title_from_id(next_video.id)
+        # Another downloader may have claimed it since; try the next one.
+        if progress_controller.claim_new_item(
             ProgressState.DOWNLOADING,
             next_video.id,
             ProgressController.ProgressItem(
-                original_video_name=ytlib.video_title_from_id(next_video.id),  # type: ignore
-                new_video_name=f"PROCESSED {ytlib.video_title_from_id(next_video.id)}",
+                original_video_name=title,  # type: ignore
+                new_video_name=f"PROCESSED {title}",
                 original_playlist_name=next_video.playlist.title,
                 new_playlist_name=f"PROCESSED {next_video.playlist.title}",
                 original_video_id=next_video.id,
                 original_playlist_id=next_video.playlist.id,
                 new_playlist_id=f"PROCESSED {next_video.playlist.id}",
             ),
+        ):
+            return next_video
+    return None
+
+
+async def download_worker(
+    page, ytlib, all_yt_videos, skipped_ids, timeout, retries, publish_url
+):
+    while True:
+        async with claim_lock:
+            next_video = await asyncio.to_thread(
+                claim_next_video, ytlib, all_yt_videos, skipped_ids
+            )
+        if next_video is None:
+            return
+
+        with progress_controller.keep_alive(next_video.id):
+            downloaded = await download_with_retries(page, next_video, timeout, retries)
+
+        # Record each result as soon as it is known.
+        if downloaded:
+            artifact = None
+            if publish_url:
+                artifact = await asyncio.to_thread(
+                    publish, OUTPUT_DIR / f"{next_video.id}.mp4", publish_url
+                )
+            await asyncio.to_thread(
+                progress_controller.move_item,
+                ProgressState.DOWNLOADING,
+                ProgressState.DOWNLOADED,
+                next_video.id,
+                artifact,
+            )
+        else:
+            # Hand it back to be picked up on a later run; repeated failures
+            # park it in FAILED.
+            skipped_ids.add(next_video.id)
+            await asyncio.to_thread(
+                progress_controller.release_item, next_video.id, count_attempt=True
+            )
+
+
+async def download_all(
+    ytlib, all_yt_videos, concurrency, timeout, retries, publish_url
+):
+    """
+    Downloads with `concurrency` pages of one logged-in headless browser.
+    """
+    skipped_ids = set()
+    async with async_playwright() as p:
+        browser = await p.chromium.launch(headless=HEADLESS)
+        context = await open_session(browser)
+        pages = [await context.new_page() for _ in range(concurrency)]
+
+        await asyncio.gather(
+            *(
+                download_worker(
+                    page,
+                    ytlib,
+                    all_yt_videos,
+                    skipped_ids,
+                    timeout,
+                    retries,
+                    publish_url,
+                )
+                for page in pages
+            )
         )
-        progress_controller.unlock_file()
 
-        with sync_playwright() as p:
-            browser = p.chromium.launch(headless=False)
-            context = browser.new_context(accept_downloads=True)
-            page = context.new_page()
+        await save_session(context)
+        await browser.close()
 
-            login_google(page)
 
-            download_video(page, next_video.id)
+def download_new_videos(ytlib, catalog, concurrency, timeout, retries, publish_url):
+    """
+    Brings the catalog up to date and downloads every video not in the
+    progress log yet.
+    """
+    catalog.sync()
+    all_yt_videos = catalog.videos()
+
+    # Look up the titles of everything left to download in a few batched
+    # requests, so claims are answered from the memo cache.
+    pending_ids = progress_controller.missing_keys(
+        [video.id for video in all_yt_videos]
+    )
+    if not pending_ids:
+        return
+    ytlib.lookup_titles(video_ids=pending_ids)
+
+    asyncio.run(
+        download_all(ytlib, all_yt_videos, concurrency, timeout, retries, publish_url)
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Download videos from Studio.")
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=CONCURRENCY,
+        help="videos to download at once",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=DOWNLOAD_TIMEOUT,
+        help="seconds before a single download is abandoned",
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=DOWNLOAD_RETRIES,
+        help="extra tries per video before it is handed back",
+    )
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="keep running and check the channel for new videos periodically",
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=CATALOG_INTERVAL,
+        help="seconds between checks for new videos with --daemon",
+    )
+    parser.add_argument(
+        "--coordinator",
+        help="URL of a progress_server.py to use instead of the local progress file",
+    )
+    parser.add_argument(
+        "--publish",
+        metavar="URL",
+        help="base URL of this machine's artifact_transfer.py, for stages elsewhere "
+        "to fetch its downloads from",
+    )
+    args = parser.parse_args()
+    metrics.configure("download", METRICS_DIR)
+    if args.coordinator:
+        progress_controller = open_progress(args.coordinator)
+
+    ytlib = YoutubeUtils(
+        youtube_token=YOUTUBE_TOKEN,
+        youtube_refresh_token=YOUTUBE_REFRESH_TOKEN,
+        youtube_token_uri=YOUTUBE_TOKEN_URI,
+        youtube_client_id=YOUTUBE_CLIENT_ID,
+        youtube_client_secret=YOUTUBE_CLIENT_SECRET,
+        quota_usage_file=QUOTA_USAGE_FILE,
+    )
 
-            browser.close()
+    # The catalog and the API client are kept across --daemon rounds, so
+    # an unchanged channel costs one conditional request per playlist.
+    catalog = CatalogIndex(ytlib, CATALOG_FILE)
+    while True:
+        download_new_videos(
+            ytlib,
+            catalog,
+            args.concurrency,
+            args.timeout,
+            args.retries,
+            args.publish,
+        )
+        print("No more videos to download.")
+        quota = ytlib.quota.metrics()
+        print(
+            f"Used {quota['used_units']} YouTube API units, "
+            f"{quota['remaining_units']} of {quota['daily_units']} left."
+        )
+        if not args.daemon:
+            break
+        time.sleep(args.interval)
@@ -0,0 +1,220 @@
+import json
+import math
+import subprocess
+
+import numpy as np
+
+
+class MotionDetector:
+    """
+    Native replacement for auto-editor's `motion` analysis.
+
+    ffmpeg decodes the video to small blurred grayscale frames on a pipe and
+    the frame differences are computed in NumPy, a batch of frames at a time.
+    As in auto-editor, a frame is moving when more than `threshold` of its
+    pixels changed since the previous analysed frame, and every moving frame
+    keeps `margin_seconds` of video on either side at normal speed.
+
+    `width` sets the analysis resolution and `stride` analyses only every
+    n-th frame, which is what makes long, mostly static streams cheap.
+    """
+
+    def __init__(
+        self,
+        fps=30,
+        speedup_factor=16,
+        threshold=0.2,
+        margin_seconds=5,
+        width=400,
+        stride=1,
+        blur=9,
+        batch_frames=256,
+        threads=None,
+    ):
+        self.fps = fps
+        self.speedup_factor = speedup_factor
+        self.threshold = threshold
+        self.margin_seconds = margin_seconds
+        self.width = width
+        self.stride = stride
+        self.blur = blur
+        self.batch_frames = batch_frames
+        self.threads = threads
+
+    def write_timeline(self, video_path, outpath):
+        """
+        Writes a v1 timeline in the format `auto-editor --export
+        timeline:api=1` produces.
+        """
+        timeline_data = {
+            "version": "1",
+            "source": str(video_path),
+            "chunks": self.detect_chunks(video_path),
+        }
+        with open(outpath, "w") as f:
+            json.dump(timeline_data, f, indent=4)
+
+    def detect_chunks(self, video_path) -> list[list[int]]:
+        motion = self.analyze(video_path)
+        samples = len(motion)
+        if samples == 0:
+            return []
+
+        active = motion > self.threshold
+
+        # Keep every sample within the margin of a moving one, using a
+        # sliding-window sum over the cumulative count of moving samples.
+        margin = math.ceil(self.margin_seconds * self.fps / self.stride)
+        moving_before = np.concatenate([[0], np.cumsum(active)])
+        index = np.arange(samples)
+        window = (
+            moving_before[np.minimum(samples, index + margin + 1)]
+            - moving_before[np.maximum(0, index - margin)]
+        )
+        kept = window > 0
+
+        boundaries = np.concatenate(
+            [[0], np.flatnonzero(np.diff(kept.astype(np.int8))) + 1, [samples]]
+        )
+        chunks = [
+            [
+                int(start * self.stride),
+                int(stop * self.stride),
+                1 if kept[start] else self.speedup_factor,
+            ]
+            for start, stop in zip(boundaries[:-1], boundaries[1:])
+        ]
+
+        # With a stride the last sample stands for up to `stride` frames,
+        # which can run past the end of the video.
+        if self.stride > 1:
+            frames = self._probe_frame_count(video_path, self.fps)
+            if frames is not None:
+                chunks[-1][1] = min(chunks[-1][1], frames)
+                if chunks[-1][1] <= chunks[-1][0]:
+                    chunks.pop()
+        return chunks
+
+    def analyze(self, video_path) -> np.ndarray:
+        """
+        Returns the fraction of changed pixels for every analysed frame.
+        """
+        source_width, source_height = self._probe_size(video_path)
+        height = max(2, round(self.width * source_height / source_width / 2) * 2)
+        frame_size = self.width * height
+
+        filters = []
+        if self.stride > 1:
+            filters.append(f"framestep={self.stride}")
+        filters.extend([f"scale={self.width}:{height}:flags=area", "format=gray"])
+        if self.blur:
+            filters.append(f"gblur=sigma={self.blur}")
+
+        command = ["ffmpeg", "-v", "error"]
+        if self.threads:
+            command.extend(["-threads", str(self.threads)])
+        command.extend(
+            [
+                "-i",
+                video_path,
+                "-an",
+                "-sn",
+                "-vf",
+                ",".join(filters),
+                "-f",
+                "rawvideo",
+                "-pix_fmt",
+                "gray",
+                "-",
+            ]
+        )
+        process = subprocess.Popen(command, stdout=subprocess.PIPE)
+
+        try:
+            motion = []
+            previous = None
+            while True:
+                data = process.stdout.read(frame_size * self.batch_frames)  # type: ignore
+                count = len(data) // frame_size
+                if count == 0:
+                    break
+
+                frames = np.frombuffer(data, np.uint8, count=count * frame_size)
+                frames = frames.reshape(count, frame_size)
+                if previous is None:
+                    # The first frame has nothing to be compared with.
+                    motion.append(np.zeros(1))
+                    compared = frames
+                else:
+                    compared = np.concatenate([previous[np.newaxis], frames])
+
+                changed = np.count_nonzero(compared[1:] != compared[:-1], axis=1)
+                motion.append(changed / frame_size)
+                previous = frames[-1]
+        except BaseException:
+            process.kill()
+            raise
+
+        process.stdout.close()  # type: ignore
+        process.wait()
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, process.args)
+
+        return np.concatenate(motion) if motion else np.zeros(0)
+
+    @staticmethod
+    def _probe_size(video_path):
+        result = subprocess.run(
+            [
+                "ffprobe",
+                "-v",
+                "error",
+                "-select_streams",
+                "v:0",
+                "-show_entries",
+                "stream=width,height",
+                "-of",
+                "csv=p=0",
+                video_path,
+            ],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        width, height = result.stdout.strip().split(",")[:2]
+        return int(width), int(height)
+
+    @staticmethod
+    def _probe_frame_count(video_path, fps):
+        """
+        Returns the video's frame count from its header, or its duration at
+        `fps` where the container has no count, or None if it has neither.
+        """
+        result = subprocess.run(
+            [
+                "ffprobe",
+                "-v",
+                "error",
+                "-select_streams",
+                "v:0",
+                "-show_entries",
+                "stream=nb_frames,duration:format=duration",
+                "-of",
+                "json",
+                video_path,
+            ],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        probe = json.loads(result.stdout)
+        stream = (probe.get("streams") or [{}])[0]
+        if stream.get("nb_frames", "N/A") != "N/A":
+            return int(stream["nb_frames"])
+        for duration in (
+            stream.get("duration"),
+            probe.get("format", {}).get("duration"),
+        ):
+            if duration not in (None, "N/A"):
+                return round(float(duration) * fps)
+        return None
@@ -0,0 +1,219 @@
+import atexit
+import functools
+import json
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from enum import Enum
+from pathlib import Path
+
+
+class PipelineMetrics:
+    """
+    Timings, counters and gauges shared by every stage of the pipeline.
+
+    Each observation is appended to a JSON-lines trace and folded into
+    per-name totals, which are written out in the Prometheus text format for
+    node_exporter's textfile collector. Nothing is written until `configure`
+    names the stage; both files are per process (`<stage>-<host>-<pid>`) so
+    concurrent workers never share one, and every sample is labelled with
+    the stage.
+
+    Once the trace passes `TRACE_MAX_BYTES` it is moved to `<name>.jsonl.1`,
+    replacing the previous one, so a long-running daemon keeps at most two.
+    """
+
+    PREFIX = "pipeline_"
+    FLUSH_SECONDS = 10
+    TRACE_MAX_BYTES = 64 * 1024 * 1024
+
+    def __init__(self):
+        self.stage = None
+        self.directory = None
+        self._summaries = {}
+        self._counters = {}
+        self._gauges = {}
+        self._lock = threading.Lock()
+        self._trace = None
+        self._pid = None
+        self._flushed = 0.0
+        atexit.register(self.flush)
+
+    def configure(self, stage, directory):
+        with self._lock:
+            self.stage = stage
+            self.directory = Path(directory)
+            self._open_unlocked()
+
+    @contextmanager
+    def span(self, name, **labels):
+        """
+        Times the `with` block as `<name>_seconds`, whether or not it raises.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(f"{name}_seconds", time.perf_counter() - start, **labels)
+
+    def timed(self, name):
+        """
+        Decorator form of `span`.
+        """
+
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return function(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def observe(self, name, value, **labels):
+        with self._lock:
+            key = self._key(name, labels)
+            count, total = self._summaries.get(key, (0, 0.0))
+            self._summaries[key] = (count + 1, total + value)
+            self._record_unlocked("observe", name, value, labels)
+
+    def count(self, name, amount=1, **labels):
+        with self._lock:
+            key = self._key(name, labels)
+            self._counters[key] = self._counters.get(key, 0) + amount
+            self._record_unlocked("count", name, amount, labels)
+
+    def gauge(self, name, value, **labels):
+        with self._lock:
+            self._gauges[self._key(name, labels)] = value
+            self._record_unlocked("gauge", name, value, labels)
+
+    def flush(self):
+        with self._lock:
+            self._flush_unlocked()
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(
+            sorted(
+                (k, v.value if isinstance(v, Enum) else str(v))
+                for k, v in labels.items()
+            )
+        )
+
+    def _open_unlocked(self):
+        if self._trace is not None:
+            self._trace.close()
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._pid = os.getpid()
+        self._trace = open(self._path_unlocked(".jsonl"), "a")
+
+    def _path_unlocked(self, suffix):
+        name = f"{self.stage}-{socket.gethostname()}-{self._pid}{suffix}"
+        return self.directory / name
+
+    def _record_unlocked(self, kind, name, value, labels):
+        if self.stage is None:
+            return
+        if self._pid != os.getpid():
+            # A forked worker starts its own files, and its own totals.
+            self._summaries, self._counters, self._gauges = {}, {}, {}
+            self._open_unlocked()
+
+        event = {"time": time.time(), "kind": kind, "name": name, "value": value}
+        event.update(self._key(name, labels)[1])
+        self._trace.write(json.dumps(event) + "\n")
+
+        if time.monotonic() - self._flushed >= self.FLUSH_SECONDS:
+            self._flush_unlocked()
+
+    def _flush_unlocked(self):
+        if self.stage is None or self._pid != os.getpid():
+            return
+        self._trace.flush()
+        self._flushed = time.monotonic()
+        if self._trace.tell() >= self.TRACE_MAX_BYTES:
+            self._trace.close()
+            path = self._path_unlocked(".jsonl")
+            os.replace(path, path.with_suffix(".jsonl.1"))
+            self._trace = open(path, "a")
+
+        lines = []
+        for values, kind in (
+            (self._summaries, "summary"),
+            (self._counters, "counter"),
+            (self._gauges, "gauge"),
+        ):
+            for name in sorted(set(name for name, _ in values)):
+                full_name = self.PREFIX + name
+                if kind == "counter":
+                    full_name += "_total"
+                lines.append(f"# TYPE {full_name} {kind}")
+                for (metric_name, labels), value in sorted(values.items()):
+                    if metric_name != name:
+                        continue
+                    label_text = self._labels(labels)
+                    if kind == "summary":
+                        count, total = value
+                        lines.append(f"{full_name}_count{label_text} {count}")
+                        lines.append(f"{full_name}_sum{label_text} {total}")
+                    else:
+                        lines.append(f"{full_name}{label_text} {value}")
+
+        path = self._path_unlocked(".prom")
+        tmp_path = path.with_suffix(".prom.tmp")
+        with open(tmp_path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, path)
+
+    def _labels(self, labels):
+        pairs = [("stage", self.stage), *labels]
+        return "{" + ",".join(f'{k}="{self._escape(v)}"' for k, v in pairs) + "}"
+
+    @staticmethod
+    def _escape(value):
+        return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+# One instance per process, configured by the stage's entry point.
+metrics = PipelineMetrics()
+
+
+class TimedLock:
+    """
+    Wraps a reentrant lock (e.g. a `FileLock`) to record how long callers
+    wait for it and how long they hold it, as `<name>_wait_seconds` and
+    `<name>_hold_seconds`. Only the outermost acquisition is timed.
+    """
+
+    def __init__(self, lock, name):
+        self.lock = lock
+        self.name = name
+        self._local = threading.local()
+
+    def acquire(self):
+        depth = getattr(self._local, "depth", 0)
+        start = time.perf_counter()
+        self.lock.acquire()
+        self._local.depth = depth + 1
+        if depth == 0:
+            self._local.acquired = time.perf_counter()
+            metrics.observe(f"{self.name}_wait_seconds", self._local.acquired - start)
+
+    def release(self):
+        self._local.depth -= 1
+        if self._local.depth == 0:
+            metrics.observe(
+                f"{self.name}_hold_seconds", time.perf_counter() - self._local.acquired
+            )
+        self.lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
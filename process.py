@@ -1,39 +1,282 @@
-import json
-from filelock import FileLock
+import argparse
+import dataclasses
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import time
+from multiprocessing.connection import wait
 from pathlib import Path
 
-import yaml
-
-from progresslib import ProgressController, ProgressState
+from artifact_transfer import ArtifactFetcher, publish
+from pipeline_metrics import metrics
+from progress_client import open_progress
+from progresslib import ProgressState
 from video_processor import VideoProcessor
 
+PROGRESS_FILE = Path(__file__).parent / "progress.json"
+DOWNLOAD_DIR = Path(__file__).parent / "downloaded_videos"
+PROCESSING_DIR = Path(__file__).parent / "processing_videos"
+PROCESSED_DIR = Path(__file__).parent / "processed_videos"
+METRICS_DIR = Path(__file__).parent / "metrics"
+# A worker that keeps crashing is restarted after 1, 2, 4... seconds, and
+# given up on after MAX_CRASHES crashes in a row. One that ran for
+# HEALTHY_SECONDS first starts counting again.
+MAX_CRASHES = 5
+MAX_RESTART_DELAY = 60
+HEALTHY_SECONDS = 5 * 60
 
-if __name__ == "__main__":
-    PROGRESS_FILE = Path(__file__).parent / "progress.json"
-    DOWNLOAD_DIR = Path(__file__).parent / "downloaded_videos"
-    PROCESSING_DIR = Path(__file__).parent / "processing_videos"
-    PROCESSED_DIR = Path(__file__).parent / "processed_videos"
 
-    progress_controller = ProgressController(PROGRESS_FILE)
+def process_worker(
+    slot,
+    supervisor_pid,
+    encoder_settings,
+    render_mode,
+    stop_event,
+    daemon,
+    progress_store,
+    publish_url,
+):
+    # Each worker leads its own session, together with the segment pool and
+    # ffmpeg processes it starts. A terminal Ctrl+C then only reaches the
+    # supervisor, which stops a worker by signalling its whole group.
+    os.setsid()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+    metrics.configure("process", METRICS_DIR)
+
+    # Workers keep their slot's id across restarts, so a replacement can
+    # hand back whatever a crashed predecessor had claimed. The supervisor's
+    # pid keeps two supervisors on one host from taking each other's claims.
+    progress_controller = open_progress(
+        progress_store,
+        worker_id=f"{socket.gethostname()}:process:{supervisor_pid}:{slot}",
+    )
+    for video_id in progress_controller.abandon_leases():
+        print(f"Worker {slot}: returned {video_id} left over by a crashed worker.")
 
-    while True:
-        # Acquire lock to safely read and update progress file
+    while not stop_event.is_set():
         next_item = progress_controller.read_and_move_next_item(
             ProgressState.DOWNLOADED, ProgressState.PROCESSING
         )
 
         if not next_item:
-            print("No more items to process.")
-            exit(0)
+            if not daemon:
+                print(f"Worker {slot}: no more items to process.")
+                return
+            progress_controller.wait_for_items(
+                ProgressState.DOWNLOADED, stop_event=stop_event
+            )
+            continue
 
         video_id, video_properties = next_item
+        input_path = DOWNLOAD_DIR / f"{video_properties.original_video_id}.mp4"
+        output_path = PROCESSED_DIR / f"{video_properties.original_video_id}.mp4"
 
-        # Process the video
-        VideoProcessor.process(
-            DOWNLOAD_DIR / video_properties.original_video_id,
-            PROCESSED_DIR / video_properties.new_video_name,
-        )
+        # Process the video, keeping our claim on it alive meanwhile
+        try:
+            with progress_controller.keep_alive(video_id):
+                # Downloaded on another machine: fetch and verify it first.
+                if video_properties.artifact is not None:
+                    try:
+                        ArtifactFetcher().fetch(video_properties.artifact, input_path)
+                    except ArtifactFetcher.ERRORS as e:
+                        print(f"Worker {slot}: could not fetch {video_id}: {e}")
+                        ArtifactFetcher.discard(input_path)
+                        progress_controller.release_item(video_id, count_attempt=True)
+                        continue
+                VideoProcessor.process(
+                    input_path,
+                    output_path,
+                    render_mode=render_mode,
+                    encoder_settings=encoder_settings,
+                )
+                artifact = publish(output_path, publish_url) if publish_url else None
+        except BaseException as e:
+            # A shutdown surfaces as SystemExit, or as whatever failed first
+            # when ffmpeg or the pool was signalled along with us. Either way
+            # the item goes back without counting an attempt.
+            if stop_event.is_set() or isinstance(e, SystemExit):
+                signal.signal(signal.SIGTERM, signal.SIG_IGN)
+                print(f"Worker {slot}: shutting down, releasing {video_id}.")
+                progress_controller.release_item(video_id)
+            raise
 
         progress_controller.move_item(
-            ProgressState.PROCESSING, ProgressState.PROCESSED, video_id
+            ProgressState.PROCESSING, ProgressState.PROCESSED, video_id, artifact
         )
+
+
+def supervise(
+    jobs,
+    encoder_settings,
+    daemon=False,
+    progress_store=PROGRESS_FILE,
+    publish_url=None,
+    render_mode=None,
+):
+    """
+    Keeps `jobs` workers running until the DOWNLOADED queue is drained (or,
+    with `daemon`, until stopped), restarting any that crash with a backoff.
+    Each renders with `encoder_settings` and `render_mode`
+    (`VideoProcessor.RENDER_MODE` if None).
+    SIGINT/SIGTERM stops the workers, which hand their current item back to
+    DOWNLOADED before exiting. Returns False if a worker crashed
+    `MAX_CRASHES` times in a row, after stopping the others.
+    """
+    stop_event = multiprocessing.Event()
+    supervisor_pid = os.getpid()
+    started = {}
+    crashes = {slot: 0 for slot in range(jobs)}
+    restarts = {}
+
+    def start(slot):
+        worker = multiprocessing.Process(
+            target=process_worker,
+            args=(
+                slot,
+                supervisor_pid,
+                encoder_settings,
+                render_mode,
+                stop_event,
+                daemon,
+                progress_store,
+                publish_url,
+            ),
+        )
+        worker.start()
+        started[slot] = time.monotonic()
+        return worker
+
+    workers = {slot: start(slot) for slot in range(jobs)}
+
+    def shutdown(signum, frame):
+        print("Shutting down workers...")
+        stop_event.set()
+        for worker in workers.values():
+            try:
+                os.killpg(worker.pid, signal.SIGTERM)
+            except ProcessLookupError:
+                # Not in its own group yet.
+                worker.terminate()
+
+    signal.signal(signal.SIGINT, shutdown)
+    signal.signal(signal.SIGTERM, shutdown)
+
+    failed = False
+    while workers or restarts:
+        timeout = None
+        if restarts:
+            timeout = max(0, min(restarts.values()) - time.monotonic())
+        wait([worker.sentinel for worker in workers.values()], timeout)
+
+        now = time.monotonic()
+        for slot, worker in list(workers.items()):
+            if worker.is_alive():
+                continue
+            del workers[slot]
+            if worker.exitcode == 0 or stop_event.is_set():
+                continue
+            if now - started[slot] >= HEALTHY_SECONDS:
+                crashes[slot] = 0
+            crashes[slot] += 1
+            if crashes[slot] >= MAX_CRASHES:
+                print(
+                    f"Worker {slot} crashed {crashes[slot]} times in a row, giving up."
+                )
+                failed = True
+                shutdown(None, None)
+                continue
+            delay = min(2 ** (crashes[slot] - 1), MAX_RESTART_DELAY)
+            print(
+                f"Worker {slot} exited with {worker.exitcode}, "
+                f"restarting in {delay}s."
+            )
+            restarts[slot] = now + delay
+
+        if stop_event.is_set():
+            restarts.clear()
+        for slot, restart_at in list(restarts.items()):
+            if restart_at <= now:
+                del restarts[slot]
+                workers[slot] = start(slot)
+
+    return not failed
+
+
+if __name__ == "__main__":
+    if hasattr(os, "sched_getaffinity"):
+        cpus = len(os.sched_getaffinity(0))
+    else:
+        cpus = os.cpu_count() or 1
+
+    parser = argparse.ArgumentParser(description="Process downloaded videos.")
+    parser.add_argument(
+        "--jobs", type=int, default=1, help="videos to process concurrently"
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        help="ffmpeg threads per job (default: available CPUs / jobs)",
+    )
+    parser.add_argument(
+        "--codec",
+        choices=sorted(VideoProcessor.ENCODER_PREFERENCE),
+        help=f"output codec (default: {VideoProcessor.ENCODER_SETTINGS.codec})",
+    )
+    parser.add_argument(
+        "--encoder",
+        help="ffmpeg encoder to use instead of the first working one for the codec",
+    )
+    parser.add_argument("--preset", help="encoder preset")
+    parser.add_argument(
+        "--quality",
+        type=int,
+        help="constant-quality level (CRF for x264/x265, CQ for NVENC)",
+    )
+    parser.add_argument(
+        "--render-mode",
+        choices=["single_pass", "segmented", "smart", "two_pass"],
+        help=f"how to render each video (default: {VideoProcessor.RENDER_MODE})",
+    )
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="keep running and wait for new downloads instead of exiting",
+    )
+    parser.add_argument(
+        "--coordinator",
+        help="URL of a progress_server.py to use instead of the local progress file",
+    )
+    parser.add_argument(
+        "--publish",
+        metavar="URL",
+        help="base URL of this machine's artifact_transfer.py, for stages elsewhere "
+        "to fetch its processed videos from",
+    )
+    args = parser.parse_args()
+
+    threads = args.threads or max(1, cpus // args.jobs)
+    print(f"Processing with {args.jobs} job(s) of {threads} thread(s) each.")
+
+    # Options left unset keep the VideoProcessor.ENCODER_SETTINGS default.
+    overrides = {
+        name: getattr(args, name)
+        for name in ("codec", "encoder", "preset", "quality")
+        if getattr(args, name) is not None
+    }
+    encoder_settings = dataclasses.replace(
+        VideoProcessor.ENCODER_SETTINGS, threads=threads, **overrides
+    )
+
+    if not supervise(
+        args.jobs,
+        encoder_settings,
+        args.daemon,
+        args.coordinator or PROGRESS_FILE,
+        args.publish,
+        args.render_mode,
+    ):
+        exit(1)
+    print("No more items to process.")
+    exit(0)
@@ -0,0 +1,130 @@
+import threading
+
+from yt_utils import YoutubeUtils
+
+
+class ProcessingTracker:
+    """
+    Waits on a background thread for YouTube to finish processing uploaded
+    videos, so the uploader can start on the next file as soon as the bytes
+    of the last one are sent.
+
+    Every pending video is polled at once, 50 ids per `videos.list` call.
+    Polls follow YouTube's estimate of the processing time left, kept within
+    `min_interval` and `max_interval` seconds; without an estimate the
+    interval doubles for as long as nothing finishes.
+
+    `on_ready(video_id)` or `on_failed(video_id, reason)` is called on the
+    tracker's thread once a video's processing is over.
+    """
+
+    MIN_INTERVAL = 5
+    MAX_INTERVAL = 60
+    FAILED_STATUSES = ("failed", "terminated")
+    # Polls a video may be missing from `videos.list` before it is taken to
+    # be deleted; a fresh upload can take a moment to show up.
+    MAX_MISSES = 3
+
+    def __init__(
+        self, ytlib: YoutubeUtils, min_interval=MIN_INTERVAL, max_interval=MAX_INTERVAL
+    ):
+        self.ytlib = ytlib
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self._pending = {}
+        self._misses = {}
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def track(self, video_id, on_ready, on_failed):
+        with self._condition:
+            self._pending[video_id] = (on_ready, on_failed)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._condition.notify_all()
+
+    def pending(self) -> int:
+        with self._condition:
+            return len(self._pending)
+
+    def join(self):
+        """
+        Blocks until every tracked video has been handed to its callback.
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: not self._pending)
+
+    def _run(self):
+        interval = self.min_interval
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._pending)
+                pending = dict(self._pending)
+
+            try:
+                details = self.ytlib.processing_details(pending)
+            except Exception as e:
+                print(f"Failed to poll processing status: {e!r}")
+                details = None
+
+            finished = 0
+            time_left = []
+            for video_id, (on_ready, on_failed) in pending.items():
+                if details is None:
+                    break
+                outcome, seconds_left = self._outcome(video_id, details.get(video_id))
+                if outcome is None:
+                    if seconds_left is not None:
+                        time_left.append(seconds_left)
+                    continue
+
+                try:
+                    if outcome == "succeeded":
+                        on_ready(video_id)
+                    else:
+                        print(f"Processing of {video_id} {outcome}.")
+                        on_failed(video_id, outcome)
+                except Exception as e:
+                    print(f"Failed to finish {video_id}: {e!r}")
+                finished += 1
+                self._misses.pop(video_id, None)
+                with self._condition:
+                    del self._pending[video_id]
+                    self._condition.notify_all()
+
+            if time_left:
+                interval = min(time_left)
+            elif finished:
+                interval = self.min_interval
+            else:
+                interval *= 2
+            interval = max(self.min_interval, min(interval, self.max_interval))
+
+            with self._condition:
+                # A newly tracked video wakes us early.
+                self._condition.wait(interval)
+
+    def _outcome(self, video_id, video):
+        """
+        Returns ("succeeded" or a failure, None) once processing is over,
+        otherwise (None, estimated seconds left or None).
+        """
+        if video is None:
+            self._misses[video_id] = self._misses.get(video_id, 0) + 1
+            if self._misses[video_id] < self.MAX_MISSES:
+                return None, None
+            return "deleted", None
+        self._misses.pop(video_id, None)
+
+        upload_status = video.get("status", {}).get("uploadStatus")
+        if upload_status in ("failed", "rejected", "deleted"):
+            return upload_status, None
+
+        processing = video.get("processingDetails", {})
+        status = processing.get("processingStatus")
+        if status == "succeeded" or status in self.FAILED_STATUSES:
+            return status, None
+
+        time_left_ms = processing.get("processingProgress", {}).get("timeLeftMs")
+        return None, int(time_left_ms) / 1000 if time_left_ms else None
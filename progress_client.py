@@ -0,0 +1,191 @@
+import json
+import os
+import socket
+import threading
+import time
+
+import requests
+
+from pipeline_metrics import metrics
+from progresslib import (
+    LeaseLostError,
+    ProgressController,
+    ProgressState,
+    keep_lease_alive,
+)
+
+
+class RemoteProgressController:
+    """
+    `ProgressController` backend that talks to a `progress_server.py`
+    coordinator instead of sharing the progress files.
+
+    It has the same methods, except the file-lock ones (`lock`,
+    `lock_file`, `unlock_file`), and raises the same `KeyError` and
+    `LeaseLostError`. Each thread keeps its own `requests.Session`, so
+    calls reuse a kept-alive connection and the object can be shared
+    between threads.
+    """
+
+    TIMEOUT = 30
+    ERRORS = {"KeyError": KeyError, "LeaseLostError": LeaseLostError}
+
+    def __init__(
+        self,
+        url,
+        worker_id=None,
+        lease_seconds=ProgressController.LEASE_SECONDS,
+        max_attempts=ProgressController.MAX_ATTEMPTS,
+        timeout=TIMEOUT,
+    ):
+        self.url = url.rstrip("/")
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def reset_progress(self):
+        self._call("reset_progress")
+
+    def compact(self):
+        self._call("compact")
+
+    def load_progress(self) -> dict[str, dict[str, ProgressController.ProgressItem]]:
+        progress_data = self._call("load_progress")
+        return {ProgressState(state): items for state, items in progress_data.items()}
+
+    def contains(self, key: str) -> bool:
+        return self._call("contains", key=key)
+
+    def missing_keys(self, keys) -> list[str]:
+        return self._call("missing_keys", keys=list(keys))
+
+    def move_item(
+        self,
+        original_state: ProgressState,
+        new_state: ProgressState,
+        key: str,
+        artifact: dict | None = None,
+    ):
+        self._call(
+            "move_item",
+            original_state=original_state,
+            new_state=new_state,
+            key=key,
+            artifact=artifact,
+        )
+
+    def read_and_move_next_item(
+        self, original_state: ProgressState, new_state: ProgressState
+    ) -> tuple[str, ProgressController.ProgressItem] | None:
+        next_item = self._call(
+            "read_and_move_next_item",
+            original_state=original_state,
+            new_state=new_state,
+        )
+        return tuple(next_item) if next_item is not None else None
+
+    def add_item(
+        self, state: ProgressState, key: str, value: ProgressController.ProgressItem
+    ):
+        self._call("add_item", state=state, key=key, value=value)
+
+    def claim_new_item(
+        self, state: ProgressState, key: str, value: ProgressController.ProgressItem
+    ) -> bool:
+        return self._call("claim_new_item", state=state, key=key, value=value)
+
+    def heartbeat(self, key: str):
+        self._call("heartbeat", key=key)
+
+    def keep_alive(self, key: str, interval=None):
+        # Each thread has its own session, so the heartbeat can share self.
+        if interval is None:
+            interval = self.lease_seconds / 3
+        return keep_lease_alive(self, key, interval)
+
+    def save_checkpoint(self, key: str, checkpoint: dict):
+        self._call("save_checkpoint", key=key, checkpoint=checkpoint)
+
+    def checkpoint(self, key: str) -> dict | None:
+        return self._call("checkpoint", key=key)
+
+    def release_item(self, key: str, count_attempt=False):
+        self._call("release_item", key=key, count_attempt=count_attempt)
+
+    def reclaim_expired(self) -> list[str]:
+        return self._call("reclaim_expired")
+
+    def abandon_leases(self) -> list[str]:
+        return self._call("abandon_leases")
+
+    def wait_for_items(
+        self,
+        state: ProgressState,
+        timeout=None,
+        stop_event=None,
+        poll_seconds=ProgressController.POLL_SECONDS,
+    ) -> bool:
+        """
+        Long-polls the coordinator, which answers as soon as `state` has an
+        item to claim; `stop_event` is checked every `poll_seconds`.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while stop_event is None or not stop_event.is_set():
+            wait = poll_seconds
+            if deadline is not None:
+                wait = min(wait, deadline - time.monotonic())
+                if wait <= 0:
+                    return False
+            if self._call("wait_for_items", state=state, timeout=wait):
+                return True
+        return False
+
+    def _call(self, operation, **args):
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = requests.Session()
+
+        body = {
+            "worker": {
+                "worker_id": self.worker_id,
+                "lease_seconds": self.lease_seconds,
+                "max_attempts": self.max_attempts,
+            },
+            "args": args,
+        }
+        timeout = self.timeout
+        if operation == "wait_for_items":
+            timeout += args["timeout"]
+
+        with metrics.span("progress_request", op=operation):
+            response = session.post(
+                f"{self.url}/{operation}",
+                data=json.dumps(body, cls=ProgressController.CustomEncoder),
+                headers={"Content-Type": "application/json"},
+                timeout=timeout,
+            )
+        # A proxy or a crashed coordinator may answer with something else.
+        if not response.headers.get("Content-Type", "").startswith("application/json"):
+            response.raise_for_status()
+            raise requests.HTTPError(
+                f"{operation}: unexpected {response.headers.get('Content-Type')} "
+                f"reply from {self.url}",
+                response=response,
+            )
+        reply = json.loads(response.text, object_hook=ProgressController.custom_decoder)
+        if "error" in reply:
+            raise self.ERRORS.get(reply["error"], RuntimeError)(reply["message"])
+        response.raise_for_status()
+        return reply["result"]
+
+
+def open_progress(location, **kwargs):
+    """
+    A `RemoteProgressController` for an http(s) URL of a coordinator, or a
+    `ProgressController` for the path of a progress file.
+    """
+    if str(location).startswith(("http://", "https://")):
+        return RemoteProgressController(str(location), **kwargs)
+    return ProgressController(location, **kwargs)
@@ -0,0 +1,159 @@
+"""
+Coordinator that owns the progress store, for machines without a shared
+filesystem. Stages reach it with `--coordinator http://<host>:<port>`.
+
+    python progress_server.py --host 0.0.0.0 --port 8765
+"""
+
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from pipeline_metrics import metrics
+from progresslib import LeaseLostError, ProgressController
+
+PROGRESS_FILE = Path(__file__).parent / "progress.json"
+METRICS_DIR = Path(__file__).parent / "metrics"
+HOST = "127.0.0.1"
+PORT = 8765
+
+
+class ProgressServer(ThreadingHTTPServer):
+    """
+    Serves one `ProgressController` over HTTP/1.1, so each operation is a
+    single small request on a kept-alive connection rather than a file lock
+    and journal read over NFS.
+
+    Every operation is `POST /<method>` with a JSON body of
+    `{"worker": {...}, "args": {...}}`; `worker` carries the caller's
+    `worker_id`, `lease_seconds` and `max_attempts`, since leases belong to
+    the calling worker rather than to the server. Operations run one at a
+    time, so each is as atomic as its file-backed counterpart.
+    `wait_for_items` is a long poll that returns as soon as another
+    operation makes an item claimable, or after `LONG_POLL_SECONDS`.
+    """
+
+    OPERATIONS = (
+        "reset_progress",
+        "compact",
+        "load_progress",
+        "contains",
+        "missing_keys",
+        "move_item",
+        "read_and_move_next_item",
+        "add_item",
+        "claim_new_item",
+        "heartbeat",
+        "save_checkpoint",
+        "checkpoint",
+        "release_item",
+        "reclaim_expired",
+        "abandon_leases",
+        "wait_for_items",
+    )
+    LONG_POLL_SECONDS = 30
+    daemon_threads = True
+
+    def __init__(self, progress_file, address):
+        super().__init__(address, ProgressRequestHandler)
+        self.controller = ProgressController(progress_file)
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+
+    def call(self, operation, worker, args):
+        if operation == "wait_for_items":
+            return self._wait_for_items(**args)
+
+        with self.lock:
+            self.controller.worker_id = worker["worker_id"]
+            self.controller.lease_seconds = worker["lease_seconds"]
+            self.controller.max_attempts = worker["max_attempts"]
+            result = getattr(self.controller, operation)(**args)
+            self.changed.notify_all()
+        return result
+
+    def _wait_for_items(self, state, timeout=None):
+        timeout = min(timeout or self.LONG_POLL_SECONDS, self.LONG_POLL_SECONDS)
+        deadline = time.monotonic() + timeout
+        with self.changed:
+            while True:
+                # Re-read the files as well, in case anything else wrote them.
+                with self.controller.lock:
+                    self.controller._refresh_unlocked()
+                    ready, expires = self.controller._claimable_unlocked(state)
+                if ready:
+                    return True
+
+                wait = min(deadline - time.monotonic(), ProgressController.POLL_SECONDS)
+                if expires is not None:
+                    wait = min(wait, expires - time.time())
+                if deadline <= time.monotonic():
+                    return False
+                self.changed.wait(max(wait, 0))
+
+
+class ProgressRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately; without TCP_NODELAY the
+    # body waits out the client's delayed ACK (~40 ms) on every call.
+    disable_nagle_algorithm = True
+    ERROR_STATUSES = {KeyError: 404, LeaseLostError: 409}
+
+    def do_POST(self):
+        operation = self.path.strip("/")
+        if operation not in self.server.OPERATIONS:
+            self._reply(404, {"error": "ValueError", "message": operation})
+            return
+
+        length = int(self.headers["Content-Length"])
+        body = json.loads(
+            self.rfile.read(length), object_hook=ProgressController.custom_decoder
+        )
+        try:
+            with metrics.span("coordinator_request", op=operation):
+                result = self.server.call(operation, body["worker"], body["args"])
+        except (KeyError, LeaseLostError) as e:
+            self._reply(
+                self.ERROR_STATUSES[type(e)],
+                {"error": type(e).__name__, "message": e.args[0] if e.args else ""},
+            )
+        except Exception as e:
+            print(f"{operation} failed: {e!r}")
+            self._reply(500, {"error": type(e).__name__, "message": str(e)})
+        else:
+            self._reply(200, {"result": result})
+
+    def _reply(self, status, body):
+        data = json.dumps(body, cls=ProgressController.CustomEncoder).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # A line per request would drown everything else.
+        pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--progress-file", type=Path, default=PROGRESS_FILE)
+    args = parser.parse_args()
+    metrics.configure("coordinator", METRICS_DIR)
+
+    server = ProgressServer(args.progress_file, (args.host, args.port))
+    print(f"Serving {args.progress_file} on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,100 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import sys
+import time
+from pathlib import Path
+
+
+class ProgressWatcher:
+    """
+    Waits for any of a few files in one directory to change.
+
+    On Linux the directory is watched with inotify, so a write by another
+    process on this machine wakes the waiter straight away. Writes made by
+    other machines on a network filesystem raise no local events, so the
+    files are also compared by `stat` every `poll_interval` seconds; where
+    inotify is not available that polling is all there is.
+    """
+
+    POLL_INTERVAL = 5
+    # IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    INOTIFY_MASK = 0x002 | 0x008 | 0x080 | 0x100 | 0x200
+
+    def __init__(self, paths, poll_interval=POLL_INTERVAL):
+        self.paths = [Path(path) for path in paths]
+        self.poll_interval = poll_interval
+        self._identities = self._stat()
+        # Events are queued from here on, so nothing written between the
+        # caller's last look and its next `wait` is missed.
+        self._fd = self._open_inotify(self.paths[0].parent)
+
+    @property
+    def uses_notifications(self):
+        return self._fd is not None
+
+    def wait(self, timeout=None) -> bool:
+        """
+        Blocks until one of the files changes or `timeout` seconds pass, and
+        returns whether a change was seen.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            interval = self.poll_interval
+            if deadline is not None:
+                interval = min(interval, deadline - time.monotonic())
+            if interval > 0:
+                if self._fd is not None:
+                    readable, _, _ = select.select([self._fd], [], [], interval)
+                    if readable:
+                        self._read_events()
+                else:
+                    time.sleep(interval)
+
+            identities = self._stat()
+            if identities != self._identities:
+                self._identities = identities
+                return True
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _stat(self):
+        identities = []
+        for path in self.paths:
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                identities.append(None)
+            else:
+                identities.append((stat.st_ino, stat.st_mtime_ns, stat.st_size))
+        return identities
+
+    def _read_events(self):
+        # Drain the queue; whether a watched file changed is settled by
+        # `_stat`, since the directory also holds the lock and temp files.
+        try:
+            while os.read(self._fd, 64 * 1024):
+                pass
+        except BlockingIOError:
+            pass
+
+    def _open_inotify(self, directory):
+        if not sys.platform.startswith("linux"):
+            return None
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError):
+            return None
+        if fd < 0:
+            return None
+        if libc.inotify_add_watch(fd, os.fsencode(directory), self.INOTIFY_MASK) < 0:
+            os.close(fd)
+            return None
+        return fd
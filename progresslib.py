@@ -1,7 +1,16 @@
 import json
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
 from filelock import FileLock
 from enum import Enum
-from dataclasses import dataclass
+from dataclasses import dataclass, replace
+from pathlib import Path
+
+from pipeline_metrics import TimedLock, metrics
+from progress_watcher import ProgressWatcher
 
 
 class ProgressState(str, Enum):
@@ -11,12 +20,99 @@ class ProgressState(str, Enum):
     PROCESSED = "processed"
     UPLOADING = "uploading"
     UPLOADED = "uploaded"
+    FAILED = "failed"
+
+
+class LeaseLostError(RuntimeError):
+    pass
+
+
+@contextmanager
+def keep_lease_alive(controller, key: str, interval: float):
+    """
+    Call `controller.heartbeat(key)` every `interval` seconds from a
+    background thread for the duration of the `with` block. Only a lost
+    lease stops it; other errors, e.g. a briefly unreachable file server or
+    coordinator, are logged and the next beat tried as usual.
+    """
+    stop = threading.Event()
+
+    def beat():
+        while not stop.wait(interval):
+            try:
+                controller.heartbeat(key)
+            except LeaseLostError as e:
+                print(f"Stopped heartbeat: {e}")
+                return
+            except Exception as e:
+                print(f"Heartbeat for {key} failed, retrying: {e!r}")
+
+    thread = threading.Thread(target=beat, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
 
 
 class ProgressController:
-    def __init__(self, progress_file_path):
-        self.progress_file_path = progress_file_path
-        self.lock = FileLock(progress_file_path.with_suffix(".lock"))
+    """
+    Progress store shared by the download, process and upload stages.
+
+    `progress.json` is a snapshot in the original export format. Every
+    transition is appended as a single record to a journal next to it
+    (`progress.journal`), and each controller keeps the state in memory,
+    replaying only the journal bytes it has not seen yet. Once the journal
+    holds at least `compact_every` records and `compact_ratio` times the
+    snapshot's size in bytes, it is folded back into the snapshot. Since the
+    threshold grows with the snapshot, rewriting it (and every other
+    controller re-reading it) costs about the same per transition however
+    many items there are.
+
+    The journal starts with a header naming the snapshot it applies to, so a
+    journal left behind by an interrupted compaction, or a hand-edited
+    `progress.json`, is never replayed on top of the wrong snapshot.
+
+    Items claimed with `read_and_move_next_item` are leased to `worker_id`
+    for `lease_seconds`. The worker extends the lease with `heartbeat` (or
+    `keep_alive`) while it works on the item; once a lease expires the item
+    is returned to the state it was claimed from, and after `max_attempts`
+    expired leases it is parked in `ProgressState.FAILED` instead. Lease
+    expiries are wall-clock times, so machines sharing a progress file need
+    reasonably synchronized clocks.
+
+    A worker can also `save_checkpoint` on an item it holds, e.g. how far an
+    upload got. Checkpoints survive expired and released leases, so the next
+    worker to claim the item can pick up where the last one stopped, and are
+    dropped once the item is moved on.
+    """
+
+    COMPACT_EVERY = 1000
+    COMPACT_RATIO = 1.0
+    LEASE_SECONDS = 300
+    MAX_ATTEMPTS = 3
+    POLL_SECONDS = 5
+
+    def __init__(
+        self,
+        progress_file_path,
+        compact_every=COMPACT_EVERY,
+        worker_id=None,
+        lease_seconds=LEASE_SECONDS,
+        max_attempts=MAX_ATTEMPTS,
+        compact_ratio=COMPACT_RATIO,
+    ):
+        self.progress_file_path = Path(progress_file_path)
+        self.journal_file_path = self.progress_file_path.with_suffix(".journal")
+        self.lock = TimedLock(
+            FileLock(self.progress_file_path.with_suffix(".lock")), "progress_lock"
+        )
+        self.compact_every = compact_every
+        self.compact_ratio = compact_ratio
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
         self.default_progress = {
             ProgressState.DOWNLOADING: {},
             ProgressState.DOWNLOADED: {},
@@ -24,8 +120,22 @@ class ProgressController:
             ProgressState.PROCESSED: {},
             ProgressState.UPLOADING: {},
             ProgressState.UPLOADED: {},
+            ProgressState.FAILED: {},
         }
 
+        # In-memory view of snapshot + journal, valid while the snapshot and
+        # journal files keep the identities recorded below.
+        self._progress = None
+        self._leases: dict[str, ProgressController.Lease] = {}
+        self._attempts: dict[str, int] = {}
+        self._checkpoints: dict[str, dict] = {}
+        self._snapshot_id = None
+        self._journal_id = None
+        self._journal_offset = 0
+        self._journal_records = 0
+        self._journal_valid = False
+        self._watcher = None
+
     @dataclass
     class ProgressItem:
         original_video_name: str
@@ -35,11 +145,21 @@ class ProgressController:
         original_video_id: str
         original_playlist_id: str
         new_playlist_id: str
+        # Where the stage that produced the item's file published it, see
+        # `artifact_transfer.publish`; None if it is on a shared filesystem.
+        artifact: dict | None = None
+
+    @dataclass
+    class Lease:
+        worker_id: str
+        source_state: str | None
+        state: str
+        expires: float
 
     class CustomEncoder(json.JSONEncoder):
         def default(self, o):
             if isinstance(o, ProgressController.ProgressItem):
-                return {
+                data = {
                     "__type__": "ProgressItem",
                     "original_video_name": o.original_video_name,
                     "new_video_name": o.new_video_name,
@@ -49,11 +169,15 @@ class ProgressController:
                     "original_playlist_id": o.original_playlist_id,
                     "new_playlist_id": o.new_playlist_id,
                 }
+                if o.artifact is not None:
+                    data["artifact"] = o.artifact
+                return data
             return super().default(o)
 
-    def custom_decoder(self, dct):
+    @classmethod
+    def custom_decoder(cls, dct):
         if "__type__" in dct and dct["__type__"] == "ProgressItem":
-            return self.ProgressItem(
+            return cls.ProgressItem(
                 dct["original_video_name"],
                 dct["new_video_name"],
                 dct["original_playlist_name"],
@@ -61,13 +185,27 @@ class ProgressController:
                 dct["original_video_id"],
                 dct["original_playlist_id"],
                 dct["new_playlist_id"],
+                dct.get("artifact"),
             )
         return dct
 
     def reset_progress(self):
         with self.lock:
-            with open(self.progress_file_path, "w") as f:
-                json.dump(self.default_progress, f, cls=self.CustomEncoder)
+            progress_data = {state: {} for state in self.default_progress}
+            self._leases = {}
+            self._attempts = {}
+            self._checkpoints = {}
+            self._write_snapshot_unlocked(progress_data)
+            self._start_journal_unlocked()
+
+    def compact(self):
+        """
+        Fold the journal into `progress.json` so the file on disk is a
+        complete export of the current state.
+        """
+        with self.lock:
+            self._refresh_unlocked()
+            self._compact_unlocked()
 
     def lock_file(self):
         self.lock.acquire()
@@ -80,46 +218,67 @@ class ProgressController:
             return self._load_progress_unlocked()
 
     def _load_progress_unlocked(self) -> dict[str, dict[str, ProgressItem]]:
-        if self.progress_file_path.exists():
-            with open(self.progress_file_path, "r") as f:
-                return json.load(f, object_hook=self.custom_decoder)
-        return {}
+        progress_data = self._refresh_unlocked()
+        return {state: dict(items) for state, items in progress_data.items()}
+
+    def contains(self, key: str) -> bool:
+        with self.lock:
+            self._refresh_unlocked()
+            return self._contains_unlocked(key)
+
+    def _contains_unlocked(self, key: str) -> bool:
+        return any(key in items for items in self._progress.values())
+
+    def missing_keys(self, keys) -> list[str]:
+        """
+        The keys, in order, that are not in any state yet.
+        """
+        with self.lock:
+            self._refresh_unlocked()
+            return [key for key in keys if not self._contains_unlocked(key)]
 
     def move_item(
-        self, original_state: ProgressState, new_state: ProgressState, key: str
+        self,
+        original_state: ProgressState,
+        new_state: ProgressState,
+        key: str,
+        artifact: dict | None = None,
     ):
+        """
+        The item's artifact is replaced with `artifact`, so a file published
+        by one stage is never taken for the next stage's output.
+        """
         with self.lock:
-            if self.progress_file_path.exists():
-                with open(self.progress_file_path, "r") as f:
-                    progress_data = json.load(f, object_hook=self.custom_decoder)
-            else:
-                progress_data = {}
-
-            progress_data[new_state][key] = progress_data[original_state][key]
-            del progress_data[original_state][key]
+            progress_data = self._refresh_unlocked()
+            if key not in progress_data.get(original_state, {}):
+                raise KeyError(key)
+            self._check_lease_unlocked(key)
 
-            with open(self.progress_file_path, "w") as f:
-                json.dump(progress_data, f, cls=self.CustomEncoder)
+            self._append_unlocked(
+                {
+                    "op": "move",
+                    "from": original_state,
+                    "to": new_state,
+                    "key": key,
+                    "artifact": artifact,
+                }
+            )
 
     def read_and_move_next_item(
         self, original_state: ProgressState, new_state: ProgressState
     ) -> tuple[str, ProgressItem] | None:
         with self.lock:
-            if self.progress_file_path.exists():
-                with open(self.progress_file_path, "r") as f:
-                    progress_data = json.load(f, object_hook=self.custom_decoder)
-            else:
-                progress_data = {}
+            progress_data = self._refresh_unlocked()
+            self._reclaim_expired_unlocked()
 
             if not progress_data.get(original_state):
                 return None
 
             key, value = next(iter(progress_data[original_state].items()))
-            progress_data[new_state][key] = value
-            del progress_data[original_state][key]
-
-            with open(self.progress_file_path, "w") as f:
-                json.dump(progress_data, f, cls=self.CustomEncoder)
+            self._append_unlocked(
+                {"op": "move", "from": original_state, "to": new_state, "key": key},
+                self._lease_record(key, original_state, new_state),
+            )
 
         return key, value
 
@@ -127,16 +286,372 @@ class ProgressController:
         with self.lock:
             self._add_item_unlocked(state, key, value)
 
-    def _add_item_unlocked(
+    def claim_new_item(
         self, state: ProgressState, key: str, value: ProgressItem
+    ) -> bool:
+        """
+        Add `key` to `state`, leased to this worker, unless it is already in
+        the progress log. Returns whether it was added.
+        """
+        with self.lock:
+            self._refresh_unlocked()
+            if self._contains_unlocked(key):
+                return False
+            self._add_item_unlocked(state, key, value, lease=True)
+            return True
+
+    def _add_item_unlocked(
+        self, state: ProgressState, key: str, value: ProgressItem, lease=False
     ) -> None:
+        """
+        With `lease=True` the new item is claimed by this worker; if the lease
+        expires the item is dropped again rather than moved back.
+        """
+        self._refresh_unlocked()
+        records = [{"op": "add", "state": state, "key": key, "value": value}]
+        if lease:
+            records.append(self._lease_record(key, None, state))
+        self._append_unlocked(*records)
+
+    def heartbeat(self, key: str):
+        """
+        Extend this worker's lease on `key` by `lease_seconds`.
+        """
+        with self.lock:
+            self._refresh_unlocked()
+            lease = self._check_lease_unlocked(key)
+            if lease is None:
+                raise LeaseLostError(f"No lease held on {key}")
+            self._append_unlocked(
+                self._lease_record(key, lease.source_state, lease.state)
+            )
+
+    def keep_alive(self, key: str, interval=None):
+        """
+        Heartbeat the lease on `key` from a background thread for the
+        duration of the `with` block.
+        """
+        if interval is None:
+            interval = self.lease_seconds / 3
+
+        # The thread gets its own controller so it never shares in-memory
+        # state with the caller; the file lock still serializes them.
+        controller = ProgressController(
+            self.progress_file_path,
+            compact_every=self.compact_every,
+            worker_id=self.worker_id,
+            lease_seconds=self.lease_seconds,
+            max_attempts=self.max_attempts,
+            compact_ratio=self.compact_ratio,
+        )
+        return keep_lease_alive(controller, key, interval)
+
+    def save_checkpoint(self, key: str, checkpoint: dict):
+        """
+        Record `checkpoint` for `key`, which this worker must hold a lease on.
+        """
+        with self.lock:
+            self._refresh_unlocked()
+            if self._check_lease_unlocked(key) is None:
+                raise LeaseLostError(f"No lease held on {key}")
+            self._append_unlocked(
+                {"op": "checkpoint", "key": key, "checkpoint": checkpoint}
+            )
+
+    def checkpoint(self, key: str) -> dict | None:
+        with self.lock:
+            self._refresh_unlocked()
+            return self._checkpoints.get(key)
+
+    def release_item(self, key: str, count_attempt=False):
+        """
+        Give up this worker's claim on `key`, returning it to the state it
+        was claimed from. With `count_attempt=True` the claim is treated as
+        a failed attempt, as if its lease had expired.
+        """
+        with self.lock:
+            self._refresh_unlocked()
+            if self._check_lease_unlocked(key) is None:
+                raise LeaseLostError(f"No lease held on {key}")
+            if count_attempt:
+                self._reclaim_unlocked(lambda lease: lease is self._leases[key])
+            else:
+                self._append_unlocked({"op": "release", "key": key})
+
+    def reclaim_expired(self) -> list[str]:
+        with self.lock:
+            self._refresh_unlocked()
+            return self._reclaim_expired_unlocked()
+
+    def abandon_leases(self) -> list[str]:
+        """
+        Reclaim every lease held by this worker as if it had expired, e.g.
+        when a worker restarts under the id of one that crashed. Unlike
+        `release_item` this counts an attempt, so an item that keeps
+        crashing its worker still ends up in FAILED.
+        """
+        with self.lock:
+            self._refresh_unlocked()
+            return self._reclaim_unlocked(
+                lambda lease: lease.worker_id == self.worker_id
+            )
+
+    def wait_for_items(
+        self,
+        state: ProgressState,
+        timeout=None,
+        stop_event=None,
+        poll_seconds=POLL_SECONDS,
+    ) -> bool:
+        """
+        Block until `state` has an item to claim, counting items whose expired
+        leases would return them there. Wakes on filesystem notifications for
+        the progress files, and re-checks them every `poll_seconds` for
+        writers on other machines. Returns False if `timeout` seconds pass or
+        `stop_event` is set first.
+        """
+        if self._watcher is None:
+            self._watcher = ProgressWatcher(
+                [self.progress_file_path, self.journal_file_path]
+            )
+        self._watcher.poll_interval = poll_seconds
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        while stop_event is None or not stop_event.is_set():
+            with self.lock:
+                self._refresh_unlocked()
+                ready, expires = self._claimable_unlocked(state)
+            if ready:
+                return True
+
+            wait = poll_seconds
+            if expires is not None:
+                wait = min(wait, expires - time.time())
+            if deadline is not None:
+                wait = min(wait, deadline - time.monotonic())
+                if wait <= 0:
+                    return False
+            self._watcher.wait(wait)
+        return False
+
+    def _claimable_unlocked(self, state):
+        """
+        Whether `state` has an item to claim now, and if not, when the first
+        lease that would return one there expires.
+        """
+        if self._progress.get(state):
+            return True, None
+        expiries = [
+            lease.expires
+            for lease in self._leases.values()
+            if lease.source_state == state
+        ]
+        if not expiries:
+            return False, None
+        return min(expiries) <= time.time(), min(expiries)
+
+    def _lease_record(self, key, source_state, state):
+        return {
+            "op": "lease",
+            "key": key,
+            "worker": self.worker_id,
+            "source": source_state,
+            "state": state,
+            "expires": time.time() + self.lease_seconds,
+        }
+
+    def _check_lease_unlocked(self, key):
+        lease = self._leases.get(key)
+        if lease is not None and lease.worker_id != self.worker_id:
+            raise LeaseLostError(f"{key} is leased to {lease.worker_id}")
+        return lease
+
+    def _reclaim_expired_unlocked(self):
+        now = time.time()
+        return self._reclaim_unlocked(lambda lease: lease.expires <= now)
+
+    def _reclaim_unlocked(self, should_reclaim):
+        records = []
+        for key, lease in self._leases.items():
+            if not should_reclaim(lease):
+                continue
+            if self._attempts.get(key, 0) + 1 >= self.max_attempts:
+                print(f"Giving up on {key} after {self.max_attempts} attempts.")
+                to_state = ProgressState.FAILED
+            else:
+                to_state = lease.source_state
+            records.append({"op": "reclaim", "key": key, "to": to_state})
+
+        if records:
+            self._append_unlocked(*records)
+        return [record["key"] for record in records]
+
+    @staticmethod
+    def _file_identity(path):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return [stat.st_ino, stat.st_mtime_ns, stat.st_size]
+
+    def _read_snapshot_unlocked(self):
+        progress_data = {state: {} for state in self.default_progress}
         if self.progress_file_path.exists():
             with open(self.progress_file_path, "r") as f:
-                progress_data = json.load(f, object_hook=self.custom_decoder)
+                progress_data.update(json.load(f, object_hook=self.custom_decoder))
+        return progress_data
+
+    def _write_snapshot_unlocked(self, progress_data):
+        tmp_path = self.progress_file_path.with_suffix(".json.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(progress_data, f, cls=self.CustomEncoder)
+        os.replace(tmp_path, self.progress_file_path)
+
+        self._progress = progress_data
+        self._snapshot_id = self._file_identity(self.progress_file_path)
+
+    def _start_journal_unlocked(self):
+        """
+        Replace the journal with a fresh one bound to the current snapshot.
+        Leases, attempt counters and checkpoints are not part of the snapshot,
+        so they are carried over at the top of the new journal.
+        """
+        lines = [{"op": "base", "snapshot": self._snapshot_id}]
+        for key, count in self._attempts.items():
+            lines.append({"op": "attempts", "key": key, "count": count})
+        for key, checkpoint in self._checkpoints.items():
+            lines.append({"op": "checkpoint", "key": key, "checkpoint": checkpoint})
+        for key, lease in self._leases.items():
+            lines.append(
+                {
+                    "op": "lease",
+                    "key": key,
+                    "worker": lease.worker_id,
+                    "source": lease.source_state,
+                    "state": lease.state,
+                    "expires": lease.expires,
+                }
+            )
+        tmp_path = self.journal_file_path.with_suffix(".journal.tmp")
+        with open(tmp_path, "w") as f:
+            for record in lines:
+                f.write(json.dumps(record, cls=self.CustomEncoder) + "\n")
+        os.replace(tmp_path, self.journal_file_path)
+
+        self._journal_id = self._file_identity(self.journal_file_path)[0]
+        self._journal_offset = os.path.getsize(self.journal_file_path)
+        self._journal_records = 0
+        self._journal_valid = True
+
+    def _refresh_unlocked(self):
+        snapshot_id = self._file_identity(self.progress_file_path)
+        journal_id = self._file_identity(self.journal_file_path)
+        journal_id = journal_id[0] if journal_id else None
+
+        if (
+            self._progress is None
+            or snapshot_id != self._snapshot_id
+            or journal_id != self._journal_id
+        ):
+            self._progress = self._read_snapshot_unlocked()
+            self._leases = {}
+            self._attempts = {}
+            self._checkpoints = {}
+            self._snapshot_id = snapshot_id
+            self._journal_id = journal_id
+            self._journal_offset = 0
+            self._journal_records = 0
+            self._journal_valid = False
+
+        if journal_id is not None:
+            self._replay_journal_unlocked()
+
+        return self._progress
+
+    def _replay_journal_unlocked(self):
+        with open(self.journal_file_path, "rb") as f:
+            f.seek(self._journal_offset)
+            data = f.read()
+
+        # A torn final line can only come from a writer that died mid-append;
+        # leave it unconsumed.
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].splitlines():
+            record = json.loads(line, object_hook=self.custom_decoder)
+            if record["op"] == "base":
+                self._journal_valid = record["snapshot"] == self._snapshot_id
+            elif self._journal_valid:
+                self._apply_record(record)
+                self._journal_records += 1
+        self._journal_offset += end
+
+    def _apply_record(self, record):
+        progress_data = self._progress
+        key = record["key"]
+
+        if record["op"] == "add":
+            progress_data.setdefault(record["state"], {})[key] = record["value"]
+        elif record["op"] == "move":
+            value = progress_data.get(record["from"], {}).pop(key)
+            if "artifact" in record:
+                value = replace(value, artifact=record["artifact"])
+            progress_data.setdefault(record["to"], {})[key] = value
+            # Moving a leased item on means the worker finished with it.
+            if self._leases.pop(key, None) is not None:
+                self._attempts.pop(key, None)
+                self._checkpoints.pop(key, None)
+        elif record["op"] == "lease":
+            self._leases[key] = self.Lease(
+                record["worker"], record["source"], record["state"], record["expires"]
+            )
+        elif record["op"] in ("release", "reclaim"):
+            lease = self._leases.pop(key)
+            if record["op"] == "reclaim":
+                self._attempts[key] = self._attempts.get(key, 0) + 1
+                to_state = record["to"]
+            else:
+                to_state = lease.source_state
+            value = progress_data[lease.state].pop(key)
+            if to_state is not None:
+                progress_data.setdefault(to_state, {})[key] = value
+            else:
+                self._checkpoints.pop(key, None)
+        elif record["op"] == "attempts":
+            self._attempts[key] = record["count"]
+        elif record["op"] == "checkpoint":
+            self._checkpoints[key] = record["checkpoint"]
         else:
-            progress_data = {}
+            raise ValueError(f"Unknown progress journal record: {record['op']}")
 
-        progress_data.setdefault(state, {})[key] = value
+    def _append_unlocked(self, *records):
+        if not self._journal_valid:
+            self._start_journal_unlocked()
+        elif os.path.getsize(self.journal_file_path) > self._journal_offset:
+            # Drop a torn line left by a writer that died mid-append, so the
+            # new records don't get glued onto it.
+            os.truncate(self.journal_file_path, self._journal_offset)
 
-        with open(self.progress_file_path, "w") as f:
-            json.dump(progress_data, f, cls=self.CustomEncoder)
+        before = {state: len(items) for state, items in self._progress.items()}
+        for record in records:
+            self._apply_record(record)
+
+        with open(self.journal_file_path, "a") as f:
+            for record in records:
+                f.write(json.dumps(record, cls=self.CustomEncoder) + "\n")
+        self._journal_offset = os.path.getsize(self.journal_file_path)
+        self._journal_records += len(records)
+        for state, items in self._progress.items():
+            if len(items) != before.get(state):
+                metrics.gauge("progress_items", len(items), state=state)
+
+        if self._journal_records >= self.compact_every and (
+            self._journal_offset >= self.compact_ratio * self._snapshot_size()
+        ):
+            self._compact_unlocked()
+
+    def _snapshot_size(self):
+        return self._snapshot_id[2] if self._snapshot_id else 0
+
+    def _compact_unlocked(self):
+        self._write_snapshot_unlocked(self._progress)
+        self._start_journal_unlocked()
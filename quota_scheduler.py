@@ -0,0 +1,208 @@
+import collections
+import heapq
+import itertools
+import json
+import os
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from zoneinfo import ZoneInfo
+
+from filelock import FileLock
+
+
+class QuotaScheduler:
+    """
+    Meters YouTube Data API calls against the project's daily quota.
+
+    Each call is charged its unit cost from a token bucket holding at most
+    `daily_units`, refilled evenly over the day. Callers that would overdraw
+    it wait, and waiting callers are served by priority (uploads first, then
+    other writes, reads and finally processing polls), in arrival order
+    within a priority. When the API reports the quota exhausted the bucket is
+    emptied, so every stage slows down together instead of failing calls.
+
+    The units charged per quota day are capped at `daily_units` as well;
+    like YouTube's own quota, a day starts at midnight Pacific time. With
+    `usage_file` that count is kept on disk and shared by every process
+    using the file, so a restart carries on with what is left of the day
+    instead of a full budget. Without it the count is per process; give
+    each stage sharing a project its share.
+    """
+
+    DAILY_UNITS = 10_000
+    # The YouTube Data API quota resets at midnight in this zone.
+    QUOTA_TIMEZONE = ZoneInfo("America/Los_Angeles")
+    COSTS = {
+        "videos.insert": 1600,
+        "search.list": 100,
+    }
+    LIST_COST = 1
+    WRITE_COST = 50
+
+    # Lower is served first.
+    UPLOAD = 0
+    WRITE = 1
+    READ = 2
+    POLL = 3
+
+    MAX_RETRIES = 6
+    MAX_BACKOFF_SECONDS = 15 * 60
+
+    def __init__(self, daily_units=DAILY_UNITS, usage_file=None):
+        self.daily_units = daily_units
+        self.rate = daily_units / (24 * 60 * 60)
+        self.usage_file = Path(usage_file) if usage_file is not None else None
+        self._usage_lock = None
+        if self.usage_file is not None:
+            self._usage_lock = FileLock(self.usage_file.with_suffix(".lock"))
+        self._day = self._quota_day()
+        self._used_today = 0
+        if self.usage_file is not None:
+            self._used_today = self._read_usage()
+        self._tokens = float(max(0, daily_units - self._used_today))
+        self._updated = time.monotonic()
+        self._waiting = []
+        self._tickets = itertools.count()
+        self._condition = threading.Condition()
+        self._used = collections.Counter()
+        self._throttled = collections.Counter()
+
+    def cost(self, method_id) -> int:
+        name = method_id.removeprefix("youtube.")
+        if name in self.COSTS:
+            return self.COSTS[name]
+        return self.LIST_COST if name.endswith(".list") else self.WRITE_COST
+
+    def priority(self, method_id) -> int:
+        name = method_id.removeprefix("youtube.")
+        if name == "videos.insert":
+            return self.UPLOAD
+        return self.READ if name.endswith(".list") else self.WRITE
+
+    def acquire(self, method_ids, priority=None):
+        """
+        Blocks until the calls `method_ids` (e.g. "youtube.videos.list") can
+        be charged to the budget, then charges them.
+        """
+        cost = sum(self.cost(method_id) for method_id in method_ids)
+        if priority is None:
+            priority = min(self.priority(method_id) for method_id in method_ids)
+        # A call dearer than the whole budget goes once the bucket is full.
+        needed = min(cost, self.daily_units)
+
+        with self._condition:
+            ticket = (priority, next(self._tickets))
+            heapq.heappush(self._waiting, ticket)
+            try:
+                while True:
+                    self._refill_unlocked()
+                    # Other processes sharing the file may have used some.
+                    if self.usage_file is not None:
+                        self._used_today = self._read_usage()
+                    over_day = self._used_today + needed > self.daily_units
+                    first = self._waiting[0] == ticket
+                    if first and not over_day and self._tokens >= needed:
+                        break
+                    timeout = None
+                    if first:
+                        if over_day:
+                            timeout = self._seconds_to_next_day()
+                        else:
+                            timeout = (needed - self._tokens) / self.rate
+                    self._condition.wait(timeout)
+            finally:
+                self._waiting.remove(ticket)
+                heapq.heapify(self._waiting)
+                self._condition.notify_all()
+
+            self._tokens -= cost
+            self._record_usage_unlocked(cost)
+            for method_id in method_ids:
+                self._used[method_id.removeprefix("youtube.")] += self.cost(method_id)
+
+    def backoff(self, attempt, reason):
+        """
+        Sleeps before retrying a call the API refused with `reason`
+        ("quotaExceeded" or "rateLimitExceeded").
+        """
+        with self._condition:
+            self._throttled[reason] += 1
+            if reason == "quotaExceeded":
+                self._refill_unlocked()
+                self._tokens = min(self._tokens, 0)
+
+        delay = min(2**attempt, self.MAX_BACKOFF_SECONDS) * (1 + random.random())
+        print(f"YouTube API {reason}, retrying in {delay:.0f}s.")
+        time.sleep(delay)
+
+    def metrics(self) -> dict:
+        with self._condition:
+            self._refill_unlocked()
+            return {
+                "daily_units": self.daily_units,
+                "remaining_units": max(0, int(self._tokens)),
+                "used_units": sum(self._used.values()),
+                "used_units_today": self._used_today,
+                "used_units_by_method": dict(self._used),
+                "waiting_calls": len(self._waiting),
+                "throttled": dict(self._throttled),
+            }
+
+    def _refill_unlocked(self):
+        now = time.monotonic()
+        self._tokens = min(
+            self.daily_units, self._tokens + (now - self._updated) * self.rate
+        )
+        self._updated = now
+
+        today = self._quota_day()
+        if today != self._day:
+            self._day = today
+            self._used_today = 0
+            self._tokens = float(self.daily_units)
+
+    def _record_usage_unlocked(self, cost):
+        if self.usage_file is None:
+            self._used_today += cost
+            return
+
+        with self._usage_lock:
+            used = self._read_usage_unlocked() + cost
+            tmp_path = self.usage_file.with_suffix(".tmp")
+            with open(tmp_path, "w") as f:
+                json.dump({"day": self._quota_day(), "used_units": used}, f)
+            os.replace(tmp_path, self.usage_file)
+        self._used_today = used
+
+    def _read_usage(self) -> int:
+        with self._usage_lock:
+            return self._read_usage_unlocked()
+
+    def _read_usage_unlocked(self) -> int:
+        try:
+            with open(self.usage_file, "r") as f:
+                usage = json.load(f)
+        except FileNotFoundError:
+            return 0
+        # Yesterday's count no longer applies.
+        if usage.get("day") != self._quota_day():
+            return 0
+        return usage["used_units"]
+
+    @classmethod
+    def _quota_day(cls, now=None) -> str:
+        now = time.time() if now is None else now
+        return datetime.fromtimestamp(now, cls.QUOTA_TIMEZONE).strftime("%Y-%m-%d")
+
+    @classmethod
+    def _seconds_to_next_day(cls, now=None) -> float:
+        now = time.time() if now is None else now
+        today = datetime.fromtimestamp(now, cls.QUOTA_TIMEZONE).date()
+        # Via timestamps, as a DST change makes some days 23 or 25 hours.
+        midnight = datetime.combine(
+            today + timedelta(days=1), datetime.min.time(), cls.QUOTA_TIMEZONE
+        )
+        return midnight.timestamp() - now
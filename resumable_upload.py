@@ -0,0 +1,195 @@
+import os
+import random
+import time
+
+import requests
+
+
+class UploadSessionExpiredError(RuntimeError):
+    pass
+
+
+class ResumableUpload:
+    """
+    Client for Google's resumable upload protocol, sending `file_path` in
+    `chunk_size` pieces.
+
+    Every chunk is its own request, so a failed request only costs that
+    chunk: 5xx responses and connection errors are retried with exponential
+    backoff, asking the server how many bytes it has before continuing. The
+    session URI identifies the upload for about a week, so a new process can
+    pass it to `upload` and carry on from the server's offset.
+
+    `session` is any `requests.Session`; give it an `AuthorizedSession` for
+    the real API, or a plain one for a local test endpoint. Chunk bodies are
+    read through `throttle`, a `TokenBucket` of bytes, when one is given.
+    """
+
+    # The protocol requires chunks to be multiples of 256 KiB.
+    CHUNK_ALIGNMENT = 256 * 1024
+    CHUNK_SIZE = 32 * 1024 * 1024
+    MAX_RETRIES = 8
+    MAX_BACKOFF_SECONDS = 64
+    RETRY_STATUSES = (500, 502, 503, 504)
+
+    def __init__(
+        self,
+        session: requests.Session,
+        file_path,
+        chunk_size=CHUNK_SIZE,
+        max_retries=MAX_RETRIES,
+        mimetype="video/*",
+        timeout=60,
+        throttle=None,
+    ):
+        if chunk_size % self.CHUNK_ALIGNMENT:
+            raise ValueError(
+                f"chunk_size must be a multiple of {self.CHUNK_ALIGNMENT} bytes"
+            )
+        self.session = session
+        self.file_path = file_path
+        self.size = os.path.getsize(file_path)
+        self.chunk_size = chunk_size
+        self.max_retries = max_retries
+        self.mimetype = mimetype
+        self.timeout = timeout
+        self.throttle = throttle
+
+    def create_session(self, url, params: dict, metadata: dict) -> str:
+        """
+        Starts an upload of the file with the resource `metadata` and returns
+        its session URI.
+        """
+        response = self._with_retries(
+            lambda: self.session.post(
+                url,
+                params={**params, "uploadType": "resumable"},
+                json=metadata,
+                headers={
+                    "X-Upload-Content-Length": str(self.size),
+                    "X-Upload-Content-Type": self.mimetype,
+                },
+                timeout=self.timeout,
+            )
+        )
+        response.raise_for_status()
+        return response.headers["Location"]
+
+    def upload(self, session_uri, on_progress=None) -> dict:
+        """
+        Sends whatever the server is missing of the file and returns the
+        created resource. `on_progress(offset)` is called after every chunk
+        the server has acknowledged.
+        """
+        offset = None
+        acknowledged = -1
+        failures = 0
+        with open(self.file_path, "rb") as f:
+            while True:
+                try:
+                    if offset is None:
+                        response = self._query_status(session_uri)
+                    else:
+                        response = self._send_chunk(session_uri, f, offset)
+                except (requests.ConnectionError, requests.Timeout) as e:
+                    error = e
+                else:
+                    if response.status_code in (200, 201):
+                        return response.json()
+                    if response.status_code == 308:
+                        offset = self._acknowledged_bytes(response)
+                        # The status query after a failure succeeds too; only
+                        # new bytes on the server count as getting anywhere.
+                        if offset > acknowledged:
+                            acknowledged = offset
+                            failures = 0
+                            if on_progress:
+                                on_progress(offset)
+                        continue
+                    if response.status_code in (404, 410):
+                        raise UploadSessionExpiredError(session_uri)
+                    if response.status_code not in self.RETRY_STATUSES:
+                        response.raise_for_status()
+                    error = requests.HTTPError(
+                        f"{response.status_code} from upload", response=response
+                    )
+
+                failures += 1
+                if failures > self.max_retries:
+                    raise error
+                self._backoff(failures, error)
+                # The server may have stored part of the failed chunk.
+                offset = None
+
+    def _query_status(self, session_uri):
+        return self.session.put(
+            session_uri,
+            headers={"Content-Range": f"bytes */{self.size}"},
+            timeout=self.timeout,
+        )
+
+    def _send_chunk(self, session_uri, f, offset):
+        f.seek(offset)
+        data = f.read(self.chunk_size)
+        headers = {"Content-Type": self.mimetype}
+        if data:
+            headers["Content-Range"] = (
+                f"bytes {offset}-{offset + len(data) - 1}/{self.size}"
+            )
+        else:
+            headers["Content-Range"] = f"bytes */{self.size}"
+        body = data if self.throttle is None else _ThrottledBody(data, self.throttle)
+        return self.session.put(
+            session_uri, data=body, headers=headers, timeout=self.timeout
+        )
+
+    @staticmethod
+    def _acknowledged_bytes(response):
+        # "Range: bytes=0-N" covers what the server has; no header means
+        # nothing yet.
+        content_range = response.headers.get("Range")
+        if not content_range:
+            return 0
+        return int(content_range.rsplit("-", 1)[1]) + 1
+
+    def _with_retries(self, send):
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = send()
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            else:
+                if response.status_code not in self.RETRY_STATUSES:
+                    return response
+                error = requests.HTTPError(
+                    f"{response.status_code} from upload", response=response
+                )
+            if attempt == self.max_retries:
+                raise error
+            self._backoff(attempt + 1, error)
+
+    def _backoff(self, failures, error):
+        delay = min(2 ** (failures - 1), self.MAX_BACKOFF_SECONDS) + random.random()
+        print(f"Upload request failed ({error}), retrying in {delay:.1f}s.")
+        time.sleep(delay)
+
+
+class _ThrottledBody:
+    """
+    Request body that draws on a token bucket as the connection reads it.
+    """
+
+    def __init__(self, data, throttle):
+        self._data = memoryview(data)
+        self._position = 0
+        self._throttle = throttle
+
+    def __len__(self):
+        return len(self._data)
+
+    def read(self, size=-1):
+        end = len(self._data) if size < 0 else self._position + size
+        piece = self._data[self._position : end]
+        self._position += len(piece)
+        self._throttle.consume(len(piece))
+        return bytes(piece)
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# The stages are plain modules at the repository root.
+sys.path.insert(0, str(Path(__file__).parent.parent))
@@ -0,0 +1,110 @@
+import json
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeUploadServer(ThreadingHTTPServer):
+    """
+    Local stand-in for Google's resumable upload endpoint.
+
+    `POST /upload` starts a session and answers with its URI in `Location`.
+    `PUT <session URI>` either asks for the status (`Content-Range: bytes
+    */<size>`) or sends the chunk at the offset the server has reached;
+    unfinished sessions answer 308 with `Range: bytes=0-<last byte>`,
+    finished ones 201 with the created resource. Expired sessions answer
+    `expired_status`.
+
+    Statuses queued in `faults` answer the next chunks instead, after
+    storing half of each when `keep_on_fault` is set, as a real server may
+    keep part of a failed request.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, expired_status=404):
+        super().__init__(("127.0.0.1", 0), FakeUploadHandler)
+        self.url = f"http://127.0.0.1:{self.server_address[1]}"
+        self.expired_status = expired_status
+        self.sessions = {}
+        self.expired = set()
+        self.faults = []
+        self.keep_on_fault = True
+        self.chunk_offsets = []
+        self.lock = threading.Lock()
+
+    def expire(self, session_uri):
+        session_id = session_uri.rsplit("/", 1)[1]
+        with self.lock:
+            del self.sessions[session_id]
+            self.expired.add(session_id)
+
+    def received(self, session_uri):
+        return bytes(self.sessions[session_uri.rsplit("/", 1)[1]]["data"])
+
+
+class FakeUploadHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    CONTENT_RANGE = re.compile(r"bytes (?:\*|(\d+)-(\d+))/(\d+)$")
+
+    def do_POST(self):
+        metadata = json.loads(self._read_body())
+        with self.server.lock:
+            session_id = str(len(self.server.sessions) + len(self.server.expired))
+            self.server.sessions[session_id] = {
+                "size": int(self.headers["X-Upload-Content-Length"]),
+                "metadata": metadata,
+                "data": bytearray(),
+            }
+        self._reply(200, {"Location": f"{self.server.url}/session/{session_id}"})
+
+    def do_PUT(self):
+        body = self._read_body()
+        session_id = self.path.rsplit("/", 1)[1]
+        with self.server.lock:
+            if session_id in self.server.expired:
+                self._reply(self.server.expired_status)
+                return
+            session = self.server.sessions[session_id]
+            data = session["data"]
+
+            match = self.CONTENT_RANGE.match(self.headers["Content-Range"])
+            if match.group(1) is not None and body:
+                start = int(match.group(1))
+                if start != len(data):
+                    self._reply_status(session)
+                    return
+                self.server.chunk_offsets.append(start)
+                if self.server.faults:
+                    if self.server.keep_on_fault:
+                        data.extend(body[: len(body) // 2])
+                    self._reply(self.server.faults.pop(0))
+                    return
+                data.extend(body)
+            self._reply_status(session)
+
+    def _reply_status(self, session):
+        received = len(session["data"])
+        if received == session["size"]:
+            resource = {"id": "fake-video", **session["metadata"]}
+            self._reply(201, body=json.dumps(resource).encode())
+        elif received:
+            self._reply(308, {"Range": f"bytes=0-{received - 1}"})
+        else:
+            self._reply(308)
+
+    def _read_body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def _reply(self, status, headers=None, body=b""):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if body:
+            self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
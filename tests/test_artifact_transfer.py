@@ -0,0 +1,102 @@
+import json
+import os
+import threading
+
+import pytest
+import requests
+
+from artifact_transfer import (
+    ArtifactChecksumError,
+    ArtifactFetcher,
+    ArtifactServer,
+    publish,
+)
+
+CHUNK_SIZE = 1024
+
+
+@pytest.fixture
+def server(tmp_path):
+    root = tmp_path / "server"
+    (root / "processed_videos").mkdir(parents=True)
+    server = ArtifactServer(root, ("127.0.0.1", 0))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    server.base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def video(server):
+    path = server.directories["processed_videos"] / "PROCESSED a video.mp4"
+    path.write_bytes(os.urandom(10 * CHUNK_SIZE + 100))
+    return path
+
+
+class FailingFetcher(ArtifactFetcher):
+    """
+    Drops the connection on every range from `fail_from` on.
+    """
+
+    def __init__(self, fail_from, **kwargs):
+        super().__init__(**kwargs)
+        self.fail_from = fail_from
+        self.ranges = []
+
+    def _fetch_range(self, url, part_path, start, end):
+        if self.fail_from is not None and start >= self.fail_from:
+            raise requests.ConnectionError("connection dropped")
+        self.ranges.append(start)
+        super()._fetch_range(url, part_path, start, end)
+
+
+def test_fetch_resumes_missing_chunks(server, video, tmp_path):
+    artifact = publish(video, server.base_url)
+    destination = tmp_path / "client" / video.name
+    part_path = destination.with_name(destination.name + ".part")
+    state_path = destination.with_name(destination.name + ".part.json")
+
+    interrupted = FailingFetcher(
+        4 * CHUNK_SIZE, chunk_size=CHUNK_SIZE, workers=1, max_retries=0
+    )
+    with pytest.raises(requests.ConnectionError):
+        interrupted.fetch(artifact, destination)
+    assert not destination.exists()
+    assert part_path.exists()
+    with open(state_path) as f:
+        assert json.load(f)["done"] == [0, CHUNK_SIZE, 2 * CHUNK_SIZE, 3 * CHUNK_SIZE]
+
+    resumed = FailingFetcher(None, chunk_size=CHUNK_SIZE, workers=2)
+    resumed.fetch(artifact, destination)
+    assert sorted(resumed.ranges) == list(
+        range(4 * CHUNK_SIZE, artifact["size"], CHUNK_SIZE)
+    )
+    assert destination.read_bytes() == video.read_bytes()
+    assert not part_path.exists()
+    assert not state_path.exists()
+
+
+def test_fetch_rejects_checksum_mismatch(server, video, tmp_path):
+    artifact = publish(video, server.base_url)
+    # Same size, different content, as if the file was replaced after publish.
+    video.write_bytes(os.urandom(artifact["size"]))
+    destination = tmp_path / "client" / video.name
+
+    with pytest.raises(ArtifactChecksumError):
+        ArtifactFetcher(chunk_size=CHUNK_SIZE).fetch(artifact, destination)
+    assert list(destination.parent.iterdir()) == []
+
+
+def test_discard_removes_every_partial_file(tmp_path):
+    destination = tmp_path / "video.mp4"
+    for suffix in ("", ".part", ".part.json", ".part.tmp"):
+        destination.with_name(destination.name + suffix).write_text("partial")
+
+    ArtifactFetcher.discard(destination)
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_server_refuses_paths_outside_artifact_dirs(server, video):
+    for path in ("/processed_videos/..%2Fsecret", "/other/file", "/processed_videos"):
+        assert requests.get(server.base_url + path).status_code == 404
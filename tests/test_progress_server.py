@@ -0,0 +1,111 @@
+import threading
+import time
+
+import pytest
+
+from progress_client import RemoteProgressController, open_progress
+from progress_server import ProgressServer
+from progresslib import LeaseLostError, ProgressController, ProgressState
+
+DOWNLOADED = ProgressState.DOWNLOADED
+PROCESSING = ProgressState.PROCESSING
+PROCESSED = ProgressState.PROCESSED
+
+
+def make_item(key):
+    return ProgressController.ProgressItem(
+        original_video_name=f"{key}.mp4",
+        new_video_name=f"PROCESSED {key}",
+        original_playlist_name="Playlist",
+        new_playlist_name="PROCESSED Playlist",
+        original_video_id=key,
+        original_playlist_id="playlist",
+        new_playlist_id="PROCESSED playlist",
+    )
+
+
+@pytest.fixture
+def progress_file(tmp_path):
+    progress_file = tmp_path / "progress.json"
+    ProgressController(progress_file).reset_progress()
+    return progress_file
+
+
+@pytest.fixture
+def url(progress_file):
+    server = ProgressServer(progress_file, ("127.0.0.1", 0))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def test_open_progress_picks_the_backend(url, progress_file):
+    assert isinstance(open_progress(url), RemoteProgressController)
+    assert type(open_progress(progress_file)) is ProgressController
+    assert type(open_progress(str(progress_file))) is ProgressController
+
+
+def test_claim_move_and_release(url, progress_file):
+    worker = RemoteProgressController(url, worker_id="worker")
+    worker.add_item(DOWNLOADED, "a", make_item("a"))
+    downloading = ProgressState.DOWNLOADING
+    assert worker.claim_new_item(downloading, "b", make_item("b"))
+    assert not worker.claim_new_item(downloading, "b", make_item("b"))
+    assert worker.missing_keys(["a", "c"]) == ["c"]
+
+    key, item = worker.read_and_move_next_item(DOWNLOADED, PROCESSING)
+    assert key == "a" and item == make_item("a")
+    worker.save_checkpoint(key, {"offset": 1})
+    assert worker.checkpoint(key) == {"offset": 1}
+    worker.release_item(key)
+
+    key, _ = worker.read_and_move_next_item(DOWNLOADED, PROCESSING)
+    artifact = {"url": "http://host/a", "size": 1, "sha256": "0"}
+    worker.move_item(PROCESSING, PROCESSED, key, artifact)
+
+    progress_data = worker.load_progress()
+    assert list(progress_data[PROCESSED]) == ["a"]
+    assert progress_data[PROCESSED]["a"].artifact == artifact
+    # The coordinator wrote it through to the shared progress file.
+    assert ProgressController(progress_file).load_progress() == progress_data
+
+
+def test_errors_come_back_as_their_own_types(url):
+    worker = RemoteProgressController(url, worker_id="worker")
+    other = RemoteProgressController(url, worker_id="other")
+    worker.add_item(DOWNLOADED, "a", make_item("a"))
+    key, _ = worker.read_and_move_next_item(DOWNLOADED, PROCESSING)
+
+    with pytest.raises(KeyError):
+        worker.move_item(DOWNLOADED, PROCESSED, "missing")
+    with pytest.raises(LeaseLostError):
+        other.heartbeat(key)
+    with pytest.raises(LeaseLostError):
+        other.move_item(PROCESSING, PROCESSED, key)
+
+
+def test_expired_lease_is_reclaimed(url):
+    crashed = RemoteProgressController(url, worker_id="crashed", lease_seconds=0.05)
+    crashed.add_item(DOWNLOADED, "a", make_item("a"))
+    key, _ = crashed.read_and_move_next_item(DOWNLOADED, PROCESSING)
+    time.sleep(0.1)
+
+    # The long poll counts items whose leases have expired.
+    other = RemoteProgressController(url, worker_id="other")
+    assert other.wait_for_items(DOWNLOADED, timeout=1)
+    assert other.read_and_move_next_item(DOWNLOADED, PROCESSING)[0] == key
+    with pytest.raises(LeaseLostError):
+        crashed.heartbeat(key)
+
+
+def test_wait_for_items_wakes_on_add(url):
+    waiter = RemoteProgressController(url, worker_id="waiter")
+    threading.Timer(
+        0.2,
+        lambda: RemoteProgressController(url).add_item(DOWNLOADED, "a", make_item("a")),
+    ).start()
+    started = time.monotonic()
+    assert waiter.wait_for_items(DOWNLOADED, timeout=5)
+    assert time.monotonic() - started < 2
+    assert not waiter.wait_for_items(PROCESSED, timeout=0.2)
@@ -0,0 +1,178 @@
+import json
+import os
+import time
+
+import pytest
+
+from progresslib import LeaseLostError, ProgressController, ProgressState
+
+DOWNLOADED = ProgressState.DOWNLOADED
+PROCESSING = ProgressState.PROCESSING
+PROCESSED = ProgressState.PROCESSED
+
+
+def make_item(key):
+    return ProgressController.ProgressItem(
+        original_video_name=f"{key}.mp4",
+        new_video_name=f"PROCESSED {key}",
+        original_playlist_name="Playlist",
+        new_playlist_name="PROCESSED Playlist",
+        original_video_id=key,
+        original_playlist_id="playlist",
+        new_playlist_id="PROCESSED playlist",
+    )
+
+
+@pytest.fixture
+def progress_file(tmp_path):
+    progress_file = tmp_path / "progress.json"
+    ProgressController(progress_file).reset_progress()
+    return progress_file
+
+
+def keys(progress_data):
+    return {state: sorted(items) for state, items in progress_data.items() if items}
+
+
+def journal_lines(progress_file):
+    with open(progress_file.with_suffix(".journal"), "rb") as f:
+        return f.read().splitlines()
+
+
+def test_state_is_replayed_from_snapshot_and_journal(progress_file):
+    controller = ProgressController(progress_file, compact_every=4, compact_ratio=0)
+    for i in range(6):
+        controller.add_item(DOWNLOADED, f"item-{i}", make_item(f"item-{i}"))
+    key, _ = controller.read_and_move_next_item(DOWNLOADED, PROCESSING)
+    controller.move_item(PROCESSING, PROCESSED, key)
+
+    # Compacted at least once, with records after it in the journal.
+    with open(progress_file) as f:
+        assert len(json.load(f)[DOWNLOADED]) >= 4
+    assert len(journal_lines(progress_file)) > 1
+
+    expected = {
+        DOWNLOADED: [f"item-{i}" for i in range(1, 6)],
+        PROCESSED: ["item-0"],
+    }
+    assert keys(controller.load_progress()) == expected
+    assert keys(ProgressController(progress_file).load_progress()) == expected
+
+
+def test_compaction_waits_for_the_journal_to_outgrow_the_snapshot(progress_file):
+    controller = ProgressController(progress_file, compact_every=1, compact_ratio=1)
+    for i in range(20):
+        controller.add_item(DOWNLOADED, f"item-{i}", make_item(f"item-{i}"))
+    snapshot_size = os.path.getsize(progress_file)
+    journal_size = os.path.getsize(progress_file.with_suffix(".journal"))
+    # Each compaction happens once the journal is as large as the snapshot.
+    assert journal_size < snapshot_size + 1000
+    assert snapshot_size > 1000
+
+
+def test_torn_last_line_is_ignored_and_truncated(progress_file):
+    controller = ProgressController(progress_file)
+    controller.add_item(DOWNLOADED, "whole", make_item("whole"))
+    with open(progress_file.with_suffix(".journal"), "a") as f:
+        f.write('{"op": "add", "state": "downloaded", "key": "torn"')
+
+    fresh = ProgressController(progress_file)
+    assert keys(fresh.load_progress()) == {DOWNLOADED: ["whole"]}
+
+    fresh.add_item(DOWNLOADED, "after", make_item("after"))
+    for line in journal_lines(progress_file):
+        json.loads(line)
+    assert keys(ProgressController(progress_file).load_progress()) == {
+        DOWNLOADED: ["after", "whole"]
+    }
+
+
+def test_other_controllers_replacing_the_files_are_noticed(progress_file):
+    controller = ProgressController(progress_file)
+    other = ProgressController(progress_file)
+    controller.add_item(DOWNLOADED, "first", make_item("first"))
+
+    other.compact()
+    other.add_item(DOWNLOADED, "second", make_item("second"))
+    assert keys(controller.load_progress()) == {DOWNLOADED: ["first", "second"]}
+
+    other.reset_progress()
+    assert keys(controller.load_progress()) == {}
+
+
+def test_journal_of_another_snapshot_is_not_replayed(progress_file):
+    controller = ProgressController(progress_file)
+    controller.add_item(DOWNLOADED, "journaled", make_item("journaled"))
+
+    # A hand-edited progress.json replaces the snapshot the journal was for.
+    tmp_path = progress_file.with_name("edited.json")
+    with open(tmp_path, "w") as f:
+        json.dump(
+            {DOWNLOADED: {"edited": make_item("edited")}},
+            f,
+            cls=ProgressController.CustomEncoder,
+        )
+    os.replace(tmp_path, progress_file)
+
+    assert keys(controller.load_progress()) == {DOWNLOADED: ["edited"]}
+    assert keys(ProgressController(progress_file).load_progress()) == {
+        DOWNLOADED: ["edited"]
+    }
+
+
+def claim(progress_file, worker_id, **kwargs):
+    controller = ProgressController(progress_file, worker_id=worker_id, **kwargs)
+    key, _ = controller.read_and_move_next_item(DOWNLOADED, PROCESSING)
+    return controller, key
+
+
+def test_expired_lease_is_reclaimed_with_its_attempt_counted(progress_file):
+    ProgressController(progress_file).add_item(DOWNLOADED, "item", make_item("item"))
+    crashed, key = claim(progress_file, "crashed", lease_seconds=0.05, max_attempts=2)
+    time.sleep(0.1)
+
+    other = ProgressController(progress_file, worker_id="other", max_attempts=2)
+    assert other.reclaim_expired() == [key]
+    assert keys(other.load_progress()) == {DOWNLOADED: ["item"]}
+
+    # The attempt outlives a compaction: the next expiry reaches the cap.
+    other.compact()
+    claim(progress_file, "crashed-again", lease_seconds=0.05, max_attempts=2)
+    time.sleep(0.1)
+    assert other.reclaim_expired() == [key]
+    assert keys(other.load_progress()) == {ProgressState.FAILED: ["item"]}
+
+
+def test_item_fails_after_max_attempts(progress_file):
+    ProgressController(progress_file).add_item(DOWNLOADED, "item", make_item("item"))
+    for attempt in range(3):
+        controller, key = claim(progress_file, f"worker-{attempt}", max_attempts=3)
+        controller.release_item(key, count_attempt=True)
+    assert keys(controller.load_progress()) == {ProgressState.FAILED: ["item"]}
+
+
+def test_heartbeat_after_reclaim_raises_lease_lost(progress_file):
+    ProgressController(progress_file).add_item(DOWNLOADED, "item", make_item("item"))
+    slow, key = claim(progress_file, "slow", lease_seconds=0.05)
+    slow.heartbeat(key)
+    time.sleep(0.1)
+
+    fast, claimed = claim(progress_file, "fast")
+    assert claimed == key
+    with pytest.raises(LeaseLostError):
+        slow.heartbeat(key)
+    with pytest.raises(LeaseLostError):
+        slow.move_item(PROCESSING, PROCESSED, key)
+    fast.move_item(PROCESSING, PROCESSED, key)
+
+
+def test_checkpoint_survives_release_and_is_dropped_on_move(progress_file):
+    ProgressController(progress_file).add_item(DOWNLOADED, "item", make_item("item"))
+    first, key = claim(progress_file, "first")
+    first.save_checkpoint(key, {"offset": 42})
+    first.release_item(key)
+
+    second, key = claim(progress_file, "second")
+    assert second.checkpoint(key) == {"offset": 42}
+    second.move_item(PROCESSING, PROCESSED, key)
+    assert ProgressController(progress_file).checkpoint(key) is None
@@ -0,0 +1,81 @@
+import json
+import time
+from datetime import datetime, timezone
+
+import quota_scheduler
+from quota_scheduler import QuotaScheduler
+
+
+def test_usage_survives_restart(tmp_path):
+    usage_file = tmp_path / "quota_usage.json"
+    QuotaScheduler(1000, usage_file).acquire(["youtube.videos.update"] * 4)
+
+    restarted = QuotaScheduler(1000, usage_file)
+    assert restarted.metrics()["used_units_today"] == 200
+    assert restarted.metrics()["remaining_units"] == 800
+
+
+def test_processes_share_the_day(tmp_path):
+    usage_file = tmp_path / "quota_usage.json"
+    first = QuotaScheduler(1000, usage_file)
+    second = QuotaScheduler(1000, usage_file)
+
+    first.acquire(["youtube.videos.update"])
+    second.acquire(["youtube.playlistItems.list"])
+
+    with open(usage_file) as f:
+        assert json.load(f)["used_units"] == 51
+
+
+def test_other_days_do_not_count(tmp_path):
+    usage_file = tmp_path / "quota_usage.json"
+    with open(usage_file, "w") as f:
+        json.dump({"day": "2000-01-01", "used_units": 1000}, f)
+
+    scheduler = QuotaScheduler(1000, usage_file)
+    assert scheduler.metrics()["remaining_units"] == 1000
+    scheduler.acquire(["youtube.videos.update"])
+    with open(usage_file) as f:
+        assert json.load(f)["used_units"] == 50
+
+
+class FakeTime:
+    """
+    Stands in for the `time` module with a wall clock set by the test.
+    """
+
+    monotonic = staticmethod(time.monotonic)
+    sleep = staticmethod(time.sleep)
+
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+def utc(*args):
+    return datetime(*args, tzinfo=timezone.utc).timestamp()
+
+
+def test_quota_day_follows_pacific_midnight():
+    # 00:30 UTC is still the previous evening in California.
+    assert QuotaScheduler._quota_day(utc(2026, 10, 18, 0, 30)) == "2026-10-17"
+    assert QuotaScheduler._quota_day(utc(2026, 10, 18, 6, 59, 59)) == "2026-10-17"
+    assert QuotaScheduler._quota_day(utc(2026, 10, 18, 7, 0, 1)) == "2026-10-18"
+    assert QuotaScheduler._seconds_to_next_day(utc(2026, 10, 18, 6, 59, 59)) == 1
+    # The day the clocks go back has 25 hours.
+    assert QuotaScheduler._seconds_to_next_day(utc(2026, 11, 1, 7)) == 25 * 60 * 60
+
+
+def test_usage_resets_at_pacific_midnight_not_utc(tmp_path, monkeypatch):
+    usage_file = tmp_path / "quota_usage.json"
+    clock = FakeTime(utc(2026, 10, 17, 23))
+    monkeypatch.setattr(quota_scheduler, "time", clock)
+    QuotaScheduler(1000, usage_file).acquire(["youtube.videos.update"])
+
+    clock.now = utc(2026, 10, 18, 0, 30)
+    assert QuotaScheduler(1000, usage_file).metrics()["used_units_today"] == 50
+
+    clock.now = utc(2026, 10, 18, 7, 30)
+    assert QuotaScheduler(1000, usage_file).metrics()["used_units_today"] == 0
@@ -0,0 +1,104 @@
+import os
+import threading
+
+import pytest
+import requests
+
+from fake_upload_server import FakeUploadServer
+from resumable_upload import ResumableUpload, UploadSessionExpiredError
+
+CHUNK_SIZE = ResumableUpload.CHUNK_ALIGNMENT
+METADATA = {"snippet": {"title": "A video"}}
+
+
+class Interrupted(Exception):
+    pass
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(ResumableUpload, "_backoff", lambda self, *args: None)
+
+
+@pytest.fixture
+def server():
+    server = FakeUploadServer()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def video(tmp_path):
+    path = tmp_path / "video.mp4"
+    path.write_bytes(os.urandom(4 * CHUNK_SIZE + 1000))
+    return path
+
+
+def start_upload(server, video, **kwargs):
+    upload = ResumableUpload(requests.Session(), video, chunk_size=CHUNK_SIZE, **kwargs)
+    session_uri = upload.create_session(f"{server.url}/upload", {}, METADATA)
+    return upload, session_uri
+
+
+def test_interrupted_upload_resumes_from_server_offset(server, video):
+    upload, session_uri = start_upload(server, video)
+
+    def stop_after_two_chunks(offset):
+        if offset >= 2 * CHUNK_SIZE:
+            raise Interrupted()
+
+    with pytest.raises(Interrupted):
+        upload.upload(session_uri, on_progress=stop_after_two_chunks)
+    assert len(server.received(session_uri)) == 2 * CHUNK_SIZE
+
+    # A new process only has the session URI.
+    resumed = ResumableUpload(requests.Session(), video, chunk_size=CHUNK_SIZE)
+    offsets = []
+    resource = resumed.upload(session_uri, on_progress=offsets.append)
+
+    assert resource["id"] == "fake-video"
+    assert resource["snippet"] == METADATA["snippet"]
+    assert server.received(session_uri) == video.read_bytes()
+    # Nothing the server already had was sent again.
+    assert server.chunk_offsets == [i * CHUNK_SIZE for i in range(5)]
+    assert offsets[0] == 2 * CHUNK_SIZE
+
+
+def test_server_errors_are_retried_from_stored_offset(server, video):
+    upload, session_uri = start_upload(server, video)
+    server.faults = [503, 500]
+
+    upload.upload(session_uri)
+
+    assert server.faults == []
+    assert server.received(session_uri) == video.read_bytes()
+    # Each failed chunk left half of itself behind, which was not resent.
+    assert server.chunk_offsets[:3] == [0, CHUNK_SIZE // 2, CHUNK_SIZE]
+
+
+def test_server_errors_give_up_after_max_retries(server, video):
+    upload, session_uri = start_upload(server, video, max_retries=2)
+    server.keep_on_fault = False
+    server.faults = [503] * 3
+
+    with pytest.raises(requests.HTTPError):
+        upload.upload(session_uri)
+    assert server.faults == []
+    assert server.received(session_uri) == b""
+
+
+@pytest.mark.parametrize("status", [404, 410])
+def test_expired_session_restarts_upload(server, video, status):
+    server.expired_status = status
+    upload, session_uri = start_upload(server, video)
+    server.expire(session_uri)
+
+    with pytest.raises(UploadSessionExpiredError):
+        upload.upload(session_uri)
+
+    # What YoutubeUtils.upload does next: start over in a new session.
+    session_uri = upload.create_session(f"{server.url}/upload", {}, METADATA)
+    upload.upload(session_uri)
+    assert server.received(session_uri) == video.read_bytes()
@@ -0,0 +1,46 @@
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket for a budget shared by several consumers, such
+    as the bytes per second of every upload stream in a process.
+
+    `rate` tokens are added per second, up to `burst` (one second's worth by
+    default); with `rate=None` nothing is limited. `consume` takes what it
+    needs even when that puts the bucket into debt and then sleeps until the
+    debt is paid off, so concurrent consumers are served in the order they
+    asked. Everything consumed is counted, for throughput reporting.
+    """
+
+    def __init__(self, rate=None, burst=None):
+        self.rate = rate
+        self.burst = burst or rate
+        self.consumed = 0
+        self.started = time.monotonic()
+        self._tokens = self.burst
+        self._updated = self.started
+        self._lock = threading.Lock()
+
+    def consume(self, amount):
+        with self._lock:
+            self.consumed += amount
+            if self.rate is None:
+                return
+            now = time.monotonic()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._updated) * self.rate
+            )
+            self._updated = now
+            self._tokens -= amount
+            wait = -self._tokens / self.rate
+
+        if wait > 0:
+            time.sleep(wait)
+
+    def throughput(self) -> float:
+        """
+        Average tokens consumed per second since the bucket was created.
+        """
+        return self.consumed / max(time.monotonic() - self.started, 1e-9)
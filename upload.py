@@ -1,5 +1,13 @@
+import argparse
+import threading
+from contextlib import ExitStack
 from pathlib import Path
-from progresslib import ProgressController, ProgressState
+from artifact_transfer import ArtifactFetcher
+from pipeline_metrics import metrics
+from processing_tracker import ProcessingTracker
+from progress_client import open_progress
+from progresslib import ProgressState
+from token_bucket import TokenBucket
 from yt_utils import YoutubeUtils
 from my_secrets import (
     YOUTUBE_CLIENT_ID,
@@ -9,44 +17,253 @@ from my_secrets import (
     YOUTUBE_TOKEN_URI,
 )
 
-if __name__ == "__main__":
-    PROGRESS_FILE = Path(__file__).parent / "progress.json"
-    PROCESSED_DIR = Path(__file__).parent / "processed_videos"
+PROGRESS_FILE = Path(__file__).parent / "progress.json"
+PROCESSED_DIR = Path(__file__).parent / "processed_videos"
+# YouTube API units used today, shared with download.py.
+QUOTA_USAGE_FILE = Path(__file__).parent / "quota_usage.json"
+METRICS_DIR = Path(__file__).parent / "metrics"
+REPORT_SECONDS = 30
 
-    progress_controller = ProgressController(PROGRESS_FILE)
-    process_log = progress_controller.load_progress()
 
-    ytlib = YoutubeUtils(
-        youtube_token=YOUTUBE_TOKEN,
-        youtube_refresh_token=YOUTUBE_REFRESH_TOKEN,
-        youtube_token_uri=YOUTUBE_TOKEN_URI,
-        youtube_client_id=YOUTUBE_CLIENT_ID,
-        youtube_client_secret=YOUTUBE_CLIENT_SECRET,
+def finish_when_processed(
+    tracker, progress_controller, ytlib, video_id, uploaded_video_id, playlist_id, lease
+):
+    """
+    Has `tracker` add the video to its playlist and mark it UPLOADED once
+    YouTube has processed it, and release `lease` either way.
+    """
+
+    def on_ready(_):
+        try:
+            ytlib.add_to_playlist(uploaded_video_id, playlist_id)
+        finally:
+            lease.close()
+        progress_controller.move_item(
+            ProgressState.UPLOADING, ProgressState.UPLOADED, video_id
+        )
+        print(f"Uploaded {video_id} as {uploaded_video_id}.")
+
+    def on_failed(_, reason):
+        lease.close()
+        # Upload it again next time.
+        progress_controller.save_checkpoint(video_id, {})
+        progress_controller.release_item(video_id, count_attempt=True)
+
+    tracker.track(uploaded_video_id, on_ready, on_failed)
+
+
+def upload_stream(
+    stream,
+    progress_store,
+    ytlib,
+    tracker,
+    tracker_controller,
+    bandwidth,
+    chunk_size,
+    stop_event,
+):
+    # Every stream has its own controller, all under the process's worker id.
+    progress_controller = open_progress(
+        progress_store, worker_id=tracker_controller.worker_id
     )
 
-    while True:
+    # Without a stop event the stream exits once PROCESSED is empty;
+    # with one it waits for more until the event is set.
+    while stop_event is None or not stop_event.is_set():
         next_item = progress_controller.read_and_move_next_item(
             ProgressState.PROCESSED, ProgressState.UPLOADING
         )
         if not next_item:
-            print("No more items to upload.")
-            exit(0)
+            if stop_event is None:
+                print(f"Stream {stream}: no more items to upload.")
+                return
+            progress_controller.wait_for_items(
+                ProgressState.PROCESSED, stop_event=stop_event
+            )
+            continue
 
         video_id, video_properties = next_item
 
-        ytlib.upload(
-            PROCESSED_DIR / video_properties.original_video_name,
-            video_properties.new_video_name,
-            description="",
-            category_id="22",
-            privacy="public",
-        )
+        # Resume where an earlier, interrupted upload of this video stopped.
+        checkpoint = progress_controller.checkpoint(video_id) or {}
+
+        def save_checkpoint(session_uri, offset):
+            progress_controller.save_checkpoint(
+                video_id, {"session_uri": session_uri, "offset": offset}
+            )
+
+        # The lease is kept alive until YouTube has processed the video.
+        lease = ExitStack()
+        lease.enter_context(progress_controller.keep_alive(video_id))
+        try:
+            uploaded_video_id = checkpoint.get("uploaded_video_id")
+            if uploaded_video_id is None:
+                video_path = PROCESSED_DIR / f"{video_properties.original_video_id}.mp4"
+                # Processed on another machine: fetch and verify it first.
+                if video_properties.artifact is not None:
+                    try:
+                        ArtifactFetcher().fetch(video_properties.artifact, video_path)
+                    except ArtifactFetcher.ERRORS as e:
+                        print(f"Stream {stream}: could not fetch {video_id}: {e}")
+                        ArtifactFetcher.discard(video_path)
+                        lease.close()
+                        progress_controller.release_item(video_id, count_attempt=True)
+                        continue
+                response = ytlib.upload(
+                    video_path,
+                    video_properties.new_video_name,
+                    description="",
+                    category_id="22",
+                    privacy="public",
+                    session_uri=checkpoint.get("session_uri"),
+                    on_progress=save_checkpoint,
+                    chunk_size=chunk_size,
+                    throttle=bandwidth,
+                )
+                uploaded_video_id = response["id"]
+                progress_controller.save_checkpoint(
+                    video_id, {"uploaded_video_id": uploaded_video_id}
+                )
+        except Exception as e:
+            # The checkpoint stays, so the next attempt resumes the session.
+            print(f"Stream {stream}: upload of {video_id} failed: {e!r}")
+            lease.close()
+            progress_controller.release_item(video_id, count_attempt=True)
+            continue
+        except BaseException:
+            lease.close()
+            raise
 
-        ytlib.add_to_playlist(
+        finish_when_processed(
+            tracker,
+            tracker_controller,
+            ytlib,
             video_id,
+            uploaded_video_id,
             video_properties.new_playlist_id,
+            lease,
         )
 
-        progress_controller.move_item(
-            ProgressState.UPLOADING, ProgressState.UPLOADED, video_id
+
+def run_stream(stream, failed_streams, stop_event, *args):
+    """
+    Runs `upload_stream`, recording the stream in `failed_streams` if it
+    dies and asking the others to stop, so the process exits non-zero
+    instead of carrying on with fewer streams.
+    """
+    try:
+        upload_stream(stream, *args, stop_event)
+    except BaseException:
+        failed_streams.append(stream)
+        if stop_event is not None:
+            stop_event.set()
+        raise
+
+
+def report_throughput(bandwidth, streams, stop):
+    while not stop.wait(REPORT_SECONDS):
+        print(
+            f"Aggregate upload throughput over {streams} stream(s): "
+            f"{bandwidth.throughput() * 8 / 1e6:.1f} Mbit/s"
         )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Upload processed videos.")
+    parser.add_argument(
+        "--chunk-mib",
+        type=int,
+        default=YoutubeUtils.UPLOAD_CHUNK_SIZE // (1024 * 1024),
+        help="size of each upload request in MiB",
+    )
+    parser.add_argument(
+        "--streams", type=int, default=1, help="videos to upload concurrently"
+    )
+    parser.add_argument(
+        "--max-mbps",
+        type=float,
+        help="cap on the combined upload rate of all streams, in Mbit/s",
+    )
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="keep running and wait for newly processed videos instead of exiting",
+    )
+    parser.add_argument(
+        "--coordinator",
+        help="URL of a progress_server.py to use instead of the local progress file",
+    )
+    args = parser.parse_args()
+    metrics.configure("upload", METRICS_DIR)
+
+    ytlib = YoutubeUtils(
+        youtube_token=YOUTUBE_TOKEN,
+        youtube_refresh_token=YOUTUBE_REFRESH_TOKEN,
+        youtube_token_uri=YOUTUBE_TOKEN_URI,
+        youtube_client_id=YOUTUBE_CLIENT_ID,
+        youtube_client_secret=YOUTUBE_CLIENT_SECRET,
+        quota_usage_file=QUOTA_USAGE_FILE,
+    )
+
+    # Callbacks run on the tracker's thread, so it gets its own controller.
+    progress_store = args.coordinator or PROGRESS_FILE
+    tracker_controller = open_progress(progress_store)
+    tracker = ProcessingTracker(ytlib)
+    bandwidth = TokenBucket(args.max_mbps * 1e6 / 8 if args.max_mbps else None)
+
+    stop_reporting = threading.Event()
+    stop_streams = threading.Event() if args.daemon else None
+    threading.Thread(
+        target=report_throughput,
+        args=(bandwidth, args.streams, stop_reporting),
+        daemon=True,
+    ).start()
+
+    failed_streams = []
+    streams = [
+        threading.Thread(
+            target=run_stream,
+            args=(
+                stream,
+                failed_streams,
+                stop_streams,
+                progress_store,
+                ytlib,
+                tracker,
+                tracker_controller,
+                bandwidth,
+                args.chunk_mib * 1024 * 1024,
+            ),
+        )
+        for stream in range(args.streams)
+    ]
+    for thread in streams:
+        thread.start()
+    try:
+        for thread in streams:
+            thread.join()
+    except KeyboardInterrupt:
+        if stop_streams is None:
+            raise
+        print("Stopping once the current uploads are sent...")
+        stop_streams.set()
+        for thread in streams:
+            thread.join()
+    stop_reporting.set()
+
+    print(
+        f"Sent {bandwidth.consumed / 1e6:.1f} MB at "
+        f"{bandwidth.throughput() * 8 / 1e6:.1f} Mbit/s, "
+        f"waiting on {tracker.pending()} video(s) to finish processing."
+    )
+    tracker.join()
+    quota = ytlib.quota.metrics()
+    print(
+        f"Used {quota['used_units']} YouTube API units, "
+        f"{quota['remaining_units']} of {quota['daily_units']} left."
+    )
+    if failed_streams:
+        print(f"Upload stream(s) {sorted(failed_streams)} failed, exiting.")
+        exit(1)
+    print("No more items to upload.")
+    exit(0)
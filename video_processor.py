@@ -1,14 +1,151 @@
+import dataclasses
+import functools
 import json
+import bisect
+import math
 import os
+import shutil
+import signal
 import subprocess
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
 from pathlib import Path
 from io import StringIO
 
+from analysis_cache import AnalysisCache
+from motion_detector import MotionDetector
+from pipeline_metrics import metrics
+
 
 class VideoProcessor:
     VIDEO_FPS = 30
     SPEEDUP_FACTOR = 16
     VIDEO_CODEC = "libx264"
+    MOTION_THRESHOLD = 0.2
+    MARGIN_SECONDS = 5
+
+    # "native" uses MotionDetector, "auto-editor" shells out to auto-editor.
+    MOTION_ANALYZER = "native"
+    ANALYSIS_WIDTH = 400
+    ANALYSIS_STRIDE = 1
+
+    # Set ANALYSIS_CACHE_DIR to None to always re-analyse.
+    ANALYSIS_CACHE_DIR = Path(__file__).parent / "analysis_cache"
+    ANALYSIS_CACHE_MAX_BYTES = 256 * 1024 * 1024
+    OVERLAY_PATH = Path(__file__).parent / "resources" / "overlay.png"
+    RENDER_MODE = "single_pass"
+    SEGMENT_WORKERS = None  # None means one per CPU
+    SEGMENTS_PER_WORKER = 2
+    SMART_MIN_COPY_SECONDS = 2
+
+    # ffmpeg encoders for the source audio codecs smart rendering re-encodes
+    # to; pieces with different audio codecs cannot be stream-copied into
+    # one file.
+    AUDIO_ENCODERS = {"aac": "aac", "mp3": "libmp3lame", "opus": "libopus"}
+
+    # Hardware encoders first; the last entry is the CPU fallback.
+    ENCODER_PREFERENCE = {
+        "h264": ["h264_nvenc", "h264_qsv", "h264_videotoolbox", "libx264"],
+        "hevc": ["hevc_nvenc", "hevc_qsv", "hevc_videotoolbox", "libx265"],
+    }
+    DEFAULT_PRESETS = {
+        "libx264": "veryfast",
+        "libx265": "fast",
+        "h264_nvenc": "p4",
+        "hevc_nvenc": "p4",
+    }
+
+    @dataclass
+    class EncoderSettings:
+        """
+        Per-run encoder options. `encoder` forces a specific ffmpeg encoder,
+        otherwise the first working one for `codec` is used. `quality` is the
+        encoder's constant-quality level (CRF for x264/x265, CQ for NVENC).
+        """
+
+        codec: str = "h264"
+        encoder: str | None = None
+        preset: str | None = None
+        threads: int | None = None
+        quality: int | None = None
+
+    ENCODER_SETTINGS = EncoderSettings()
+
+    @staticmethod
+    @functools.cache
+    def detect_encoder(codec="h264"):
+        """
+        Returns the first encoder for `codec` that this machine's ffmpeg
+        both lists and can actually open, e.g. NVENC is skipped on nodes
+        without a GPU.
+        """
+        result = subprocess.run(
+            ["ffmpeg", "-hide_banner", "-encoders"],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        listed = {
+            fields[1]
+            for fields in map(str.split, result.stdout.splitlines())
+            if len(fields) > 1
+        }
+
+        for encoder in VideoProcessor.ENCODER_PREFERENCE[codec]:
+            if encoder not in listed:
+                continue
+            probe = subprocess.run(
+                [
+                    "ffmpeg",
+                    "-hide_banner",
+                    "-v",
+                    "error",
+                    "-f",
+                    "lavfi",
+                    "-i",
+                    "color=size=256x256:duration=0.1",
+                    "-frames:v",
+                    "1",
+                    "-c:v",
+                    encoder,
+                    "-f",
+                    "null",
+                    "-",
+                ],
+                capture_output=True,
+            )
+            if probe.returncode == 0:
+                print(f"Using encoder {encoder}")
+                return encoder
+
+        raise RuntimeError(f"ffmpeg has no working {codec} encoder")
+
+    @staticmethod
+    def _encoder_args(settings=None):
+        if settings is None:
+            settings = VideoProcessor.ENCODER_SETTINGS
+
+        encoder = settings.encoder or VideoProcessor.detect_encoder(settings.codec)
+        args = ["-c:v", encoder]
+
+        preset = settings.preset or VideoProcessor.DEFAULT_PRESETS.get(encoder)
+        if preset:
+            args.extend(["-preset", preset])
+
+        if settings.quality is not None:
+            if encoder.startswith("lib"):
+                args.extend(["-crf", str(settings.quality)])
+            elif encoder.endswith("_nvenc"):
+                args.extend(["-rc", "vbr", "-cq", str(settings.quality)])
+            elif encoder.endswith("_qsv"):
+                args.extend(["-global_quality", str(settings.quality)])
+            else:
+                args.extend(["-q:v", str(settings.quality)])
+
+        if settings.threads:
+            args.extend(["-threads", str(settings.threads)])
+
+        return args
 
     @staticmethod
     def download(video_id=None, url=None, format=None, output_file=None):
@@ -32,47 +169,703 @@ class VideoProcessor:
         if output_file:
             command.extend(["--output", output_file])
 
-        process = subprocess.Popen(
-            command,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            text=True,
-            bufsize=1,
-        )
+        VideoProcessor._run_and_print(command)
         print("Download successful!")
 
-        for line in process.stdout:  # type: ignore
-            print(line, end="")
-
-        process.stdout.close()  # type: ignore
-        process.wait()
-
     @staticmethod
-    def process(file_path, outpath=None):
-        file_path_stem = Path(file_path).stem
+    @metrics.timed("video_process")
+    def process(
+        file_path, outpath=None, render_mode=None, encoder_settings=None, workers=None
+    ):
+        """
+        `render_mode` is "single_pass" (overlay and speed-up in one ffmpeg
+        filter graph), "segmented" (the single-pass render split into
+        segments rendered by `workers` processes), "smart" (stream-copy the
+        normal-speed spans and re-encode the rest, also using `workers`) or
+        "two_pass" (overlay to an intermediate file, then speed it up with
+        auto-editor). Defaults to `RENDER_MODE`. `encoder_settings` defaults
+        to `ENCODER_SETTINGS`.
+        """
+        if render_mode is None:
+            render_mode = VideoProcessor.RENDER_MODE
+
+        file_path = Path(file_path)
+        file_path_stem = file_path.stem
+        work_dir = file_path.parent
 
         if outpath == None:
-            outpath = Path(file_path).parent / f"{file_path_stem}_edited.mp4"
+            outpath = work_dir / f"{file_path_stem}_edited.mp4"
 
-        v1_path = file_path / f".{file_path_stem}_v1_timeline.json"
-        VideoProcessor._generate_v1(file_path, v1_path)
+        v1_path = work_dir / f".{file_path_stem}_v1_timeline.json"
+        VideoProcessor._generate_v1_cached(
+            file_path,
+            v1_path,
+            threads=(encoder_settings or VideoProcessor.ENCODER_SETTINGS).threads,
+        )
+
+        if render_mode == "single_pass":
+            VideoProcessor._render_single_pass(
+                file_path, v1_path, outpath, encoder_settings
+            )
+        elif render_mode == "segmented":
+            VideoProcessor._render_segmented(
+                file_path, v1_path, outpath, encoder_settings, workers
+            )
+        elif render_mode == "smart":
+            VideoProcessor._render_smart(
+                file_path, v1_path, outpath, encoder_settings, workers
+            )
+        elif render_mode == "two_pass":
+            VideoProcessor._render_two_pass(
+                file_path, v1_path, outpath, encoder_settings
+            )
+        else:
+            raise ValueError(f"Unknown render mode: {render_mode}")
+
+        os.remove(v1_path)
 
-        overlayed_video_path = file_path / f".{file_path_stem}_overlayed_video.mp4"
+        return outpath
+
+    @staticmethod
+    @metrics.timed("video_render_two_pass")
+    def _render_two_pass(video_path, timeline_path, output_path, encoder_settings=None):
+        video_path = Path(video_path)
+        overlayed_video_path = (
+            video_path.parent / f".{video_path.stem}_overlayed_video.mp4"
+        )
         VideoProcessor._edit_add_overlay(
-            video_path=file_path,
-            timeline_path=v1_path,
+            video_path=video_path,
+            timeline_path=timeline_path,
             output_path=overlayed_video_path,
+            encoder_settings=encoder_settings,
         )
 
         VideoProcessor._edit_apply_speedup(
             video_path=overlayed_video_path,
-            output_path=outpath,
+            timeline_path=timeline_path,
+            output_path=output_path,
+            encoder_settings=encoder_settings,
         )
 
-        os.remove(v1_path)
         os.remove(overlayed_video_path)
 
-        return outpath
+    @staticmethod
+    @metrics.timed("video_render_single_pass")
+    def _render_single_pass(
+        video_path, timeline_path, output_path, encoder_settings=None
+    ):
+        """
+        Renders the final video in one ffmpeg run: every timeline chunk is
+        trimmed out of the source, sped-up chunks are retimed and overlaid,
+        and the chunks are concatenated, so there is no intermediate encode.
+        """
+        chunks = VideoProcessor._load_chunks(timeline_path)
+        if not chunks:
+            raise ValueError("Timeline has no chunks to render.")
+
+        graph_path = Path(timeline_path).with_name(
+            f"{Path(timeline_path).stem}_graph.txt"
+        )
+        VideoProcessor._render_chunks(
+            video_path, chunks, output_path, graph_path, encoder_settings
+        )
+
+    @staticmethod
+    @metrics.timed("video_render_segmented")
+    def _render_segmented(
+        video_path, timeline_path, output_path, encoder_settings=None, workers=None
+    ):
+        """
+        Splits the timeline into segments of roughly equal source duration,
+        renders them with the single-pass graph in a process pool, and joins
+        the results with the concat demuxer without re-encoding.
+
+        Each segment is read with an input seek, which decodes from the
+        keyframe before the segment start and drops frames up to the exact
+        start, so seams need not fall on source keyframes. Sped-up chunks are
+        only split on multiples of their speed, so the frames kept at a seam
+        are the same ones the unsegmented render keeps.
+        """
+        encoder_settings, workers = VideoProcessor._parallel_encoder_settings(
+            encoder_settings, workers
+        )
+
+        chunks = VideoProcessor._load_frame_chunks(timeline_path)
+        if not chunks:
+            raise ValueError("Timeline has no chunks to render.")
+        segments = VideoProcessor._plan_segments(
+            chunks, workers * VideoProcessor.SEGMENTS_PER_WORKER
+        )
+
+        output_path = Path(output_path)
+        segment_dir = output_path.parent / f".{output_path.stem}_segments"
+        segment_dir.mkdir(exist_ok=True)
+
+        try:
+            fps = VideoProcessor.VIDEO_FPS
+            segment_paths = []
+            with VideoProcessor._process_pool(workers) as pool:
+                futures = []
+                for i, segment in enumerate(segments):
+                    first_frame, last_frame = segment[0][0], segment[-1][1]
+                    segment_chunks = [
+                        ((start - first_frame) / fps, (stop - first_frame) / fps, speed)
+                        for start, stop, speed in segment
+                    ]
+                    segment_path = segment_dir / f"segment_{i:04d}.mp4"
+                    segment_paths.append(segment_path)
+                    futures.append(
+                        pool.submit(
+                            VideoProcessor._render_chunks,
+                            video_path,
+                            segment_chunks,
+                            segment_path,
+                            segment_dir / f"segment_{i:04d}_graph.txt",
+                            encoder_settings,
+                            (first_frame / fps, (last_frame - first_frame) / fps),
+                        )
+                    )
+                for future in futures:
+                    future.result()
+
+            VideoProcessor._concat_copy(segment_paths, segment_dir, output_path)
+        finally:
+            shutil.rmtree(segment_dir)
+
+    @staticmethod
+    @metrics.timed("video_render_smart")
+    def _render_smart(
+        video_path, timeline_path, output_path, encoder_settings=None, workers=None
+    ):
+        """
+        Stream-copies the normal-speed spans between their first and last
+        source keyframe and re-encodes only the rest: the sped-up, overlaid
+        chunks and the short edges between a cut and the nearest keyframe.
+        Neighbouring re-encoded pieces are rendered together, the pieces run
+        in a process pool, and everything is joined with the concat demuxer.
+
+        Re-encoded pieces use the source's video and audio codecs and
+        formats, and all pieces are written as MPEG-TS, which repeats the
+        parameter sets in-band, so copied and re-encoded pieces can be joined
+        without re-encoding. Audio in copied spans is cut on the nearest
+        audio frame.
+        """
+        codec, pix_fmt = VideoProcessor._probe_video_codec(video_path)
+        if codec not in VideoProcessor.ENCODER_PREFERENCE:
+            raise ValueError(f"Smart rendering does not support {codec} sources")
+        output_args = ["-pix_fmt", pix_fmt]
+        audio = VideoProcessor._probe_audio_codec(video_path)
+        if audio is not None:
+            audio_codec, bit_rate, sample_rate, channels = audio
+            if audio_codec not in VideoProcessor.AUDIO_ENCODERS:
+                raise ValueError(
+                    f"Smart rendering does not support {audio_codec} audio"
+                )
+            # Without -c:a the MPEG-TS muxer would pick MP2.
+            output_args.extend(
+                [
+                    "-c:a",
+                    VideoProcessor.AUDIO_ENCODERS[audio_codec],
+                    "-ar",
+                    sample_rate,
+                    "-ac",
+                    channels,
+                ]
+            )
+            if bit_rate:
+                output_args.extend(["-b:a", bit_rate])
+
+        if encoder_settings is None:
+            encoder_settings = VideoProcessor.ENCODER_SETTINGS
+        encoder_settings = dataclasses.replace(encoder_settings, codec=codec)
+        if encoder_settings.encoder not in VideoProcessor.ENCODER_PREFERENCE[codec]:
+            encoder_settings = dataclasses.replace(encoder_settings, encoder=None)
+        encoder_settings, workers = VideoProcessor._parallel_encoder_settings(
+            encoder_settings, workers
+        )
+
+        chunks = VideoProcessor._load_chunks(timeline_path)
+        if not chunks:
+            raise ValueError("Timeline has no chunks to render.")
+        pieces = VideoProcessor._plan_smart_pieces(
+            chunks, VideoProcessor._probe_keyframes(video_path)
+        )
+
+        output_path = Path(output_path)
+        piece_dir = output_path.parent / f".{output_path.stem}_pieces"
+        piece_dir.mkdir(exist_ok=True)
+
+        try:
+            piece_paths = []
+            with VideoProcessor._process_pool(workers) as pool:
+                futures = []
+                for i, (kind, start, stop, piece_chunks) in enumerate(pieces):
+                    piece_path = piece_dir / f"piece_{i:05d}.ts"
+                    piece_paths.append(piece_path)
+                    if kind == "copy":
+                        futures.append(
+                            pool.submit(
+                                VideoProcessor._copy_span,
+                                video_path,
+                                start,
+                                stop,
+                                piece_path,
+                            )
+                        )
+                    else:
+                        futures.append(
+                            pool.submit(
+                                VideoProcessor._render_chunks,
+                                video_path,
+                                piece_chunks,
+                                piece_path,
+                                piece_dir / f"piece_{i:05d}_graph.txt",
+                                encoder_settings,
+                                (start, stop - start),
+                                output_args,
+                            )
+                        )
+                for future in futures:
+                    future.result()
+
+            VideoProcessor._concat_copy(piece_paths, piece_dir, output_path)
+        finally:
+            shutil.rmtree(piece_dir)
+
+    @staticmethod
+    def _plan_smart_pieces(chunks, keyframes):
+        """
+        Turns chunks (in seconds) into an ordered list of
+        ("copy" | "encode", start, stop, chunks) pieces. Encode pieces carry
+        their chunks relative to the piece start; copy pieces start and end
+        on keyframes.
+        """
+        pieces = []
+        pending = []
+
+        def encode(start, stop, speed):
+            if stop > start:
+                pending.append((start, stop, speed))
+
+        def flush():
+            if pending:
+                first = pending[0][0]
+                pieces.append(
+                    (
+                        "encode",
+                        first,
+                        pending[-1][1],
+                        [
+                            (start - first, stop - first, speed)
+                            for start, stop, speed in pending
+                        ],
+                    )
+                )
+                pending.clear()
+
+        for start, stop, speed in chunks:
+            if speed == 1:
+                first_keyframe = bisect.bisect_left(keyframes, start)
+                last_keyframe = bisect.bisect_right(keyframes, stop) - 1
+                if (
+                    first_keyframe < last_keyframe
+                    and keyframes[last_keyframe] - keyframes[first_keyframe]
+                    >= VideoProcessor.SMART_MIN_COPY_SECONDS
+                ):
+                    copy_start = keyframes[first_keyframe]
+                    copy_stop = keyframes[last_keyframe]
+                    encode(start, copy_start, 1)
+                    flush()
+                    pieces.append(("copy", copy_start, copy_stop, None))
+                    encode(copy_stop, stop, 1)
+                    continue
+            encode(start, stop, speed)
+
+        flush()
+        return pieces
+
+    @staticmethod
+    def _copy_span(video_path, start, stop, output_path):
+        # An input seek onto a keyframe with stream copy starts exactly there.
+        VideoProcessor._run_and_print(
+            [
+                "ffmpeg",
+                "-y",
+                "-ss",
+                str(start),
+                "-t",
+                str(stop - start),
+                "-i",
+                video_path,
+                "-map",
+                "0:v:0",
+                "-map",
+                "0:a?",
+                "-c",
+                "copy",
+                "-avoid_negative_ts",
+                "make_zero",
+                output_path,
+            ]
+        )
+
+    @staticmethod
+    def _probe_keyframes(video_path):
+        """
+        Returns the sorted keyframe times of the first video stream, relative
+        to the stream's start like the timeline and `-ss` seeks. Only packet
+        flags are read, so nothing is decoded.
+        """
+        result = subprocess.run(
+            [
+                "ffprobe",
+                "-v",
+                "error",
+                "-select_streams",
+                "v:0",
+                "-show_entries",
+                "stream=start_time:packet=pts_time,flags",
+                "-of",
+                "json",
+                video_path,
+            ],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        probe = json.loads(result.stdout)
+        start_time = probe["streams"][0].get("start_time", "N/A")
+        offset = float(start_time) if start_time != "N/A" else 0.0
+
+        keyframes = []
+        for packet in probe.get("packets", []):
+            pts_time = packet.get("pts_time", "N/A")
+            if "K" in packet.get("flags", "") and pts_time != "N/A":
+                keyframes.append(float(pts_time) - offset)
+        return sorted(keyframes)
+
+    @staticmethod
+    def _probe_video_codec(video_path):
+        result = subprocess.run(
+            [
+                "ffprobe",
+                "-v",
+                "error",
+                "-select_streams",
+                "v:0",
+                "-show_entries",
+                "stream=codec_name,pix_fmt",
+                "-of",
+                "csv=p=0",
+                video_path,
+            ],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        codec, pix_fmt = result.stdout.strip().split(",")[:2]
+        return codec, pix_fmt
+
+    @staticmethod
+    def _probe_audio_codec(video_path):
+        """
+        Returns (codec, bit rate, sample rate, channels) of the first audio
+        stream as ffmpeg option values, or None if there is no audio. The bit
+        rate is None where the container does not record one.
+        """
+        result = subprocess.run(
+            [
+                "ffprobe",
+                "-v",
+                "error",
+                "-select_streams",
+                "a:0",
+                "-show_entries",
+                "stream=codec_name,bit_rate,sample_rate,channels",
+                "-of",
+                "json",
+                video_path,
+            ],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        streams = json.loads(result.stdout).get("streams", [])
+        if not streams:
+            return None
+        stream = streams[0]
+        bit_rate = stream.get("bit_rate")
+        return (
+            stream["codec_name"],
+            bit_rate if bit_rate not in (None, "N/A") else None,
+            str(stream["sample_rate"]),
+            str(stream["channels"]),
+        )
+
+    @staticmethod
+    def _process_pool(workers):
+        """
+        A process pool whose workers die on SIGTERM. Forked workers would
+        otherwise inherit the caller's handler, turn the signal into an
+        exception on one task and carry on with the queued ones.
+        """
+        return ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=signal.signal,
+            initargs=(signal.SIGTERM, signal.SIG_DFL),
+        )
+
+    @staticmethod
+    def _parallel_encoder_settings(encoder_settings, workers):
+        """
+        Treats `threads` as the budget for the whole job and splits it
+        between `workers` concurrent encodes. The encoder is resolved here
+        rather than probed again in every worker.
+        """
+        if encoder_settings is None:
+            encoder_settings = VideoProcessor.ENCODER_SETTINGS
+
+        budget = encoder_settings.threads or os.cpu_count() or 1
+        workers = workers or VideoProcessor.SEGMENT_WORKERS or budget
+
+        encoder_settings = dataclasses.replace(
+            encoder_settings,
+            encoder=encoder_settings.encoder
+            or VideoProcessor.detect_encoder(encoder_settings.codec),
+            threads=max(1, budget // workers),
+        )
+        return encoder_settings, workers
+
+    @staticmethod
+    def _concat_copy(paths, work_dir, output_path):
+        concat_list_path = Path(work_dir) / "concat.txt"
+        with open(concat_list_path, "w") as f:
+            for path in paths:
+                f.write(f"file '{Path(path).resolve()}'\n")
+
+        VideoProcessor._run_and_print(
+            [
+                "ffmpeg",
+                "-y",
+                "-f",
+                "concat",
+                "-safe",
+                "0",
+                "-i",
+                concat_list_path,
+                "-c",
+                "copy",
+                output_path,
+            ]
+        )
+
+    @staticmethod
+    def _plan_segments(chunks, count):
+        """
+        Groups frame chunks into at most `count` segments of roughly equal
+        source duration, splitting chunks where a boundary falls inside one.
+        """
+        target = (chunks[-1][1] - chunks[0][0]) / count
+        segments = []
+        current = []
+        boundary = chunks[0][0] + target
+
+        for start, stop, speed in chunks:
+            while stop > boundary and len(segments) < count - 1:
+                # Keep the frames fps= selects after a split identical to an
+                # unsplit chunk by cutting on a multiple of the speed.
+                step = speed if float(speed).is_integer() else 1
+                split = start + max(0, math.ceil((boundary - start) / step)) * step
+                if split >= stop:
+                    break
+                if split > start:
+                    current.append((start, split, speed))
+                    start = split
+                if current:
+                    segments.append(current)
+                    current = []
+                boundary = start + target
+            current.append((start, stop, speed))
+
+        segments.append(current)
+        return segments
+
+    @staticmethod
+    def _render_chunks(
+        video_path,
+        chunks,
+        output_path,
+        graph_path,
+        encoder_settings=None,
+        seek=None,
+        output_args=(),
+    ):
+        """
+        Runs the single-pass graph for `chunks`, given in seconds. With
+        `seek=(start, duration)` only that part of the source is read and
+        chunk times are relative to `start`.
+        """
+        has_audio = VideoProcessor._has_audio(video_path)
+        filter_graph = VideoProcessor._build_single_pass_graph(chunks, has_audio)
+
+        # Long streams produce graphs too large for the command line.
+        with open(graph_path, "w") as f:
+            f.write(filter_graph)
+
+        command = ["ffmpeg", "-y"]
+        if seek is not None:
+            command.extend(["-ss", str(seek[0]), "-t", str(seek[1])])
+        command.extend(
+            [
+                "-i",
+                video_path,
+                "-i",
+                VideoProcessor.OVERLAY_PATH,
+                "-filter_complex_script",
+                graph_path,
+                "-map",
+                "[outv]",
+            ]
+        )
+        if has_audio:
+            command.extend(["-map", "[outa]"])
+        command.extend(VideoProcessor._encoder_args(encoder_settings))
+        command.extend(output_args)
+        command.append(output_path)
+
+        try:
+            VideoProcessor._run_and_print(command)
+        finally:
+            os.remove(graph_path)
+
+    @staticmethod
+    def _build_single_pass_graph(chunks, has_audio):
+        fps = VideoProcessor.VIDEO_FPS
+        sped_up = [i for i, (_, _, speed) in enumerate(chunks) if speed != 1]
+
+        graph = [
+            f"[0:v]split={len(chunks)}" + "".join(f"[s{i}]" for i in range(len(chunks)))
+        ]
+        if has_audio:
+            graph.append(
+                f"[0:a]asplit={len(chunks)}"
+                + "".join(f"[a{i}]" for i in range(len(chunks)))
+            )
+        if sped_up:
+            graph.append(
+                f"[1:v]split={len(sped_up)}" + "".join(f"[o{i}]" for i in sped_up)
+            )
+
+        concat_inputs = ""
+        for i, (start, stop, speed) in enumerate(chunks):
+            video = f"[s{i}]trim=start={start}:end={stop},setpts=PTS-STARTPTS"
+            if speed != 1:
+                # Drop the surplus frames before overlaying, not after.
+                graph.append(f"{video},setpts=PTS/{speed},fps={fps}[t{i}]")
+                graph.append(f"[t{i}][o{i}]overlay=0:0[v{i}]")
+            else:
+                graph.append(f"{video}[v{i}]")
+            concat_inputs += f"[v{i}]"
+
+            if has_audio:
+                audio = f"[a{i}]atrim=start={start}:end={stop},asetpts=PTS-STARTPTS"
+                if speed != 1:
+                    audio += "," + VideoProcessor._atempo_chain(speed)
+                graph.append(f"{audio}[b{i}]")
+                concat_inputs += f"[b{i}]"
+
+        outputs = "[outv][outa]" if has_audio else "[outv]"
+        graph.append(
+            f"{concat_inputs}concat=n={len(chunks)}:v=1:a={int(has_audio)}{outputs}"
+        )
+        return ";\n".join(graph)
+
+    @staticmethod
+    def _atempo_chain(speed):
+        # atempo only accepts factors up to 2 on older ffmpeg builds.
+        filters = []
+        while speed > 2:
+            filters.append("atempo=2")
+            speed /= 2
+        filters.append(f"atempo={speed}")
+        return ",".join(filters)
+
+    @staticmethod
+    def _load_frame_chunks(timeline_path):
+        """
+        Returns the v1 timeline chunks as (start, stop, speed) in frames,
+        leaving out chunks that auto-editor cuts entirely.
+        """
+        with open(timeline_path, "r") as f:
+            timeline_data = json.load(f)
+
+        return [
+            (start, stop, speed)
+            for start, stop, speed in timeline_data["chunks"]
+            if 0 < speed < 99999
+        ]
+
+    @staticmethod
+    def _load_chunks(timeline_path):
+        """
+        Same as `_load_frame_chunks`, with times in seconds.
+        """
+        fps = VideoProcessor.VIDEO_FPS
+        return [
+            (start / fps, stop / fps, speed)
+            for start, stop, speed in VideoProcessor._load_frame_chunks(timeline_path)
+        ]
+
+    @staticmethod
+    def _has_audio(video_path):
+        result = subprocess.run(
+            [
+                "ffprobe",
+                "-v",
+                "error",
+                "-select_streams",
+                "a",
+                "-show_entries",
+                "stream=index",
+                "-of",
+                "csv=p=0",
+                video_path,
+            ],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        return bool(result.stdout.strip())
+
+    @staticmethod
+    def _run_and_print(command, capture=False):
+        """
+        Runs `command`, echoing its output, and raises CalledProcessError if
+        it fails. With `capture` the output is also returned.
+        """
+        output = StringIO() if capture else None
+        process = subprocess.Popen(
+            command,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            bufsize=1,
+        )
+
+        try:
+            for line in process.stdout:  # type: ignore
+                print(line, end="")
+                if output is not None:
+                    output.write(line)
+            process.wait()
+        except BaseException:
+            # Don't leave ffmpeg running if the worker is being shut down.
+            process.kill()
+            raise
+
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, process.args)
+        return output.getvalue() if output is not None else None
 
     @staticmethod
     def download_and_process(link):
@@ -80,7 +873,7 @@ class VideoProcessor:
         1. Get v1 chunks
         2. Get timestamps for stale chunks
         3. ffmpeg add overlay
-        4. Apply auto-editor with v1
+        4. Render the overlaid video with auto-editor from the v1 timeline
         """
         file_path = Path(__file__).parent
 
@@ -100,6 +893,7 @@ class VideoProcessor:
         edited_video_path = file_path / ".edited_video.mp4"
         VideoProcessor._edit_apply_speedup(
             video_path=overlayed_video_path,
+            timeline_path=v1_path,
             output_path=edited_video_path,
         )
 
@@ -119,20 +913,67 @@ class VideoProcessor:
             raise ValueError("Could not find JSON data in stdout.")
 
     @staticmethod
-    def _frame_number_to_seconds(frame_number, fps):
-        total_seconds = frame_number / fps
-        return int(total_seconds)
+    def _analysis_params():
+        """
+        Everything that changes the timeline `_generate_v1` produces.
+        """
+        params = {
+            "analyzer": VideoProcessor.MOTION_ANALYZER,
+            "fps": VideoProcessor.VIDEO_FPS,
+            "threshold": VideoProcessor.MOTION_THRESHOLD,
+            "margin_seconds": VideoProcessor.MARGIN_SECONDS,
+            "speedup_factor": VideoProcessor.SPEEDUP_FACTOR,
+        }
+        if VideoProcessor.MOTION_ANALYZER == "native":
+            params["width"] = VideoProcessor.ANALYSIS_WIDTH
+            params["stride"] = VideoProcessor.ANALYSIS_STRIDE
+        return params
 
     @staticmethod
-    def _generate_v1(video_path, outpath):
-        log_buffer = StringIO()
+    def analysis_cache():
+        if VideoProcessor.ANALYSIS_CACHE_DIR is None:
+            return None
+        return AnalysisCache(
+            VideoProcessor.ANALYSIS_CACHE_DIR,
+            VideoProcessor.ANALYSIS_CACHE_MAX_BYTES,
+        )
 
-        process = subprocess.Popen(
+    @staticmethod
+    def _generate_v1_cached(video_path, outpath, threads=None):
+        cache = VideoProcessor.analysis_cache()
+        if cache is None:
+            VideoProcessor._generate_v1(video_path, outpath, threads)
+            return
+
+        key = cache.key(video_path, VideoProcessor._analysis_params())
+        if cache.get(key, outpath):
+            print(f"Reusing cached motion analysis for {video_path}")
+            return
+
+        VideoProcessor._generate_v1(video_path, outpath, threads)
+        cache.put(key, outpath)
+
+    @staticmethod
+    @metrics.timed("video_generate_v1")
+    def _generate_v1(video_path, outpath, threads=None):
+        if VideoProcessor.MOTION_ANALYZER == "native":
+            MotionDetector(
+                fps=VideoProcessor.VIDEO_FPS,
+                speedup_factor=VideoProcessor.SPEEDUP_FACTOR,
+                threshold=VideoProcessor.MOTION_THRESHOLD,
+                margin_seconds=VideoProcessor.MARGIN_SECONDS,
+                width=VideoProcessor.ANALYSIS_WIDTH,
+                stride=VideoProcessor.ANALYSIS_STRIDE,
+                threads=threads,
+            ).write_timeline(video_path, outpath)
+            return
+
+        log = VideoProcessor._run_and_print(
             [
                 "auto-editor",
                 video_path,
                 "--edit",
-                "motion:threshold=0.2",
+                f"motion:threshold={VideoProcessor.MOTION_THRESHOLD}",
                 "--video-speed",
                 "1",
                 "--silent-speed",
@@ -142,118 +983,140 @@ class VideoProcessor:
                 "--download-format",
                 "bv",
                 "--margin",
-                "5sec",
+                f"{VideoProcessor.MARGIN_SECONDS}sec",
                 "--export",
                 "timeline:api=1",
             ],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            text=True,
-            bufsize=1,
+            capture=True,
         )
-
-        for line in process.stdout:  # type: ignore
-            print(line, end="")
-            log_buffer.write(line)
-
-        process.wait()
-        if process.returncode != 0:
-            raise subprocess.CalledProcessError(process.returncode, process.args)
-
-        VideoProcessor._parse_json_from_text(log_buffer.getvalue(), outpath)
+        VideoProcessor._parse_json_from_text(log, outpath)
 
     @staticmethod
-    def _edit_add_overlay(video_path, timeline_path, output_path):
-        with open(timeline_path, "r") as f:
-            timeline_data = json.load(f)
-
-        chunks = timeline_data["chunks"]
-
-        sped_up_timestamps = []
-
-        for start, stop, speed in chunks:
-            # Check if the speed is not 1 (normal speed)
-            if speed != 1:
-                sped_up_timestamps.append(
-                    (
-                        VideoProcessor._frame_number_to_seconds(
-                            start, VideoProcessor.VIDEO_FPS
-                        ),
-                        VideoProcessor._frame_number_to_seconds(
-                            stop, VideoProcessor.VIDEO_FPS
-                        ),
-                    )
-                )
-
-        # Build ffmpeg filter-complex
-        filter_complex = ""
-        for i, (start, stop) in enumerate(sped_up_timestamps):
-            if i == 0:
-                filter_complex += f"[0:v][1:v] overlay=0:0:enable='between(t,{start},{stop})' [v{i+1}]; "
-            elif i == len(sped_up_timestamps) - 1:
-                filter_complex += f"[v{i}][1:v] overlay=0:0:enable='between(t,{start},{stop}):' [v{i+1}]"
-            else:
-                filter_complex += f"[v{i}][1:v] overlay=0:0:enable='between(t,{start},{stop})' [v{i+1}]; "
-
-        overlay_path = Path(__file__).parent / "overlay.png"
+    @metrics.timed("video_edit_add_overlay")
+    def _edit_add_overlay(
+        video_path, timeline_path, output_path, encoder_settings=None
+    ):
+        sped_up_intervals = VideoProcessor._merge_intervals(
+            (start, stop)
+            for start, stop, speed in VideoProcessor._load_chunks(timeline_path)
+            if speed != 1
+        )
 
-        process = subprocess.Popen(
-            [
+        if not sped_up_intervals:
+            # Nothing to overlay, so the video can be passed through as is.
+            command = ["ffmpeg", "-y", "-i", video_path, "-c", "copy", output_path]
+        else:
+            # One overlay node switched on by a single enable expression,
+            # instead of one chained overlay per interval.
+            enable = VideoProcessor._enable_expression(sped_up_intervals)
+            command = [
                 "ffmpeg",
                 "-y",
                 "-i",
                 video_path,
                 "-i",
-                overlay_path,
+                VideoProcessor.OVERLAY_PATH,
                 "-filter_complex",
-                filter_complex,
+                f"[0:v][1:v] overlay=0:0:enable='{enable}' [v]",
+                "-map",
+                "[v]",
                 "-map",
-                f"[v{len(sped_up_timestamps)}]",
+                "0:a?",
                 "-c:a",
                 "copy",
-                "-c:v",
-                "h264_nvenc",
+                *VideoProcessor._encoder_args(encoder_settings),
                 output_path,
-            ],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            text=True,
-            bufsize=1,
-        )
+            ]
 
-        for line in process.stdout:  # type: ignore
-            print(line, end="")
+        VideoProcessor._run_and_print(command)
 
-        process.wait()
+    @staticmethod
+    def _merge_intervals(intervals):
+        """
+        Sorts (start, stop) intervals and merges the ones that overlap or
+        touch.
+        """
+        merged = []
+        for start, stop in sorted(intervals):
+            if merged and start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+            else:
+                merged.append((start, stop))
+        return merged
 
     @staticmethod
-    def _edit_apply_speedup(video_path, output_path):
-        process = subprocess.Popen(
+    def _enable_expression(intervals):
+        """
+        Builds an ffmpeg expression that is true inside any of the sorted,
+        disjoint `intervals`. The intervals are laid out as a binary search
+        over `if()`, which ffmpeg evaluates lazily, so each frame costs
+        O(log n) comparisons rather than one per interval.
+        """
+        if len(intervals) == 1:
+            start, stop = intervals[0]
+            return f"between(t,{start},{stop})"
+
+        mid = len(intervals) // 2
+        left = VideoProcessor._enable_expression(intervals[:mid])
+        right = VideoProcessor._enable_expression(intervals[mid:])
+        return f"if(lt(t,{intervals[mid][0]}),{left},{right})"
+
+    @staticmethod
+    @metrics.timed("video_edit_apply_speedup")
+    def _edit_apply_speedup(
+        video_path, timeline_path, output_path, encoder_settings=None
+    ):
+        """
+        Renders `video_path` with the cuts from the v1 timeline produced by
+        `_generate_v1`, so the motion analysis is not run a second time.
+        The overlay does not move any frames, so the timeline computed on the
+        source applies to the overlaid video unchanged.
+
+        auto-editor encodes through its own bundled ffmpeg libraries, which
+        are not the ones `detect_encoder` probes, so this step always uses the
+        CPU encoder for the configured codec. Its command line takes no
+        encoder preset or quality, so those settings cannot reach it; the
+        thread budget is applied by running it under `taskset` on that many
+        CPUs, which the encoder sizes its thread pool by.
+        """
+        if encoder_settings is None:
+            encoder_settings = VideoProcessor.ENCODER_SETTINGS
+        encoder = VideoProcessor.ENCODER_PREFERENCE[encoder_settings.codec][-1]
+
+        if encoder_settings.preset or encoder_settings.quality is not None:
+            print(
+                "auto-editor ignores the encoder preset and quality; "
+                "use a native render mode to apply them."
+            )
+        # taskset rather than a preexec_fn, which runs Python in the forked
+        # child and can deadlock on a lock the heartbeat thread held.
+        command = []
+        if encoder_settings.threads and shutil.which("taskset"):
+            cpus = sorted(os.sched_getaffinity(0))[: encoder_settings.threads]
+            command.extend(["taskset", "-c", ",".join(map(str, cpus))])
+
+        with open(timeline_path, "r") as f:
+            timeline_data = json.load(f)
+
+        timeline_data["source"] = str(Path(video_path).resolve())
+
+        speedup_timeline_path = Path(timeline_path).with_name(
+            f"{Path(timeline_path).stem}_speedup.json"
+        )
+        with open(speedup_timeline_path, "w") as f:
+            json.dump(timeline_data, f)
+
+        command.extend(
             [
                 "auto-editor",
-                video_path,
-                "--edit",
-                "motion:threshold=0.2",
-                "--video-speed",
-                "1",
-                "--silent-speed",
-                str(VideoProcessor.SPEEDUP_FACTOR),
+                speedup_timeline_path,
                 "--video-codec",
-                VideoProcessor.VIDEO_CODEC,
-                "--download-format",
-                "bv",
-                "--margin",
-                "5sec",
+                encoder,
                 "--output-file",
                 output_path,
-            ],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            text=True,
-            bufsize=1,
+            ]
         )
-
-        for line in process.stdout:  # type: ignore
-            print(line, end="")
-
-        process.wait()
+        try:
+            VideoProcessor._run_and_print(command)
+        finally:
+            os.remove(speedup_timeline_path)
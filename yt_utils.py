@@ -1,15 +1,32 @@
+import json
 import os
+import threading
 import time
+import cachetools
+import google_auth_httplib2
+import httplib2
+import requests
+from google.auth.transport.requests import AuthorizedSession
 from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload
+from googleapiclient.errors import HttpError
 from dataclasses import dataclass
+from pathlib import Path
 
+from pipeline_metrics import metrics
+from quota_scheduler import QuotaScheduler
+from resumable_upload import ResumableUpload, UploadSessionExpiredError
 
 YT_API_KEY = os.getenv("YT_API_KEY")
 
 
 class YoutubeUtils:
+    # Most ids a single `list` request takes, and most calls in one batch.
+    BATCH_SIZE = 50
+    METADATA_TTL = 60 * 60
+    UPLOAD_URL = "https://www.googleapis.com/upload/youtube/v3/videos"
+    UPLOAD_CHUNK_SIZE = ResumableUpload.CHUNK_SIZE
+
     def __init__(
         self,
         youtube_token,
@@ -17,19 +34,22 @@ class YoutubeUtils:
         youtube_token_uri,
         youtube_client_id,
         youtube_client_secret,
+        daily_quota=QuotaScheduler.DAILY_UNITS,
+        quota_usage_file=None,
     ):
-        self.youtube = build(
-            "youtube",
-            "v3",
-            credentials=Credentials(
-                token=youtube_token,
-                refresh_token=youtube_refresh_token,
-                token_uri=youtube_token_uri,
-                client_id=youtube_client_id,
-                client_secret=youtube_client_secret,
-                scopes=["https://www.googleapis.com/auth/youtube.force-ssl"],
-            ),
+        self.credentials = Credentials(
+            token=youtube_token,
+            refresh_token=youtube_refresh_token,
+            token_uri=youtube_token_uri,
+            client_id=youtube_client_id,
+            client_secret=youtube_client_secret,
+            scopes=["https://www.googleapis.com/auth/youtube.force-ssl"],
         )
+        self.youtube = build("youtube", "v3", credentials=self.credentials)
+        self._local = threading.local()
+        self._metadata = cachetools.TTLCache(maxsize=100_000, ttl=self.METADATA_TTL)
+        self._metadata_lock = threading.Lock()
+        self.quota = QuotaScheduler(daily_quota, quota_usage_file)
 
     @dataclass
     class Playlist:
@@ -42,6 +62,126 @@ class YoutubeUtils:
         title: str
         playlist: "YoutubeUtils.Playlist"
 
+    def execute(self, request, etag=None, priority=None):
+        """
+        Executes `request` on an HTTP connection owned by the calling thread,
+        as httplib2 connections can't be shared between threads, once the
+        quota scheduler admits it. With `etag` the request is conditional,
+        and None is returned if the resource still has that ETag.
+        """
+        if etag is not None:
+            request.headers["If-None-Match"] = etag
+        try:
+            return self._scheduled(
+                [request.methodId],
+                lambda: request.execute(http=self._http()),
+                priority,
+            )
+        except HttpError as e:
+            if etag is not None and e.resp.status == 304:
+                return None
+            raise
+
+    def execute_batch(self, requests, priority=None) -> list:
+        """
+        Executes `requests` as batch HTTP requests of up to BATCH_SIZE calls
+        each and returns their responses in order. When some calls of a batch
+        are throttled, only those are sent (and charged) again.
+        """
+        if len(requests) == 1:
+            return [self.execute(requests[0], priority=priority)]
+
+        responses = [None] * len(requests)
+        for start in range(0, len(requests), self.BATCH_SIZE):
+            pending = dict(enumerate(requests[start : start + self.BATCH_SIZE], start))
+            self._scheduled(
+                lambda: [request.methodId for request in pending.values()],
+                lambda: self._send_batch(pending, responses),
+                priority,
+            )
+        return responses
+
+    def _send_batch(self, pending, responses):
+        """
+        Sends `pending`, a dict of index to request, as one batch request.
+        Each response is stored at its index in `responses` and its request
+        dropped from `pending`; the calls that failed stay and the first
+        error is raised.
+        """
+        errors = []
+
+        def callback(request_id, response, exception):
+            if exception is not None:
+                errors.append(exception)
+            else:
+                responses[int(request_id)] = response
+                del pending[int(request_id)]
+
+        batch = self.youtube.new_batch_http_request(callback=callback)
+        for i, request in list(pending.items()):
+            batch.add(request, request_id=str(i))
+        batch.execute(http=self._http())
+
+        if errors:
+            raise errors[0]
+
+    def _scheduled(self, method_ids, send, priority=None):
+        """
+        Charges `method_ids` to the quota and calls `send`, backing off and
+        retrying while the API refuses it for quota or rate limits.
+        `method_ids` may also be a function returning the calls that are
+        still to be sent, when a retry sends fewer of them.
+        """
+        for attempt in range(self.quota.MAX_RETRIES + 1):
+            calls = method_ids() if callable(method_ids) else method_ids
+            method = calls[0] if len(calls) == 1 else "batch"
+            with metrics.span("youtube_quota_wait", method=method):
+                self.quota.acquire(calls, priority)
+            metrics.gauge(
+                "youtube_quota_remaining_units",
+                self.quota.metrics()["remaining_units"],
+            )
+            try:
+                with metrics.span("youtube_api_call", method=method):
+                    return send()
+            except (HttpError, requests.HTTPError) as e:
+                reason = self._throttle_reason(e)
+                if reason is None or attempt == self.quota.MAX_RETRIES:
+                    raise
+                self.quota.backoff(attempt, reason)
+
+    @staticmethod
+    def _throttle_reason(error):
+        if isinstance(error, HttpError):
+            status, content = error.resp.status, error.content
+        elif error.response is not None:
+            status, content = error.response.status_code, error.response.content
+        else:
+            return None
+
+        try:
+            reasons = {
+                detail.get("reason")
+                for detail in json.loads(content)["error"]["errors"]
+            }
+        except (ValueError, KeyError, TypeError, AttributeError):
+            reasons = set()
+
+        if status == 403 and "quotaExceeded" in reasons:
+            return "quotaExceeded"
+        if status == 429 or (
+            status == 403 and reasons & {"rateLimitExceeded", "userRateLimitExceeded"}
+        ):
+            return "rateLimitExceeded"
+        return None
+
+    def _http(self):
+        if not hasattr(self._local, "http"):
+            self._local.http = google_auth_httplib2.AuthorizedHttp(
+                self.credentials, http=httplib2.Http()
+            )
+        return self._local.http
+
     def get_playlists(self):
         playlists = []
         request = self.youtube.playlists().list(
@@ -49,7 +189,7 @@ class YoutubeUtils:
         )
 
         while request:
-            response = request.execute()
+            response = self.execute(request)
             for item in response.get("items", []):
                 playlist_id = item["id"]
                 title = item["snippet"]["title"]
@@ -67,7 +207,7 @@ class YoutubeUtils:
         )
 
         while request:
-            response = request.execute()
+            response = self.execute(request)
             for item in response["items"]:
                 video_id = item["snippet"]["resourceId"]["videoId"]
                 title = item["snippet"]["title"]
@@ -79,8 +219,26 @@ class YoutubeUtils:
         return videos
 
     def upload(
-        self, file_path, title, description="", category_id="22", privacy="public"
+        self,
+        file_path,
+        title,
+        description="",
+        category_id="22",
+        privacy="public",
+        session_uri=None,
+        on_progress=None,
+        chunk_size=UPLOAD_CHUNK_SIZE,
+        throttle=None,
     ):
+        """
+        Uploads `file_path` in `chunk_size` pieces and returns the new video
+        as soon as the bytes are sent, before YouTube has processed it (see
+        `processing_details`). Pass the `session_uri` of an interrupted
+        upload to resume it; `on_progress(session_uri, offset)` is called
+        whenever a session starts and after every chunk, so the caller can
+        persist both. Pass a `TokenBucket` of bytes as `throttle` to share a
+        bandwidth budget between uploads.
+        """
         body = {
             "snippet": {
                 "title": title,
@@ -90,43 +248,77 @@ class YoutubeUtils:
             "status": {"privacyStatus": privacy},
         }
 
-        media = MediaFileUpload(
-            file_path, chunksize=-1, resumable=True, mimetype="video/*"
+        upload = ResumableUpload(
+            AuthorizedSession(self.credentials),
+            file_path,
+            chunk_size=chunk_size,
+            throttle=throttle,
         )
-        request = self.youtube.videos().insert(
-            part="snippet,status", body=body, media_body=media
-        )
-
+        started = time.monotonic()
+        start_offset = acknowledged = None
         response = None
         while response is None:
-            status, response = request.next_chunk()
-            if status:
-                print(f"Upload progress: {int(status.progress() * 100)}%")
-        print(f"Upload complete. Video ID: {response['id']}")
+            if session_uri is None:
+                session_uri = self._scheduled(
+                    ["youtube.videos.insert"],
+                    lambda: upload.create_session(
+                        self.UPLOAD_URL, {"part": "snippet,status"}, body
+                    ),
+                )
+                if on_progress:
+                    on_progress(session_uri, 0)
+            else:
+                print(f"Resuming upload of {file_path}.")
 
-        while True:
-            processing_response = (
-                self.youtube.videos()
-                .list(part="processingDetails", id=response["id"])
-                .execute()
-            )
+            def report(offset):
+                nonlocal start_offset, acknowledged
+                if start_offset is None:
+                    start_offset = acknowledged = offset
+                metrics.count("upload_bytes", max(0, offset - acknowledged))
+                acknowledged = offset
+                rate = (offset - start_offset) / (time.monotonic() - started)
+                print(
+                    f"Upload progress of {Path(file_path).name}: "
+                    f"{int(offset / upload.size * 100)}%, {rate / 1e6:.1f} MB/s"
+                )
+                if on_progress:
+                    on_progress(session_uri, offset)
 
-            processing_status = (
-                processing_response["items"][0]
-                .get("processingDetails", {})
-                .get("processingStatus", "")
-            )
+            try:
+                response = upload.upload(session_uri, on_progress=report)
+            except UploadSessionExpiredError:
+                print("Upload session expired, starting over.")
+                session_uri = None
+                started = time.monotonic()
+                start_offset = acknowledged = None
 
-            print(f"Processing status: {processing_status}")
-            if processing_status == "succeeded":
-                break
-            elif processing_status == "failed":
-                raise RuntimeError("YouTube processing failed.")
-            else:
-                time.sleep(5)
+        print(f"Upload complete. Video ID: {response['id']}")
+        metrics.observe("upload_seconds", time.monotonic() - started)
 
         return response
 
+    def processing_details(self, video_ids) -> dict[str, dict]:
+        """
+        Returns the `status` and `processingDetails` parts of many videos,
+        BATCH_SIZE ids per `videos.list` call. Videos that no longer exist
+        are left out.
+        """
+        video_ids = list(video_ids)
+        requests = [
+            self.youtube.videos().list(
+                part="status,processingDetails",
+                id=",".join(video_ids[start : start + self.BATCH_SIZE]),
+            )
+            for start in range(0, len(video_ids), self.BATCH_SIZE)
+        ]
+        if not requests:
+            return {}
+        return {
+            item["id"]: item
+            for response in self.execute_batch(requests, QuotaScheduler.POLL)
+            for item in response["items"]
+        }
+
     def add_to_playlist(self, video_id, playlist_id):
         body = {
             "snippet": {
@@ -139,7 +331,7 @@ class YoutubeUtils:
         }
 
         request = self.youtube.playlistItems().insert(part="snippet", body=body)
-        response = request.execute()
+        response = self.execute(request)
         print(f"Video added to playlist: {response['snippet']['title']}")
         return response
 
@@ -151,20 +343,50 @@ class YoutubeUtils:
         else:
             raise ValueError("Invalid YouTube URL format")
 
-    def video_title_from_id(self, video_id) -> str | None:
-        response = self.youtube.videos().list(part="snippet", id=video_id).execute()
+    def lookup_titles(
+        self, video_ids=(), playlist_ids=()
+    ) -> dict[str, dict[str, str | None]]:
+        """
+        Looks up the titles of many videos and playlists at once, returned as
+        `{"videos": {id: title}, "playlists": {id: title}}` with None for ids
+        that don't exist. Up to BATCH_SIZE ids are packed into each `list`
+        call and all the calls go out as one batch request. Titles are
+        memoized for METADATA_TTL seconds.
+        """
+        wanted = {"videos": video_ids, "playlists": playlist_ids}
+        titles = {kind: {} for kind in wanted}
+        missing = {kind: [] for kind in wanted}
+        with self._metadata_lock:
+            for kind, ids in wanted.items():
+                for id in dict.fromkeys(ids):
+                    if (kind, id) in self._metadata:
+                        titles[kind][id] = self._metadata[(kind, id)]
+                    else:
+                        missing[kind].append(id)
 
-        if response["items"]:
-            return response["items"][0]["snippet"]["title"]
-        else:
-            return None
+        calls = []
+        for kind, ids in missing.items():
+            resource = getattr(self.youtube, kind)()
+            for start in range(0, len(ids), self.BATCH_SIZE):
+                chunk = ids[start : start + self.BATCH_SIZE]
+                request = resource.list(part="snippet", id=",".join(chunk))
+                calls.append((kind, chunk, request))
+        if not calls:
+            return titles
 
-    def playlist_title_from_id(self, playlist_id):
-        response = (
-            self.youtube.playlists().list(part="snippet", id=playlist_id).execute()
-        )
+        responses = self.execute_batch([request for _, _, request in calls])
+        with self._metadata_lock:
+            for (kind, chunk, _), response in zip(calls, responses):
+                found = {
+                    item["id"]: item["snippet"]["title"] for item in response["items"]
+                }
+                for id in chunk:
+                    titles[kind][id] = self._metadata[(kind, id)] = found.get(id)
 
-        if response["items"]:
-            return response["items"][0]["snippet"]["title"]
-        else:
-            return None
+        return titles
+
+    def video_title_from_id(self, video_id) -> str | None:
+        return self.lookup_titles(video_ids=[video_id])["videos"][video_id]
+
+    def playlist_title_from_id(self, playlist_id):
+        return self.lookup_titles(playlist_ids=[playlist_id])["playlists"][playlist_id]